@@ -2,4 +2,4 @@ from flask import Blueprint
 
 api = Blueprint("api", __name__)
 
-from app.api import user, error, reservation, restaurant
+from app.api import user, error, reservation, restaurant, metrics, export
@@ -1,5 +1,8 @@
 from werkzeug.http import HTTP_STATUS_CODES
 
+from app.api import api
+from app.models import PaginationError
+
 
 def error_response(status_code, message=None):
     """Also plagiarized from Miguel Ginberg's guide:
@@ -9,3 +12,8 @@ def error_response(status_code, message=None):
     if message:
         payload["message"] = message
     return payload, status_code
+
+
+@api.errorhandler(PaginationError)
+def pagination_error(e):
+    return error_response(400, str(e))
@@ -0,0 +1,36 @@
+from datetime import datetime
+from app.api import api
+from app.api.error import error_response
+from app.api.reservation import history_args
+from app.export import KINDS, ndjson
+from flask import Response, request, stream_with_context
+
+
+@api.route("/export/<kind>.ndjson", methods=["GET"])
+def export(kind):
+    """Stream every reservation/user/restaurant, one JSON object per line
+
+    Example:
+    curl 'localhost:5000/export/reservations.ndjson?since=2024-08-01T00:00:00%2B00:00'
+    """
+    if kind not in KINDS:
+        return error_response(404, f"Nothing to export as {kind}")
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return error_response(400, f"Invalid datetime {since}")
+    try:
+        # The first chunk runs the query, so errors are raised before streaming
+        chunks = ndjson(kind, since=since, history=bool(history_args()))
+        first = next(chunks, "")
+    except ValueError as e:
+        return error_response(400, str(e))
+
+    def body():
+        yield first
+        yield from chunks
+
+    # Keeps the request (and its db session) open until the last line is sent
+    return Response(stream_with_context(body()), mimetype="application/x-ndjson")
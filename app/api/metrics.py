@@ -0,0 +1,12 @@
+from app.api import api
+from app.api.error import error_response
+from app.instrumentation import metrics
+
+
+@api.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Request latency and SQL counts, in Prometheus text format"""
+    collected = metrics()
+    if collected is None:
+        return error_response(404, "Metrics are disabled")
+    return collected.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
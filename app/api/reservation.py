@@ -1,16 +1,34 @@
+from datetime import datetime, timedelta
 from app.api import api
+from app.api.error import error_response
 from flask import request
-from app.models import db, Reservation
+from app.models import db, Reservation, ReservationHistory, Restaurant, User
 import sqlalchemy as sa
 
 
+def history_args() -> dict:
+    """`?history=true` includes archived reservations. As url_for kwargs, for links"""
+    if request.args.get("history", "false").lower() == "true":
+        return {"history": "true"}
+    return {}
+
+
 @api.route("/reservations", methods=["GET"])
 def reservations():
     """Get all reservations"""
     page = request.args.get("page", 1, type=int)
     per_page = min(request.args.get("per_page", 5, type=int), 100)
-    return Reservation.to_collection_dict(
-        sa.select(Reservation), page, per_page, "api.reservations"
+    history = history_args()
+    model = ReservationHistory if history else Reservation
+    return model.to_collection_dict(
+        # The history is a UNION, with no order of its own
+        sa.select(model).order_by(model.id),
+        page,
+        per_page,
+        "api.reservations",
+        cursor=request.args.get("cursor"),
+        total=request.args.get("total"),
+        **history,
     )
 
 
@@ -21,3 +39,99 @@ def delete_reservation(id):
     db.session.delete(reservation)
     db.session.commit()
     return "", 204
+
+
+def user_ids_arg(value) -> list[int]:
+    """A JSON list of user ids, without duplicates (they'd count twice towards the
+    party size). Raises ValueError for anything else, eg a string of digits
+    """
+    if not isinstance(value, list) or not all(
+        isinstance(u, int) and not isinstance(u, bool) for u in value
+    ):
+        raise ValueError(f"Invalid user ids {value}")
+    return list(dict.fromkeys(value))
+
+
+# Most reservations a single bulk request will create
+MAX_BULK_SIZE = 500
+
+
+@api.route("/reservations/bulk", methods=["POST"])
+def create_reservations_bulk():
+    """Create many reservations, in one transaction
+
+    Expects a JSON list of `{"restaurant_id": 1, "user_ids": [...], "datetime": "..."}`
+    items. Users and restaurants are validated for every item at once, and tables are
+    allocated in order, so an item can fail because an earlier one took the last
+    table. Returns one result per item, in order: either the reservation, or an error
+    payload with its `status`.
+
+    Example:
+    curl -X POST localhost:5000/reservations/bulk -H 'Content-Type: application/json' \
+        -d '[{"restaurant_id": 1, "user_ids": [1, 2], "datetime": "2024-08-04T18:00:00+00:00"}]'
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or len(items) == 0:
+        return error_response(400, "Expected a list of reservations")
+    if len(items) > MAX_BULK_SIZE:
+        return error_response(400, f"At most {MAX_BULK_SIZE} reservations per request")
+
+    def error(status_code, message):
+        payload, status_code = error_response(status_code, message)
+        return {**payload, "status": status_code}
+
+    results = [None] * len(items)
+    parsed = {}
+    for i, item in enumerate(items):
+        try:
+            restaurant_id = int(item.get("restaurant_id"))
+            user_ids = user_ids_arg(item.get("user_ids", []))
+        except (AttributeError, TypeError, ValueError):
+            results[i] = error(400, "Invalid restaurant or user ids")
+            continue
+        if len(user_ids) == 0:
+            results[i] = error(400, "No user ids provided")
+            continue
+        try:
+            dt = datetime.fromisoformat(item.get("datetime"))
+        except Exception:
+            results[i] = error(400, f"Invalid datetime {item.get('datetime')}")
+            continue
+        parsed[i] = (restaurant_id, user_ids, dt, dt + timedelta(hours=2))
+
+    # Validate users and restaurants for every item at once
+    all_users = {u for (_, ids, _, _) in parsed.values() for u in ids}
+    all_restaurants = {rid for (rid, _, _, _) in parsed.values()}
+    users = set(db.session.scalars(sa.select(User.id).where(User.id.in_(all_users))))
+    restaurants = set(
+        db.session.scalars(
+            sa.select(Restaurant.id).where(Restaurant.id.in_(all_restaurants))
+        )
+    )
+    for i, (rid, ids, _, _) in list(parsed.items()):
+        missing = [u for u in ids if u not in users]
+        if rid not in restaurants:
+            results[i] = error(404, f"Restaurant {rid} not found")
+        elif missing:
+            results[i] = error(404, f"User {missing[0]} not found")
+        else:
+            continue
+        del parsed[i]
+
+    order = list(parsed)
+    try:
+        booked = Restaurant.book_table_batch([parsed[i] for i in order])
+    except sa.exc.OperationalError:
+        return error_response(503, "Too many bookings at once, try again")
+
+    ids = [b for b in booked if isinstance(b, int)]
+    reservations = {
+        r["id"]: r
+        for r in Reservation.to_dicts(
+            sa.select(Reservation).where(Reservation.id.in_(ids))
+        )
+    }
+    for i, b in zip(order, booked):
+        results[i] = reservations[b] if isinstance(b, int) else error(400, b)
+
+    return {"results": results}
@@ -1,9 +1,13 @@
-from datetime import datetime, timedelta
-from flask import request
+from datetime import date, datetime, timedelta, timezone
+import io
+from flask import current_app, request
 import sqlalchemy as sa
 
 from app.api import api
 from app.api.error import error_response
+from app.api.reservation import user_ids_arg
+from app.cache import catalog_response, search_cache
+from app.imports import FORMATS, import_restaurants
 from app.models import Restaurant, db, User
 
 
@@ -12,14 +16,83 @@ def restaurants():
     """Get all restaurants"""
     page = request.args.get("page", 1, type=int)
     per_page = min(request.args.get("per_page", 10, type=int), 100)
-    return Restaurant.to_collection_dict(
-        sa.select(Restaurant), page, per_page, "api.restaurants"
+    return catalog_response(
+        "restaurant",
+        None,
+        lambda: Restaurant.to_collection_dict(
+            sa.select(Restaurant),
+            page,
+            per_page,
+            "api.restaurants",
+            cursor=request.args.get("cursor"),
+            total=request.args.get("total"),
+        ),
     )
 
 
+@api.route("/restaurants/import", methods=["POST"])
+def restaurants_import():
+    """Add restaurants, with their tables and endorsements, from an NDJSON/CSV body
+
+    The body is read as it arrives, and written a chunk per transaction (see
+    app/imports.py). `format` defaults to csv for a `text/csv` body, else ndjson.
+    With `name`, a retried upload carries on after the last committed chunk.
+    Returns the totals, with the rejected records and rows/second.
+
+    Example:
+    curl -X POST 'localhost:5000/restaurants/import?name=nyc' \
+        -H 'Content-Type: application/x-ndjson' --data-binary @restaurants.ndjson
+    """
+    default = "csv" if request.mimetype == "text/csv" else "ndjson"
+    fmt = request.args.get("format", default)
+    if fmt not in FORMATS:
+        return error_response(400, f"Unknown format {fmt}")
+    lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    try:
+        return import_restaurants(lines, fmt, name=request.args.get("name"))
+    except UnicodeDecodeError:
+        return error_response(400, "Body isn't UTF-8")
+
+
 @api.route("/restaurant/<int:id>", methods=["GET"])
 def restaurant(id):
-    return db.get_or_404(Restaurant, id).to_dict()
+    return catalog_response(
+        "restaurant", id, lambda: Restaurant.get_or_404(id).to_dict()
+    )
+
+
+@api.route("/restaurant/<int:id>/availability", methods=["GET"])
+def restaurant_availability(id):
+    """Which start times on a day have a table free for a 2 hour reservation
+
+    Example:
+    http://localhost:5000/restaurant/1/availability?date=2024-08-04&party_size=2
+    """
+    restaurant = db.get_or_404(Restaurant, id)
+    day = request.args.get("date", type=str)
+    size = request.args.get("party_size", 1, type=int)
+
+    try:
+        day = date.fromisoformat(day)
+    except Exception:
+        return error_response(400, f"Invalid date {day}")
+    if size < 1:
+        return error_response(400, f"Invalid party size {size}")
+
+    interval = timedelta(minutes=current_app.config["BOOKING_SLOT_MINUTES"])
+    slots = restaurant.day_availability(day, size, interval, timedelta(hours=2))
+    return {
+        "restaurant_id": restaurant.id,
+        "date": day.isoformat(),
+        "party_size": size,
+        "slots": [
+            {
+                "start": start.replace(tzinfo=timezone.utc).isoformat(),
+                "available": available,
+            }
+            for (start, available) in slots
+        ],
+    }
 
 
 @api.route("/restaurant/search", methods=["GET"])
@@ -54,7 +127,109 @@ def restaurant_search():
         return error_response(400, "User has reservation at this time")
 
     query = Restaurant.search_has_table(user_ids, dt, end)
-    return Restaurant.to_collection_dict(query, page, per_page, "api.restaurant_search")
+    return Restaurant.to_collection_dict(
+        query,
+        page,
+        per_page,
+        "api.restaurant_search",
+        cursor=request.args.get("cursor"),
+        total=request.args.get("total"),
+        user_ids=user_ids,
+        datetime=dt.isoformat(),
+    )
+
+
+@api.route("/restaurant/search/cache", methods=["GET"])
+def restaurant_search_cache():
+    """Hit/miss counters for the search cache, to help size it"""
+    cache = search_cache()
+    if cache is None:
+        return error_response(404, "Search cache is disabled")
+    return cache.stats()
+
+
+# Most queries a single batch search will run
+MAX_BATCH_SIZE = 50
+
+
+@api.route("/restaurant/search/batch", methods=["POST"])
+def restaurant_search_batch():
+    """Run many restaurant searches in one request
+
+    Expects a JSON list of `{"user_ids": [...], "datetime": "..."}` queries. User
+    lookups, reservation checks and table availability are shared between queries.
+    Returns one result per query, in order: either the first `per_page` restaurants,
+    or an error payload with its `status`.
+
+    Example:
+    curl -X POST localhost:5000/restaurant/search/batch -H 'Content-Type: application/json' \
+        -d '[{"user_ids": [1, 2], "datetime": "2024-08-04T18:00:00+00:00"}]'
+    """
+    per_page = min(request.args.get("per_page", 10, type=int), 100)
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list) or len(queries) == 0:
+        return error_response(400, "Expected a list of queries")
+    if len(queries) > MAX_BATCH_SIZE:
+        return error_response(400, f"At most {MAX_BATCH_SIZE} queries per batch")
+
+    def error(status_code, message):
+        payload, status_code = error_response(status_code, message)
+        return {**payload, "status": status_code}
+
+    results = [None] * len(queries)
+    parsed = {}
+    for i, query in enumerate(queries):
+        try:
+            user_ids = user_ids_arg(query.get("user_ids", []))
+        except (AttributeError, TypeError, ValueError):
+            results[i] = error(400, "Invalid user ids")
+            continue
+        if len(user_ids) == 0:
+            results[i] = error(400, "No user ids provided")
+            continue
+        try:
+            dt = datetime.fromisoformat(query.get("datetime"))
+        except Exception:
+            results[i] = error(400, f"Invalid datetime {query.get('datetime')}")
+            continue
+        parsed[i] = (user_ids, dt, dt + timedelta(hours=2))
+
+    # Validate users for every query at once
+    all_ids = {u for (ids, _, _) in parsed.values() for u in ids}
+    found = set(db.session.scalars(sa.select(User.id).where(User.id.in_(all_ids))))
+    for i, (ids, _, _) in list(parsed.items()):
+        missing = [u for u in ids if u not in found]
+        if missing:
+            results[i] = error(404, f"User {missing[0]} not found")
+            del parsed[i]
+
+    order = list(parsed)
+    conflicts = User.has_reservation_batch([parsed[i] for i in order])
+    for i, conflict in zip(order, conflicts):
+        if conflict:
+            results[i] = error(400, "User has reservation at this time")
+            del parsed[i]
+
+    order = list(parsed)
+    matches = dict(
+        zip(order, Restaurant.search_has_table_batch([parsed[i] for i in order]))
+    )
+
+    # Serialize every restaurant we need once, for all queries
+    needed = {rid for ids in matches.values() for rid in ids[:per_page]}
+    restaurants = {
+        r["id"]: r
+        for r in Restaurant.to_dicts(
+            sa.select(Restaurant).where(Restaurant.id.in_(needed))
+        )
+    }
+    for i, ids in matches.items():
+        results[i] = {
+            "items": [restaurants[rid] for rid in ids[:per_page]],
+            "_meta": {"per_page": per_page, "total_items": len(ids)},
+        }
+
+    return {"results": results}
 
 
 @api.route("/restaurant/<int:id>/reservation", methods=["POST"])
@@ -78,10 +253,16 @@ def create_reservation(id):
         return error_response(400, "User has reservation at this time")
 
     restaurant_query = Restaurant.search_has_table(user_ids, dt, end)
-    restaurant_query.where(Restaurant.id == id).limit(1)
+    restaurant_query = restaurant_query.where(Restaurant.id == id).limit(1)
     restaurant = db.session.scalars(restaurant_query).first()
     if not restaurant:
         return error_response(400, "Restaurant not available at this time")
 
-    res = restaurant.book_table(user_ids, dt, end)
+    try:
+        res = restaurant.book_table(user_ids, dt, end)
+    except sa.exc.OperationalError:
+        return error_response(503, "Too many bookings at once, try again")
+    # Someone else claimed the last table since we searched
+    if res is None:
+        return error_response(400, "Restaurant not available at this time")
     return res.to_dict()
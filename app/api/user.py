@@ -1,6 +1,8 @@
 from app.api import api
+from app.api.reservation import history_args
+from app.cache import catalog_response
 from flask import request
-from app.models import User, db, Reservation
+from app.models import User, db, Reservation, ReservationHistory
 import sqlalchemy as sa
 
 
@@ -9,12 +11,23 @@ def users():
     """Get all users"""
     page = request.args.get("page", 1, type=int)
     per_page = min(request.args.get("per_page", 5, type=int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page, "api.users")
+    return catalog_response(
+        "user",
+        None,
+        lambda: User.to_collection_dict(
+            sa.select(User),
+            page,
+            per_page,
+            "api.users",
+            cursor=request.args.get("cursor"),
+            total=request.args.get("total"),
+        ),
+    )
 
 
 @api.route("/user/<int:id>", methods=["GET"])
 def user(id):
-    return db.get_or_404(User, id).to_dict()
+    return catalog_response("user", id, lambda: User.get_or_404(id).to_dict())
 
 
 @api.route("/user/<int:id>/reservations", methods=["GET"])
@@ -23,9 +36,15 @@ def user_reservations(id):
     db.get_or_404(User, id)
     page = request.args.get("page", 1, type=int)
     per_page = min(request.args.get("per_page", 5, type=int), 100)
-    return Reservation.to_collection_dict(
-        sa.select(Reservation).where(Reservation.users.any(User.id == id)),
+    history = history_args()
+    model = ReservationHistory if history else Reservation
+    return model.to_collection_dict(
+        model.for_user(id).order_by(model.id),
         page,
         per_page,
-        "api.users",
+        "api.user_reservations",
+        cursor=request.args.get("cursor"),
+        total=request.args.get("total"),
+        id=id,
+        **history,
     )
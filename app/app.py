@@ -2,7 +2,6 @@ from flask import Flask
 from config import Config
 from flask_migrate import Migrate
 
-
 # app.config.from_object(Config)
 migrate = Migrate()
 
@@ -10,14 +9,27 @@ migrate = Migrate()
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    from app import routing, sqlite
     from app.models import db
 
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = sqlite.engine_options(app.config)
     db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            sqlite.apply_profile(engine, app.config)
     migrate.init_app(app, db)
+    routing.init_app(app, db)
+
+    # Registers the session listeners that keep in-memory engines/caches in sync
+    from app import availability, busy, cache, slots  # noqa: F401
 
     from app.api import api
 
     app.register_blueprint(api)
+
+    from app import instrumentation
+
+    instrumentation.init_app(app)
     return app
 
 
@@ -0,0 +1,90 @@
+"""Move past reservations out of `reservation`, so overlap checks only see live rows
+
+A reservation that ended before the cutoff can't conflict with a new booking, but
+every search, booking and `User.has_reservation` would still read past it. Archiving
+moves it (and its `user_reservation` rows) into `reservation_archive` and
+`user_reservation_archive`, with the same ids. `?history=true` on
+`/reservations` and `/user/<id>/reservations` reads both (`ReservationHistory`).
+
+Run it periodically, eg daily from cron: `python scripts.py archive`. Each batch is
+its own short transaction, so bookings aren't locked out while it runs.
+"""
+
+from datetime import datetime, timedelta
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app import availability
+from app.cache import search_cache
+from app.models import (
+    Reservation,
+    db,
+    reservation_archive,
+    table_slot,
+    user_busy,
+    user_reservation,
+    user_reservation_archive,
+)
+
+
+def cutoff(now: datetime | None = None) -> datetime:
+    """Reservations ending before this are archived: `ARCHIVE_AFTER_DAYS` ago"""
+    now = now or datetime.now()
+    return now - timedelta(days=current_app.config.get("ARCHIVE_AFTER_DAYS", 30))
+
+
+def archive_reservations(before: datetime, batch_size: int | None = None) -> int:
+    """Archive every reservation that ended before `before`. Returns how many"""
+    batch_size = batch_size or current_app.config.get("ARCHIVE_BATCH_SIZE", 1000)
+    before = before.replace(tzinfo=None)
+    archived = 0
+    while True:
+        ids = db.session.scalars(
+            sa.select(Reservation.id)
+            # `start` is indexed, and a reservation ending before the cutoff starts
+            # before it too
+            .where(Reservation.start < before, Reservation.end < before)
+            .order_by(Reservation.id)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            break
+        _archive_batch(ids)
+        archived += len(ids)
+
+    if archived:
+        # Past blocks have fewer reservations now
+        cache = search_cache()
+        if cache is not None:
+            cache.invalidate(lambda key: key[2] < before)
+        availability.reset()
+    return archived
+
+
+def _archive_batch(ids: list[int]):
+    reservations = Reservation.__table__
+    columns = ["id", "start", "end", "table_id"]
+    db.session.execute(
+        reservation_archive.insert().from_select(
+            columns,
+            sa.select(*(reservations.c[c] for c in columns)).where(
+                reservations.c.id.in_(ids)
+            ),
+        )
+    )
+    db.session.execute(
+        user_reservation_archive.insert().from_select(
+            ["user_id", "reservation_id"],
+            sa.select(
+                user_reservation.c.user_id, user_reservation.c.reservation_id
+            ).where(user_reservation.c.reservation_id.in_(ids)),
+        )
+    )
+    db.session.execute(
+        user_reservation.delete().where(user_reservation.c.reservation_id.in_(ids))
+    )
+    db.session.execute(user_busy.delete().where(user_busy.c.reservation_id.in_(ids)))
+    db.session.execute(table_slot.delete().where(table_slot.c.reservation_id.in_(ids)))
+    db.session.execute(reservations.delete().where(reservations.c.id.in_(ids)))
+    db.session.commit()
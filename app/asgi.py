@@ -0,0 +1,171 @@
+"""Async entry point: the same app, served over ASGI with an async SQLAlchemy engine
+
+`AsyncApp` wraps the Flask app. Every request is dispatched through Flask as usual
+(same routes, models and hooks), but inside `AsyncSession.run_sync`, with `db.session`
+pointed at that request's session. The session's connection is an async driver
+(aiosqlite for SQLite), so whenever a handler waits on the db, the event loop moves
+on to other requests, instead of a thread sitting blocked.
+
+Serve it with any ASGI server, eg `uvicorn rec_async:app`. Requires aiosqlite (and an
+ASGI server), which aren't in the poetry deps.
+
+Handlers still run one at a time between db calls, so this helps I/O-bound traffic
+(many requests waiting on the db), not CPU-bound work.
+"""
+
+import asyncio
+import io
+import sys
+from urllib.parse import urlsplit
+
+from flask import Flask
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import instrumentation, sqlite
+from app.models import db
+
+# Async drivers for the sync URLs in config.py
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def async_url(url: str) -> sa.URL:
+    """`SQLALCHEMY_DATABASE_URI` with its async driver"""
+    url = sa.make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+class AsyncApp:
+    """ASGI app running `app`'s requests on an async engine"""
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.engine = create_async_engine(
+            app.config.get("SQLALCHEMY_ASYNC_DATABASE_URI")
+            or async_url(app.config["SQLALCHEMY_DATABASE_URI"])
+        )
+        sqlite.apply_profile(self.engine.sync_engine, app.config)
+        # A no-op unless `instrumentation` is on, like the sync engine's hooks
+        instrumentation.instrument_engine(self.engine.sync_engine)
+        self.sessions = async_sessionmaker(self.engine)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise NotImplementedError(f"Unsupported ASGI scope {scope['type']}")
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        environ = _environ(scope, body)
+        async with self.sessions() as session:
+            status, headers, data = await session.run_sync(self._dispatch, environ)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (k.encode("latin1"), v.encode("latin1")) for (k, v) in headers
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": data})
+
+    def _dispatch(self, session, environ):
+        """Handle one request in Flask, on `session` (in `run_sync`'s greenlet)"""
+        # A fresh app context, even if the caller has one: `db.session` is scoped to it
+        with self.app.app_context(), self.app.request_context(environ):
+            # Removed (and closed) when the app context is torn down
+            db.session.registry.set(session)
+            response = self.app.full_dispatch_request()
+            return (
+                response.status_code,
+                response.headers.to_wsgi_list(),
+                response.get_data(),
+            )
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def _environ(scope: dict, body: bytes) -> dict:
+    """The WSGI environ Flask expects, for an ASGI HTTP scope"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    return environ
+
+
+async def local_request(app, method: str, url: str, body: bytes = b"", headers=()):
+    """Call an ASGI app directly, without a server. Returns (status, headers, body)
+
+    For tests and benchmarks.
+    """
+    parts = urlsplit(url)
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": parts.path,
+        "query_string": parts.query.encode("latin1"),
+        "root_path": "",
+        "headers": [
+            (k.lower().encode("latin1"), v.encode("latin1")) for (k, v) in headers
+        ]
+        + [(b"content-length", str(len(body)).encode("latin1"))],
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 0),
+    }
+    received = asyncio.Queue()
+    await received.put({"type": "http.request", "body": body, "more_body": False})
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, received.get, send)
+    start, payload = sent
+    headers = [(k.decode("latin1"), v.decode("latin1")) for (k, v) in start["headers"]]
+    return start["status"], headers, payload["body"]
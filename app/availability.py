@@ -0,0 +1,382 @@
+"""In-memory availability engines for `Restaurant.search_has_table`.
+
+The default engine ("sql") runs the overlap check as an EXISTS subquery against
+`reservation`. The engines here keep a copy of the reservations in the process, so
+the overlap check doesn't touch `reservation` at all. They are built lazily from the
+database, then kept in sync by listening to the session: any reservation that is
+flushed and committed (eg, by `Restaurant.book_table` or `DELETE /reservation/<id>`)
+is applied to the engine.
+
+- "index": sorted intervals per table, exact
+- "matrix": NumPy tables x time slots occupancy counts, for a fixed horizon
+
+Note these are per-process. If you run several workers, every worker keeps its own
+copy and only sees its own writes.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from operator import itemgetter
+import threading
+
+from flask import current_app, has_app_context
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app.models import db, pre_flush_values, Reservation, Table
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the "matrix" engine
+    np = None
+
+
+def _naive(dt: datetime) -> datetime:
+    """SQLite stores datetimes without a timezone, so compare them the same way"""
+    return dt.replace(tzinfo=None)
+
+
+def _today() -> datetime:
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class IntervalIndex:
+    """Sorted (start, end, reservation id) intervals for every table
+
+    Overlap semantics match the SQL check: a reservation conflicts with a block if
+    `reservation.start <= end and reservation.end >= start`.
+    """
+
+    name = "index"
+    stale = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables: dict[int, list[tuple[datetime, datetime, int]]] = {}
+        # Longest reservation seen, so we know how far back a conflicting start can be
+        self._max_length = timedelta(0)
+
+    @classmethod
+    def build(
+        cls,
+        start: datetime | None = None,
+        end: datetime | None = None,
+        table_ids: list[int] | None = None,
+    ):
+        """Index every reservation, or only those overlapping `start`-`end` (and on
+        `table_ids`)
+        """
+        index = cls()
+        query = sa.select(
+            Reservation.table_id, Reservation.id, Reservation.start, Reservation.end
+        )
+        if start is not None and end is not None:
+            query = query.where(Reservation.start <= end, Reservation.end >= start)
+        if table_ids is not None:
+            query = query.where(Reservation.table_id.in_(table_ids))
+        rows = db.session.execute(query)
+        for table_id, id_, start, end in rows:
+            index.add(table_id, id_, start, end)
+        return index
+
+    def add(self, table_id: int, id_: int, start: datetime, end: datetime):
+        """Add an interval, unless it's already there"""
+        start, end = _naive(start), _naive(end)
+        with self._lock:
+            intervals = self._tables.setdefault(table_id, [])
+            i = bisect_left(intervals, (start, end, id_))
+            if i < len(intervals) and intervals[i] == (start, end, id_):
+                return
+            intervals.insert(i, (start, end, id_))
+            self._max_length = max(self._max_length, end - start)
+
+    def remove(self, table_id: int, id_: int, start: datetime, end: datetime):
+        start, end = _naive(start), _naive(end)
+        with self._lock:
+            intervals = self._tables.get(table_id, [])
+            i = bisect_left(intervals, (start, end, id_))
+            if i < len(intervals) and intervals[i] == (start, end, id_):
+                del intervals[i]
+
+    def is_free(self, table_id: int, start: datetime, end: datetime) -> bool:
+        start, end = _naive(start), _naive(end)
+        intervals = self._tables.get(table_id)
+        if not intervals:
+            return True
+        # Anything starting before this can't reach `start`
+        lo = bisect_left(intervals, start - self._max_length, key=itemgetter(0))
+        hi = bisect_right(intervals, end, key=itemgetter(0))
+        return not any(e >= start for (_, e, _) in intervals[lo:hi])
+
+    def tables_changed(self):
+        # Tables are read from the db on every search
+        pass
+
+    def available_restaurants(self, size: int, start: datetime, end: datetime):
+        """Ids of restaurants with a free table of at least `size`"""
+        tables = db.session.execute(
+            sa.select(Table.id, Table.restaurant_id).where(Table.capacity >= size)
+        ).all()
+        with self._lock:
+            return {rid for (tid, rid) in tables if self.is_free(tid, start, end)}
+
+
+class OccupancyMatrix:
+    """Reservation counts per (table, time slot), for a fixed horizon
+
+    Rows are tables (with parallel `capacity`/`restaurant_ids` arrays) and columns are
+    `OCCUPANCY_SLOT_MINUTES` slots from `origin`, for `OCCUPANCY_HORIZON_DAYS`. A
+    reservation counts against every slot it touches, so a search is a reduction over
+    a column range instead of a per-table lookup.
+
+    Times are rounded out to whole slots, so this can report a table as busy when a
+    reservation only comes within a slot of the block (never the other way around).
+    Blocks outside the horizon return None, and the caller falls back to SQL.
+
+    Without `OCCUPANCY_ORIGIN` the horizon starts at midnight today, and moves with
+    the day: once the date changes the matrix is stale, and rebuilt on next use.
+    """
+
+    name = "matrix"
+
+    def __init__(self, origin: datetime, slot: timedelta, slots: int, tables):
+        self._lock = threading.Lock()
+        self._stale = False
+        # Whether the origin is today's, rather than `OCCUPANCY_ORIGIN`
+        self.rolling = False
+        self.origin = _naive(origin)
+        self.slot = slot
+        self.table_ids = np.array([t[0] for t in tables], dtype=np.int64)
+        self.capacity = np.array([t[1] for t in tables], dtype=np.int32)
+        self.restaurant_ids = np.array([t[2] for t in tables], dtype=np.int64)
+        self.rows = {tid: i for (i, tid) in enumerate(self.table_ids.tolist())}
+        self.occupied = np.zeros((len(self.table_ids), slots), dtype=np.uint8)
+        # What's marked for each reservation id, so marking one twice is a no-op
+        self._spans: dict[int, tuple[int, datetime, datetime]] = {}
+
+    @classmethod
+    def build(cls):
+        if np is None:
+            raise RuntimeError("The matrix availability engine requires numpy")
+
+        config = current_app.config
+        slot = timedelta(minutes=config.get("OCCUPANCY_SLOT_MINUTES", 15))
+        horizon = timedelta(days=config.get("OCCUPANCY_HORIZON_DAYS", 7))
+        origin = config.get("OCCUPANCY_ORIGIN") or _today()
+        tables = db.session.execute(
+            sa.select(Table.id, Table.capacity, Table.restaurant_id).order_by(Table.id)
+        ).all()
+        matrix = cls(origin, slot, horizon // slot, tables)
+        matrix.rolling = not config.get("OCCUPANCY_ORIGIN")
+
+        rows = db.session.execute(
+            sa.select(
+                Reservation.id, Reservation.table_id, Reservation.start, Reservation.end
+            ).where(
+                Reservation.end >= matrix.origin,
+                Reservation.start <= matrix.origin + horizon,
+            )
+        ).all()
+        matrix._load(rows)
+        return matrix
+
+    @property
+    def stale(self) -> bool:
+        """Needs a rebuild: the tables changed, or the day did (for a rolling origin)"""
+        return self._stale or (self.rolling and _today() != self.origin)
+
+    @stale.setter
+    def stale(self, value: bool):
+        self._stale = value
+
+    def _slots(self, start: datetime, end: datetime) -> tuple[int, int]:
+        """Inclusive slot range touched by a block"""
+        first = (_naive(start) - self.origin) // self.slot
+        last = (_naive(end) - self.origin) // self.slot
+        return first, last
+
+    def _load(self, rows):
+        """Mark many reservations at once, via a difference array"""
+        n_tables, n_slots = self.occupied.shape
+        diff = np.zeros((n_tables, n_slots + 1), dtype=np.int32)
+        table_rows, firsts, lasts = [], [], []
+        for id_, table_id, start, end in rows:
+            if table_id not in self.rows:
+                continue
+            self._spans[id_] = (table_id, _naive(start), _naive(end))
+            first, last = self._slots(start, end)
+            table_rows.append(self.rows[table_id])
+            firsts.append(max(first, 0))
+            lasts.append(min(last, n_slots - 1) + 1)
+        if not table_rows:
+            return
+        np.add.at(diff, (table_rows, firsts), 1)
+        np.add.at(diff, (table_rows, lasts), -1)
+        self.occupied += np.cumsum(diff, axis=1)[:, :n_slots].astype(np.uint8)
+
+    def _mark(self, table_id: int, start: datetime, end: datetime, delta: int):
+        """Count a reservation in or out, with `_lock` held"""
+        first, last = self._slots(start, end)
+        first, last = max(first, 0), min(last, self.occupied.shape[1] - 1)
+        if first > last:
+            return
+        cells = self.occupied[self.rows[table_id], first : last + 1]
+        if delta > 0:
+            cells += 1
+        else:
+            cells -= np.minimum(cells, 1)
+
+    def add(self, table_id: int, id_: int, start: datetime, end: datetime):
+        """Mark reservation `id_`, unless it already is (or move it, if it moved)"""
+        if table_id not in self.rows:
+            # A table we haven't seen, so rebuild on next use
+            self.stale = True
+            return
+        span = (table_id, _naive(start), _naive(end))
+        with self._lock:
+            old = self._spans.get(id_)
+            if old == span:
+                return
+            if old is not None:
+                self._mark(*old, -1)
+            self._spans[id_] = span
+            self._mark(*span, 1)
+
+    def remove(self, table_id: int, id_: int, start: datetime, end: datetime):
+        with self._lock:
+            old = self._spans.pop(id_, None)
+            if old is not None:
+                self._mark(*old, -1)
+
+    def tables_changed(self):
+        self.stale = True
+
+    def available_restaurants(self, size: int, start: datetime, end: datetime):
+        """Ids of restaurants with a free table of at least `size`
+
+        None if the block isn't inside the horizon.
+        """
+        first, last = self._slots(start, end)
+        if first < 0 or last >= self.occupied.shape[1]:
+            return None
+        with self._lock:
+            rows = np.flatnonzero(self.capacity >= size)
+            busy = self.occupied[rows, first : last + 1].any(axis=1)
+        return set(np.unique(self.restaurant_ids[rows[~busy]]).tolist())
+
+
+ENGINES = {
+    IntervalIndex.name: IntervalIndex,
+    OccupancyMatrix.name: OccupancyMatrix,
+}
+
+# Re-entrant, so async requests interleaved on one thread can't deadlock on it
+_build_lock = threading.RLock()
+# Held to apply committed changes, and to swap in a newly built engine
+_changes_lock = threading.Lock()
+
+
+def get_engine():
+    """The configured engine for the current app, or None for plain SQL"""
+    name = current_app.config.get("AVAILABILITY_ENGINE", "sql")
+    if name == "sql":
+        return None
+    if name not in ENGINES:
+        raise ValueError(f"Unknown availability engine {name}")
+
+    engines = current_app.extensions.setdefault("availability", {})
+    if name not in engines or engines[name].stale:
+        with _build_lock:
+            if name not in engines or engines[name].stale:
+                _build(name, engines)
+    return engines[name]
+
+
+def _build(name: str, engines: dict):
+    """Build engine `name` and swap it in
+
+    A commit landing after the build's SELECT isn't in it, and its listener doesn't
+    see the new engine yet either, so changes committed meanwhile are kept aside
+    and replayed onto it. Engines ignore changes they already have.
+    """
+    missed = current_app.extensions["availability_missed"] = []
+    try:
+        engine = ENGINES[name].build()
+    except Exception:
+        with _changes_lock:
+            current_app.extensions.pop("availability_missed", None)
+        raise
+    with _changes_lock:
+        current_app.extensions.pop("availability_missed", None)
+        for op, *args in missed:
+            getattr(engine, op)(*args)
+        engines[name] = engine
+
+
+def reset():
+    """Drop built engines, so they are rebuilt from the database on next use"""
+    current_app.extensions.pop("availability", None)
+
+
+def _apply(op, *args):
+    for engine in current_app.extensions.get("availability", {}).values():
+        getattr(engine, op)(*args)
+
+
+@sa.event.listens_for(so.Session, "after_flush")
+def _record_changes(session, flush_context):
+    """Remember reservation writes, to apply once the transaction commits
+
+    Recorded whenever an engine is configured, even before it's built: one built
+    before this transaction commits won't see the changes in its SELECT.
+    """
+    if not has_app_context() or (
+        current_app.config.get("AVAILABILITY_ENGINE", "sql") == "sql"
+        and not current_app.extensions.get("availability")
+    ):
+        return
+    pending = session.info.setdefault("availability", [])
+    for obj in session.new:
+        if isinstance(obj, Reservation):
+            pending.append(("add", obj.table_id, obj.id, obj.start, obj.end))
+    for obj in session.deleted:
+        if isinstance(obj, Reservation):
+            pending.append(("remove", obj.table_id, obj.id, obj.start, obj.end))
+    tables = [
+        obj
+        for obj in session.new | session.deleted | session.dirty
+        if isinstance(obj, Table)
+    ]
+    if any(
+        obj not in session.dirty or session.is_modified(obj, include_collections=False)
+        for obj in tables
+    ):
+        pending.append(("tables_changed",))
+    for obj in session.dirty:
+        if not isinstance(obj, Reservation):
+            continue
+        state = sa.inspect(obj)
+        histories = [state.attrs[key].history for key in ("table_id", "start", "end")]
+        if not any(h.has_changes() for h in histories):
+            continue
+        old = pre_flush_values(obj, ("table_id", "start", "end"))
+        pending.append(("remove", old[0], obj.id, old[1], old[2]))
+        pending.append(("add", obj.table_id, obj.id, obj.start, obj.end))
+
+
+@sa.event.listens_for(so.Session, "after_commit")
+def _apply_changes(session):
+    pending = session.info.pop("availability", [])
+    if not pending or not has_app_context():
+        return
+    with _changes_lock:
+        missed = current_app.extensions.get("availability_missed")
+        if missed is not None:
+            missed.extend(pending)
+        for change in pending:
+            _apply(*change)
+
+
+@sa.event.listens_for(so.Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop("availability", None)
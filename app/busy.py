@@ -0,0 +1,86 @@
+"""`user_busy`: every user's reservation times, for `User.has_reservation`
+
+`user_reservation` only links users to reservations, so checking a party is free
+joined every one of its users' reservations to `reservation`, for their times.
+`user_busy` copies the times in, keyed by user and indexed on (user_id, end, start),
+so the check is a range probe per user that stops at the first hit.
+
+Session flushes keep it in sync: new reservations, their times changing, users
+added/removed from either side of the relationship, and deletions. Core writes to
+`reservation`/`user_reservation` (eg `scripts.generate`, which does it for you)
+bypass the session, so rebuild it after them: `python scripts.py busy`.
+"""
+
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app.models import Reservation, User, db, user_busy, user_reservation
+
+
+def _select(reservation_ids=None):
+    """Rows for `user_busy`, from `user_reservation` and `reservation`"""
+    query = sa.select(
+        user_reservation.c.reservation_id,
+        user_reservation.c.user_id,
+        Reservation.start,
+        Reservation.end,
+    ).join(Reservation, Reservation.id == user_reservation.c.reservation_id)
+    if reservation_ids is not None:
+        query = query.where(user_reservation.c.reservation_id.in_(reservation_ids))
+    return query
+
+
+_columns = ["reservation_id", "user_id", "start", "end"]
+
+
+@sa.event.listens_for(Reservation, "before_delete")
+def _delete_busy(mapper, connection, target):
+    connection.execute(
+        user_busy.delete().where(user_busy.c.reservation_id == target.id)
+    )
+
+
+@sa.event.listens_for(so.Session, "after_flush")
+def _update_busy(session, flush_context):
+    """Rewrite `user_busy` for the reservations this flush changed
+
+    Like the restriction masks, rows are recomputed from `user_reservation`, so it
+    doesn't matter which side of the relationship changed.
+    """
+    changed = set()
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Reservation):
+            state = sa.inspect(obj)
+            if obj in session.new or any(
+                state.attrs[key].history.has_changes()
+                for key in ("start", "end", "users")
+            ):
+                changed.add(obj.id)
+        elif isinstance(obj, User):
+            history = sa.inspect(obj).attrs.reservations.history
+            changed.update(r.id for r in list(history.added) + list(history.deleted))
+    changed -= {obj.id for obj in session.deleted if isinstance(obj, Reservation)}
+    if not changed:
+        return
+
+    connection = session.connection()
+    # New reservations have no rows yet, so a booking is a single INSERT
+    existing = changed - {obj.id for obj in session.new if isinstance(obj, Reservation)}
+    if existing:
+        connection.execute(
+            user_busy.delete().where(user_busy.c.reservation_id.in_(existing))
+        )
+    connection.execute(user_busy.insert().from_select(_columns, _select(changed)))
+
+
+def rebuild() -> int:
+    """Regenerate `user_busy` from `user_reservation`, in one transaction
+
+    Returns how many rows were written.
+    """
+    db.session.execute(user_busy.delete())
+    written = db.session.execute(
+        user_busy.insert().from_select(_columns, _select())
+    ).rowcount
+    db.session.commit()
+    return written
@@ -0,0 +1,305 @@
+"""In-process result caches, invalidated by listening to the session
+
+Changes are collected when a session flushes, and applied once it commits. Like the
+availability engines, these are per-process.
+
+Search cache: `Restaurant.search_has_table` results, keyed by what decides them: the
+restrictions every restaurant must endorse (as a mask), the party size, and the time
+block. Not the user ids, so different parties with the same needs share entries.
+- a reservation added/removed drops entries whose block overlaps it
+- an endorsement added/removed drops entries that require that restriction
+- any table change (or a deleted restaurant) drops everything
+
+Catalog cache: serialized `/restaurants`, `/restaurant/<id>`, `/users`, `/user/<id>`
+responses, with ETags. Every user/restaurant has a version, bumped by any change to
+its row or its restrictions/endorsements. Changing one also bumps the version of its
+collection, and changing a restriction bumps everything. Versions are rows in
+`catalog_version`, bumped in the same transaction as the change, so writes from
+other workers, `flask shell` or `scripts.py` invalidate this process's responses
+too. Each response reads its versions, one lookup by key.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import threading
+
+from flask import current_app, has_app_context, request
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app.models import (
+    Reservation,
+    Restaurant,
+    Restriction,
+    Table,
+    User,
+    catalog_version,
+    db,
+    pre_flush_values,
+)
+
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        # Bumped on every invalidation, so results computed before one aren't stored
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, generation: int | None = None):
+        """Store `value`, unless something was invalidated since `generation`"""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        """Drop entries whose key matches `predicate`, or everything"""
+        with self._lock:
+            self.generation += 1
+            keys = [k for k in self._data if predicate is None or predicate(k)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+def search_cache() -> LRUCache | None:
+    """The search cache for the current app, or None if it's disabled"""
+    maxsize = current_app.config.get("SEARCH_CACHE_SIZE", 0)
+    if not maxsize:
+        return None
+    return current_app.extensions.setdefault("search_cache", LRUCache(maxsize))
+
+
+def search_key(required: int, size: int, start: datetime, end: datetime):
+    # SQLite compares datetimes without their timezone, so cache them the same way
+    return (required, size, start.replace(tzinfo=None), end.replace(tzinfo=None))
+
+
+def _overlaps(start: datetime, end: datetime):
+    start, end = start.replace(tzinfo=None), end.replace(tzinfo=None)
+    return lambda key: key[2] <= end and key[3] >= start
+
+
+def _requires(bits: int):
+    return lambda key: key[0] & bits
+
+
+class CatalogCache:
+    """Serialized responses, keyed by the version of what they show"""
+
+    # Tables whose rows show up in each kind of response
+    TABLES = {
+        "restaurant": {"restaurant", "restaurant_endorsement", "restriction"},
+        "user": {"user", "user_restriction", "restriction"},
+    }
+
+    def __init__(self, maxsize: int):
+        self.responses = LRUCache(maxsize)
+
+    @staticmethod
+    def version(kind: str, id_: int | None) -> tuple[int, int]:
+        """Committed versions of everything of `kind`, and of `id_` (or the
+        collection)
+        """
+        keys = ["*", _version_key(id_)]
+        versions = dict(
+            db.session.execute(
+                sa.select(catalog_version.c.key, catalog_version.c.version).where(
+                    catalog_version.c.kind == kind, catalog_version.c.key.in_(keys)
+                )
+            ).all()
+        )
+        return tuple(versions.get(key, 0) for key in keys)
+
+
+def _version_key(id_: int | None) -> str:
+    return "" if id_ is None else str(id_)
+
+
+def _bump(connection, changes):
+    """Bump the versions of (kind, id) `changes`, as part of `connection`'s transaction
+
+    An id of None is everything of that kind. An object's change also bumps its
+    collection.
+    """
+    keys = set()
+    for kind, id_ in changes:
+        if id_ is None:
+            keys.add((kind, "*"))
+        else:
+            keys |= {(kind, _version_key(id_)), (kind, "")}
+    for kind, key in sorted(keys):
+        where = sa.and_(catalog_version.c.kind == kind, catalog_version.c.key == key)
+        updated = connection.execute(
+            catalog_version.update()
+            .where(where)
+            .values(version=catalog_version.c.version + 1)
+        )
+        if not updated.rowcount:
+            connection.execute(
+                catalog_version.insert().values(kind=kind, key=key, version=1)
+            )
+
+
+def catalog_cache() -> CatalogCache | None:
+    maxsize = current_app.config.get("CATALOG_CACHE_SIZE", 0)
+    if not maxsize:
+        return None
+    return current_app.extensions.setdefault("catalog_cache", CatalogCache(maxsize))
+
+
+def catalog_response(kind: str, id_: int | None, build):
+    """JSON response for `build()`, cached until `kind`/`id_` changes
+
+    Pass `id_=None` for a collection. The response has a strong ETag, and is a 304
+    if it matches `If-None-Match`.
+    """
+    catalog = catalog_cache()
+    key = (kind, id_, request.url)
+    if catalog is not None:
+        version = catalog.version(kind, id_)
+        cached = catalog.responses.get(key)
+        if cached is not None and cached[0] == version:
+            _, etag, body = cached
+        else:
+            cached = None
+
+    if catalog is None or cached is None:
+        body = current_app.json.response(build()).get_data()
+        etag = hashlib.sha1(body).hexdigest()
+        if catalog is not None:
+            catalog.responses.put(key, (version, etag, body))
+
+    response = current_app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def bump_catalog(*kinds: str):
+    """Invalidate whole kinds, for writes the session can't see (eg on a connection
+    of their own), and commit
+    """
+    _bump(db.session.connection(), [(kind, None) for kind in kinds])
+    db.session.commit()
+
+
+@sa.event.listens_for(so.Session, "after_flush")
+def _bump_catalog_versions(session, flush_context):
+    pending = []
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Restriction):
+            if obj not in session.dirty or session.is_modified(
+                obj, include_collections=False
+            ):
+                pending += [("restaurant", None), ("user", None)]
+            # Users changed from the restriction's side of the relationship
+            history = sa.inspect(obj).attrs.users.history
+            for user in list(history.added) + list(history.deleted):
+                pending.append(("user", user.id))
+            continue
+        if isinstance(obj, Restaurant):
+            kind, collection = "restaurant", "endorsements"
+        elif isinstance(obj, User):
+            kind, collection = "user", "restrictions"
+        else:
+            continue
+        if (
+            obj not in session.dirty
+            or session.is_modified(obj, include_collections=False)
+            or sa.inspect(obj).attrs[collection].history.has_changes()
+        ):
+            pending.append((kind, obj.id))
+    if pending:
+        _bump(session.connection(), pending)
+
+
+@sa.event.listens_for(so.Session, "do_orm_execute")
+def _bump_bulk_catalog_versions(orm_execute_state):
+    """Bulk statements don't go through the flush, so invalidate whole kinds"""
+    if orm_execute_state.is_select:
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    name = getattr(table, "name", None)
+    kinds = [kind for (kind, tables) in CatalogCache.TABLES.items() if name in tables]
+    if kinds:
+        _bump(orm_execute_state.session.connection(), [(kind, None) for kind in kinds])
+
+
+@sa.event.listens_for(so.Session, "after_flush")
+def _record_changes(session, flush_context):
+    """Remember what cached searches a flush affects, until it commits"""
+    pending = session.info.setdefault("search_cache", [])
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Reservation):
+            pending.append(_overlaps(obj.start, obj.end))
+        elif isinstance(obj, Table) or (
+            isinstance(obj, Restaurant) and obj in session.deleted
+        ):
+            pending.append(None)
+
+    for obj in session.dirty:
+        if isinstance(obj, Reservation):
+            # Searches in the block it left, and in the one it's in now
+            start, end = pre_flush_values(obj, ("start", "end"))
+            pending.append(_overlaps(start, end))
+            pending.append(_overlaps(obj.start, obj.end))
+        elif isinstance(obj, Table) and session.is_modified(
+            obj, include_collections=False
+        ):
+            pending.append(None)
+
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Restaurant):
+            history = sa.inspect(obj).attrs.endorsements.history
+            changed = Restriction.mask(list(history.added) + list(history.deleted))
+            if changed:
+                pending.append(_requires(changed))
+
+
+@sa.event.listens_for(so.Session, "after_commit")
+def _invalidate(session):
+    search = session.info.pop("search_cache", [])
+    if not has_app_context():
+        return
+
+    cache = current_app.extensions.get("search_cache")
+    if cache is not None:
+        for predicate in search:
+            cache.invalidate(predicate)
+
+
+@sa.event.listens_for(so.Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop("search_cache", None)
@@ -0,0 +1,68 @@
+"""Full dumps as NDJSON: one JSON object per line, for analytics and backups
+
+Paging through `/reservations` for a whole table runs a query (and a COUNT) per page,
+and each OFFSET page reads past every row before it. An export is one query, read
+`EXPORT_BATCH_SIZE` rows at a time and written out as it goes, so memory stays flat
+however big the table is. Each line is the same object the list endpoints return.
+
+- HTTP: `GET /export/<kind>.ndjson`, streamed (see app/api/export.py)
+- Offline: `python scripts.py export <kind> -o dump.ndjson`
+
+`kind` is one of `KINDS`. Reservations take `since` (only those starting at or after
+it) and `history` (include archived ones). Over the async entry point (app/asgi.py)
+responses are buffered whole, so use the threaded server or the CLI for big dumps.
+"""
+
+from datetime import datetime
+import json
+from typing import Iterator
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app.models import Reservation, ReservationHistory, Restaurant, User
+
+KINDS = {
+    "reservations": Reservation,
+    "users": User,
+    "restaurants": Restaurant,
+}
+
+
+def export_query(kind: str, since: datetime | None = None, history: bool = False):
+    """(model, query) for everything of `kind`"""
+    model = KINDS[kind]
+    if model is Reservation:
+        if history:
+            model = ReservationHistory
+        query = sa.select(model)
+        if since is not None:
+            query = query.where(model.start >= since.replace(tzinfo=None))
+    elif since is not None or history:
+        raise ValueError(f"{kind} can't be filtered by since/history")
+    else:
+        query = sa.select(model)
+    # In index order, so it's read in order rather than sorted. The history is a
+    # UNION (of two indexes), so it'd be sorted in a temporary table: left unordered
+    if model is not ReservationHistory:
+        query = query.order_by(*(getattr(model, key) for key in model.cursor_keys))
+    return model, query
+
+
+def ndjson(
+    kind: str,
+    since: datetime | None = None,
+    history: bool = False,
+    batch_size: int | None = None,
+) -> Iterator[str]:
+    """Every `kind` as NDJSON, in chunks of `batch_size` lines"""
+    batch_size = batch_size or current_app.config.get("EXPORT_BATCH_SIZE", 1000)
+    model, query = export_query(kind, since, history)
+    lines = []
+    for item in model.iter_dicts(query, batch_size):
+        lines.append(json.dumps(item, ensure_ascii=False) + "\n")
+        if len(lines) >= batch_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
@@ -0,0 +1,268 @@
+"""Bulk import of restaurants, with their tables and endorsements, from NDJSON or CSV
+
+Onboarding a city is thousands of restaurants. Through the ORM that's a flush (and
+the mask/cache bookkeeping) per restaurant, so instead records are read as a stream
+and written `IMPORT_CHUNK_SIZE` at a time, with a bulk INSERT per table and one
+transaction per chunk. Restriction names are resolved through one name -> id map,
+loaded up front.
+
+- HTTP: `POST /restaurants/import`, with the file as the body
+- Offline: `python scripts.py import restaurants.ndjson`
+
+Each record is a restaurant. As NDJSON:
+    {"name": "Lardo", "endorsements": ["Gluten Free"], "tables": {"2": 4, "4": 2}}
+or as CSV, with a header, `;` between endorsements and `capacity=count` tables:
+    name,endorsements,tables
+    Lardo,Gluten Free,2=4;4=2
+
+A record that can't be imported (an unknown restriction, a name that's taken, a bad
+table count) is skipped and reported, and the rest carry on.
+
+Named imports are resumable: how many of the input's records are done is stored in
+`import_checkpoint`, in the same transaction as each chunk. Run the same input again
+under the same name and it carries on after the last committed chunk.
+"""
+
+import csv
+from datetime import datetime
+from itertools import islice
+import json
+import time
+from typing import Callable, Iterable, Iterator
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app import availability
+from app.cache import search_cache
+from app.models import (
+    Restaurant,
+    Restriction,
+    Table,
+    db,
+    import_checkpoint,
+    restaurant_endorsement,
+)
+
+FORMATS = ("ndjson", "csv")
+# Rejected records listed in the result, at most
+MAX_ERRORS = 100
+NAME_LENGTH = 64
+
+
+def _record(line: int, name, endorsements, tables) -> dict:
+    """A parsed record: {"line", "name", "endorsements", "tables"}, or {"line", "error"}"""
+    if not isinstance(name, str) or not name.strip():
+        return {"line": line, "error": "Missing name"}
+    name = name.strip()
+    if len(name) > NAME_LENGTH:
+        return {"line": line, "error": f"Name longer than {NAME_LENGTH} characters"}
+    if not isinstance(endorsements, list) or not all(
+        isinstance(e, str) for e in endorsements
+    ):
+        return {"line": line, "error": "Endorsements should be a list of names"}
+    try:
+        tables = {int(capacity): int(count) for (capacity, count) in tables.items()}
+    except (AttributeError, TypeError, ValueError):
+        return {"line": line, "error": f"Invalid tables {tables}"}
+    if any(capacity < 1 or count < 0 for (capacity, count) in tables.items()):
+        return {"line": line, "error": f"Invalid tables {tables}"}
+    return {
+        "line": line,
+        "name": name,
+        "endorsements": [e.strip().lower() for e in endorsements if e.strip()],
+        "tables": tables,
+    }
+
+
+def _read_ndjson(lines: Iterable[str]) -> Iterator[dict]:
+    for line, text in enumerate(lines, 1):
+        if not text.strip():
+            continue
+        try:
+            item = json.loads(text)
+            if not isinstance(item, dict):
+                raise ValueError("not an object")
+        except ValueError as e:
+            yield {"line": line, "error": f"Invalid JSON: {e}"}
+            continue
+        yield _record(
+            line, item.get("name"), item.get("endorsements", []), item.get("tables", {})
+        )
+
+
+def _read_csv(lines: Iterable[str]) -> Iterator[dict]:
+    reader = csv.DictReader(lines)
+    for row in reader:
+        tables = {}
+        for part in (row.get("tables") or "").split(";"):
+            if part.strip():
+                capacity, _, count = part.partition("=")
+                tables[capacity] = count
+        endorsements = (row.get("endorsements") or "").split(";")
+        yield _record(reader.line_num, row.get("name"), endorsements, tables)
+
+
+def read_records(lines: Iterable[str], fmt: str = "ndjson") -> Iterator[dict]:
+    """Parse `lines` of `fmt` (one of `FORMATS`) into records, lazily"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, expected one of {', '.join(FORMATS)}")
+    return _read_csv(lines) if fmt == "csv" else _read_ndjson(lines)
+
+
+def checkpoint(name: str) -> int:
+    """How many records of the import `name` are committed"""
+    return (
+        db.session.scalar(
+            sa.select(import_checkpoint.c.position).where(
+                import_checkpoint.c.name == name
+            )
+        )
+        or 0
+    )
+
+
+def _save_checkpoint(name: str, position: int):
+    values = {"position": position, "updated": datetime.now()}
+    updated = db.session.execute(
+        import_checkpoint.update()
+        .where(import_checkpoint.c.name == name)
+        .values(values)
+    )
+    if not updated.rowcount:
+        db.session.execute(import_checkpoint.insert().values(name=name, **values))
+
+
+def import_restaurants(
+    lines: Iterable[str],
+    fmt: str = "ndjson",
+    name: str | None = None,
+    chunk_size: int | None = None,
+    progress: Callable[[dict], None] | None = None,
+) -> dict:
+    """Import the restaurants in `lines`, a chunk per transaction
+
+    With a `name`, records before its checkpoint are skipped, and the checkpoint
+    moves with each chunk. `progress` is called with the running totals after each
+    chunk. Returns the totals: rows written per table, records rejected (with the
+    first `MAX_ERRORS` reasons), `position` in the input, and the rate.
+    """
+    chunk_size = chunk_size or current_app.config.get("IMPORT_CHUNK_SIZE", 1000)
+    began = time.perf_counter()
+    restrictions = {
+        restriction.lower(): id_
+        for (restriction, id_) in db.session.execute(
+            sa.select(Restriction.name, Restriction.id)
+        )
+    }
+    position = checkpoint(name) if name else 0
+    result = {
+        "position": position,
+        "restaurants": 0,
+        "tables": 0,
+        "endorsements": 0,
+        "rejected": 0,
+        "errors": [],
+    }
+
+    records = islice(read_records(lines, fmt), position, None)
+    while chunk := list(islice(records, chunk_size)):
+        try:
+            _import_chunk(chunk, restrictions, result)
+            result["position"] += len(chunk)
+            if name:
+                _save_checkpoint(name, result["position"])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        _invalidate()
+        _rate(result, began)
+        if progress is not None:
+            progress(result)
+
+    _rate(result, began)
+    return result
+
+
+def _import_chunk(chunk: list[dict], restrictions: dict[str, int], result: dict):
+    def reject(record, error):
+        result["rejected"] += 1
+        if len(result["errors"]) < MAX_ERRORS:
+            result["errors"].append({"line": record["line"], "error": error})
+
+    names = [r["name"] for r in chunk if "error" not in r]
+    taken = set(
+        db.session.scalars(sa.select(Restaurant.name).where(Restaurant.name.in_(names)))
+    )
+    valid = []
+    for record in chunk:
+        if "error" in record:
+            reject(record, record["error"])
+            continue
+        unknown = [e for e in record["endorsements"] if e not in restrictions]
+        if unknown:
+            reject(record, f"Unknown restrictions {', '.join(unknown)}")
+        elif record["name"] in taken:
+            reject(record, f"Restaurant {record['name']} already exists")
+        else:
+            taken.add(record["name"])
+            record["endorsements"] = sorted(
+                {restrictions[e] for e in record["endorsements"]}
+            )
+            valid.append(record)
+    if not valid:
+        return
+
+    restaurants = Restaurant.__table__
+    ids = db.session.scalars(
+        restaurants.insert().returning(restaurants.c.id, sort_by_parameter_order=True),
+        [
+            {
+                "name": r["name"],
+                "endorse_mask": sum(Restriction.id_bit(e) for e in r["endorsements"]),
+            }
+            for r in valid
+        ],
+    ).all()
+
+    tables = [
+        {"restaurant_id": id_, "capacity": capacity}
+        for (id_, r) in zip(ids, valid)
+        for (capacity, count) in r["tables"].items()
+        for _ in range(count)
+    ]
+    endorsements = [
+        {"restaurant_id": id_, "restriction_id": e}
+        for (id_, r) in zip(ids, valid)
+        for e in r["endorsements"]
+    ]
+    if tables:
+        db.session.execute(sa.insert(Table.__table__), tables)
+    if endorsements:
+        db.session.execute(sa.insert(restaurant_endorsement), endorsements)
+    result["restaurants"] += len(ids)
+    result["tables"] += len(tables)
+    result["endorsements"] += len(endorsements)
+
+
+def _invalidate():
+    """New restaurants & tables bypass the session's flush, so drop this process's
+    searches and availability engines
+
+    Only this process's: run from the CLI, a server's search cache and engines don't
+    see the new restaurants until it restarts. Catalog responses do, as the bulk
+    INSERTs bump their versions (see app/cache.py).
+    """
+    cache = search_cache()
+    if cache is not None:
+        # Any search can have new results
+        cache.invalidate()
+    availability.reset()
+
+
+def _rate(result: dict, began: float):
+    seconds = time.perf_counter() - began
+    rows = result["restaurants"] + result["tables"] + result["endorsements"]
+    result["seconds"] = round(seconds, 3)
+    result["rows_per_second"] = round(rows / seconds) if seconds else 0
@@ -0,0 +1,229 @@
+"""Per-request latency and SQL metrics, in Prometheus text format at `/metrics`
+
+Turned on by `METRICS_ENABLED`. Every request records, by endpoint:
+- how long it took
+- how many SQL statements it ran, and how long they took in total
+
+So a slow search can be split into time in the db and time in Python. Recording is a
+few dict updates per request and per statement, under a lock. Like the caches, these
+are per-process.
+
+Separately, any request slower than `SLOW_REQUEST_SECONDS` is logged as a warning,
+with its arguments, every statement it ran (with timings), and the query plans of the
+`SLOW_REQUEST_PLANS` slowest statements.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+import sqlalchemy as sa
+
+from app.models import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count for each set of labels"""
+
+    def __init__(self, name: str, help: str, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum]
+        self._series = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self, label_names: tuple) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in sorted(self._series.items()):
+            labels = dict(zip(label_names, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket = _labels({**labels, "le": bound})
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {cumulative}")
+        return lines
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for (name, value) in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for (name, value) in escaped) + "}"
+
+
+class Metrics:
+    """Everything `/metrics` reports for one app"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.latency = Histogram(
+            "rec_http_request_duration_seconds",
+            "Time to handle a request",
+            LATENCY_BUCKETS,
+        )
+        self.queries = Histogram(
+            "rec_db_queries_per_request",
+            "SQL statements run by a request",
+            QUERY_BUCKETS,
+        )
+        self.db_time = Histogram(
+            "rec_db_seconds_per_request",
+            "Time a request spent running SQL statements",
+            LATENCY_BUCKETS,
+        )
+
+    def record(self, endpoint, method, status, seconds, queries, db_seconds):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.observe((endpoint, method), seconds)
+            self.queries.observe((endpoint,), queries)
+            self.db_time.observe((endpoint,), db_seconds)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP rec_http_requests_total Requests handled",
+                "# TYPE rec_http_requests_total counter",
+            ]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                labels = _labels(
+                    {"endpoint": endpoint, "method": method, "status": status}
+                )
+                lines.append(f"rec_http_requests_total{labels} {count}")
+            lines += self.latency.render(("endpoint", "method"))
+            lines += self.queries.render(("endpoint",))
+            lines += self.db_time.render(("endpoint",))
+        return "\n".join(lines) + "\n"
+
+
+def metrics() -> Metrics | None:
+    """The metrics for the current app, or None if they're disabled"""
+    return current_app.extensions.get("metrics")
+
+
+def init_app(app):
+    if app.config.get("METRICS_ENABLED"):
+        app.extensions["metrics"] = Metrics()
+    elif app.config.get("SLOW_REQUEST_SECONDS") is None:
+        return
+
+    @app.before_request
+    def start_request():
+        g.metrics = {"start": time.perf_counter(), "queries": 0, "db_seconds": 0.0}
+        if app.config.get("SLOW_REQUEST_SECONDS") is not None:
+            # (statement, parameters, seconds, executemany) for the slow request log
+            g.metrics["statements"] = []
+
+    @app.after_request
+    def finish_request(response):
+        stats = g.pop("metrics", None)
+        if stats is None:
+            return response
+        seconds = time.perf_counter() - stats["start"]
+        endpoint = request.url_rule.endpoint if request.url_rule else "none"
+        if "metrics" in app.extensions:
+            app.extensions["metrics"].record(
+                endpoint,
+                request.method,
+                response.status_code,
+                seconds,
+                stats["queries"],
+                stats["db_seconds"],
+            )
+        slow = app.config.get("SLOW_REQUEST_SECONDS")
+        if slow is not None and seconds >= slow and "statements" in stats:
+            app.logger.warning(_slow_request_report(endpoint, seconds, stats))
+        return response
+
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument_engine(engine)
+    if "reader_engine" in app.extensions:
+        instrument_engine(app.extensions["reader_engine"])
+
+
+def instrument_engine(engine: sa.Engine):
+    """Count and time `engine`'s statements for the request running them"""
+    sa.event.listen(engine, "before_cursor_execute", _start_statement)
+    sa.event.listen(engine, "after_cursor_execute", _finish_statement)
+
+
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+def _finish_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "metrics_start", None)
+    if started is None or not has_request_context():
+        return
+    stats = g.get("metrics")
+    if stats is not None:
+        seconds = time.perf_counter() - started
+        stats["queries"] += 1
+        stats["db_seconds"] += seconds
+        if "statements" in stats:
+            stats["statements"].append((statement, parameters, seconds, executemany))
+
+
+def _slow_request_report(endpoint: str, seconds: float, stats: dict) -> str:
+    statements = stats["statements"]
+    lines = [
+        f"Slow request: {request.method} {request.path} ({endpoint}) took "
+        f"{seconds:.3f}s, {len(statements)} SQL statements in "
+        f"{stats['db_seconds']:.3f}s",
+        f"args: {request.args.to_dict(flat=False)}",
+    ]
+    if request.is_json:
+        lines.append(f"json: {request.get_data(as_text=True)[:1000]}")
+    for i, (statement, parameters, took, _) in enumerate(statements):
+        lines.append(f"[{i}] {took * 1000:.1f}ms: {statement}")
+        lines.append(f"    parameters: {str(parameters)[:200]}")
+
+    slowest = sorted(
+        (i for (i, s) in enumerate(statements) if not s[3]),
+        key=lambda i: statements[i][2],
+        reverse=True,
+    )[: current_app.config.get("SLOW_REQUEST_PLANS", 3)]
+    for i in slowest:
+        statement, parameters, _, _ = statements[i]
+        lines.append(f"Plan for [{i}]:")
+        try:
+            lines += ["    " + line for line in query_plan(statement, parameters)]
+        except sa.exc.DBAPIError as e:
+            lines.append(f"    (couldn't explain: {e.orig})")
+    return "\n".join(lines)
+
+
+def query_plan(statement: str, parameters) -> list[str]:
+    """The db's plan for a statement, as it was sent to the driver"""
+    with db.engine.connect() as conn:
+        if conn.dialect.name != "sqlite":
+            rows = conn.exec_driver_sql("EXPLAIN " + statement, parameters)
+            return [" ".join(str(col) for col in row) for row in rows]
+
+        # (id, parent, _, detail) rows, which form a tree
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+        depth, lines = {0: -1}, []
+        for id_, parent, _, detail in rows:
+            depth[id_] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[id_] + detail)
+        return lines
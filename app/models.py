@@ -1,29 +1,121 @@
-from datetime import datetime, timezone, timedelta
-from flask import url_for
+import base64
+from bisect import bisect_right
+from contextlib import ExitStack
+from datetime import date, datetime, timezone, timedelta
+import json
+import random
+import threading
+import time
+from typing import Iterator
+from flask import current_app, url_for
 from flask_sqlalchemy import SQLAlchemy
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 
-db = SQLAlchemy()
+from app.routing import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+class PaginationError(Exception):
+    """A bad `cursor` or `total`, answered with a 400 (see app/api/error.py)"""
 
 
 class PaginatedAPIMixin(object):
     """Used to easily represent paginated queries.
 
     Plagiarized from: https://github.com/miguelgrinberg/microblog/blob/main/app/models.py#L63
+
+    Besides page numbers, this supports keyset pagination: pass a `cursor` ("" for
+    the first page) and pages are found by `cursor_keys` instead of OFFSET, so deep
+    pages cost the same as the first.
+
+    `total` picks how `total_items` is found: "exact" runs a COUNT, "estimate" counts
+    up to `ESTIMATE_LIMIT` rows, and "none" skips it. Defaults to "exact" for pages
+    and "none" for cursors.
     """
 
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = db.paginate(query, page=page, per_page=per_page, error_out=False)
+    # Columns ordering cursor pages, which must be unique together and indexed
+    cursor_keys = ("id",)
+    ESTIMATE_LIMIT = 10000
+
+    @classmethod
+    def loader_options(cls) -> list:
+        """Eager loads for everything `to_dict` touches, to avoid a query per item"""
+        return []
+
+    @classmethod
+    def get_or_404(cls, id):
+        """`db.get_or_404`, with `loader_options` applied"""
+        return db.first_or_404(
+            sa.select(cls).where(cls.id == id).options(*cls.loader_options())
+        )
+
+    @classmethod
+    def projection(cls, query):
+        """`query` selecting only the columns `row_to_dict` needs, or None"""
+        return None
+
+    @classmethod
+    def to_dicts(cls, query) -> list[dict]:
+        """Serialize every result of an entity `query`
+
+        When the model has a projection (and `SERIALIZE_PROJECTIONS` is on), dicts are
+        built straight from result rows, skipping ORM objects entirely.
+        """
+        return list(cls.iter_dicts(query))
+
+    @classmethod
+    def iter_dicts(cls, query, batch_size: int | None = None) -> Iterator[dict]:
+        """`to_dicts`, lazily
+
+        With `batch_size`, rows are fetched that many at a time (`yield_per`), so only
+        one batch is in memory, however many results there are.
+        """
+        projected = (
+            cls.projection(query)
+            if current_app.config.get("SERIALIZE_PROJECTIONS")
+            else None
+        )
+        if projected is not None:
+            if batch_size:
+                projected = projected.execution_options(yield_per=batch_size)
+            for row in db.session.execute(projected):
+                yield cls.row_to_dict(row)
+            return
+        query = query.options(*cls.loader_options())
+        if batch_size:
+            query = query.execution_options(yield_per=batch_size)
+        for item in db.session.scalars(query):
+            yield item.to_dict()
+
+    @classmethod
+    def to_collection_dict(
+        cls, query, page, per_page, endpoint, cursor=None, total=None, **kwargs
+    ):
+        per_page = max(per_page, 1)
+        if cursor is not None:
+            return cls._cursor_collection_dict(
+                query, cursor, per_page, endpoint, total or "none", **kwargs
+            )
+
+        page = max(page, 1)
+        total = total or "exact"
+        # One extra item tells us if there's a next page, without counting
+        items = cls.to_dicts(query.limit(per_page + 1).offset((page - 1) * per_page))
+        meta = {"page": page, "per_page": per_page}
+        if total == "exact":
+            count = cls._total(query, total)["total_items"]
+            meta["total_pages"] = -(-count // per_page)
+            meta["total_items"] = count
+        else:
+            meta.update(cls._total(query, total))
+        # Only carry `total` over when it isn't the default
+        total = None if total == "exact" else total
+
         data = {
-            "items": [item.to_dict() for item in resources.items],
-            "_meta": {
-                "page": page,
-                "per_page": per_page,
-                "total_pages": resources.pages,
-                "total_items": resources.total,
-            },
+            "items": items[:per_page],
+            "_meta": meta,
             "_links": {
                 "self": url_for(
                     endpoint, page=page, per_page=per_page, _external=True, **kwargs
@@ -33,10 +125,11 @@ class PaginatedAPIMixin(object):
                         endpoint,
                         page=page + 1,
                         per_page=per_page,
+                        total=total,
                         _external=True,
                         **kwargs,
                     )
-                    if resources.has_next
+                    if len(items) > per_page
                     else None
                 ),
                 "prev": (
@@ -44,39 +137,151 @@ class PaginatedAPIMixin(object):
                         endpoint,
                         page=page - 1,
                         per_page=per_page,
+                        total=total,
+                        _external=True,
+                        **kwargs,
+                    )
+                    if page > 1
+                    else None
+                ),
+            },
+        }
+        return data
+
+    @classmethod
+    def _cursor_collection_dict(
+        cls, query, cursor, per_page, endpoint, total, **kwargs
+    ):
+        keys = [getattr(cls, key) for key in cls.cursor_keys]
+        page_q = query.order_by(None).order_by(*keys)
+        if cursor:
+            page_q = page_q.where(sa.tuple_(*keys) > tuple(cls._decode_cursor(cursor)))
+        items = cls.to_dicts(page_q.limit(per_page + 1))
+
+        next_cursor = None
+        if len(items) > per_page:
+            items = items[:per_page]
+            next_cursor = cls._encode_cursor(items[-1])
+
+        data = {
+            "items": items,
+            "_meta": {"per_page": per_page, **cls._total(query, total)},
+            "_links": {
+                "self": url_for(
+                    endpoint,
+                    cursor=cursor,
+                    per_page=per_page,
+                    _external=True,
+                    **kwargs,
+                ),
+                "next": (
+                    url_for(
+                        endpoint,
+                        cursor=next_cursor,
+                        per_page=per_page,
+                        total=total,
                         _external=True,
                         **kwargs,
                     )
-                    if resources.has_prev
+                    if next_cursor
                     else None
                 ),
+                # Cursors only go forward
+                "prev": None,
             },
         }
         return data
 
+    @classmethod
+    def _total(cls, query, total):
+        """`_meta` entries for the requested kind of total"""
+        count_q = query.order_by(None)
+        if total == "exact":
+            count = db.session.scalar(
+                sa.select(sa.func.count()).select_from(count_q.subquery())
+            )
+            return {"total_items": count}
+        if total == "estimate":
+            capped = count_q.limit(cls.ESTIMATE_LIMIT + 1).subquery()
+            count = db.session.scalar(sa.select(sa.func.count()).select_from(capped))
+            if count > cls.ESTIMATE_LIMIT:
+                return {
+                    "total_items": cls.ESTIMATE_LIMIT,
+                    "total_items_is_minimum": True,
+                }
+            return {"total_items": count}
+        if total == "none":
+            return {}
+        raise PaginationError(f"Invalid total {total}")
+
+    @classmethod
+    def _encode_cursor(cls, item: dict) -> str:
+        values = [item[key] for key in cls.cursor_keys]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    @classmethod
+    def _decode_cursor(cls, cursor: str) -> list:
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            assert len(values) == len(cls.cursor_keys)
+            return [
+                (
+                    datetime.fromisoformat(value)
+                    if isinstance(getattr(cls, key).type, sa.DateTime)
+                    else value
+                )
+                for (key, value) in zip(cls.cursor_keys, values)
+            ]
+        except Exception:
+            raise PaginationError(f"Invalid cursor {cursor}")
+
 
 user_restriction = sa.Table(
     "user_restriction",
     db.Model.metadata,
-    sa.Column("user_id", sa.ForeignKey("user.id")),
-    sa.Column("restriction_id", sa.ForeignKey("restriction.id")),
+    sa.Column("user_id", sa.ForeignKey("user.id"), primary_key=True),
+    sa.Column("restriction_id", sa.ForeignKey("restriction.id"), primary_key=True),
 )
 
 restaurant_endorsement = sa.Table(
     "restaurant_endorsement",
     db.Model.metadata,
-    sa.Column("restaurant_id", sa.ForeignKey("restaurant.id")),
-    sa.Column("restriction_id", sa.ForeignKey("restriction.id")),
+    sa.Column("restaurant_id", sa.ForeignKey("restaurant.id"), primary_key=True),
+    sa.Column("restriction_id", sa.ForeignKey("restriction.id"), primary_key=True),
 )
 
+# Keyed by user first, for `User.has_reservation` and a user's reservations. The
+# index is for the other way, eg loading `Reservation.users`
 user_reservation = sa.Table(
     "user_reservation",
     db.Model.metadata,
-    sa.Column("user_id", sa.ForeignKey("user.id")),
-    sa.Column("reservation_id", sa.ForeignKey("reservation.id")),
+    sa.Column("user_id", sa.ForeignKey("user.id"), primary_key=True),
+    sa.Column("reservation_id", sa.ForeignKey("reservation.id"), primary_key=True),
+    sa.Index("ix_user_reservation_reservation_id", "reservation_id"),
 )
 
 
+# Joins names aggregated with `group_concat`. Unlikely to show up in a name
+NAME_SEP = "\x1f"
+
+
+def _restriction_names(association, on):
+    """Names of the restrictions linked by `association`, as one string
+
+    A correlated aggregate, so it only runs for rows that make it onto the page.
+    """
+    return (
+        sa.select(sa.func.group_concat(Restriction.name, NAME_SEP))
+        .join(association, association.c.restriction_id == Restriction.id)
+        .where(on)
+        .scalar_subquery()
+    )
+
+
+def _split_names(names: str | None) -> list[str]:
+    return [n.title() for n in names.split(NAME_SEP)] if names else []
+
+
 class Restriction(db.Model):
     """Dietary restrictions
 
@@ -94,6 +299,27 @@ class Restriction(db.Model):
         secondary=user_restriction, back_populates="restrictions"
     )
 
+    # Masks are stored as a signed 64-bit int, so only this many restrictions fit
+    MAX_RESTRICTIONS = 63
+
+    @property
+    def bit(self) -> int:
+        """This restriction's bit in `Restaurant.endorse_mask`/`User.restriction_mask`"""
+        return self.id_bit(self.id)
+
+    @classmethod
+    def id_bit(cls, id_: int) -> int:
+        if id_ > cls.MAX_RESTRICTIONS:
+            raise ValueError(f"Restriction id {id_} doesn't fit in a mask")
+        return 1 << (id_ - 1)
+
+    @staticmethod
+    def mask(restrictions: list["Restriction"]) -> int:
+        out = 0
+        for r in restrictions:
+            out |= r.bit
+        return out
+
     def __repr__(self):
         return f"<Restriction {self.id}:{self.name}>"
 
@@ -113,20 +339,62 @@ class User(PaginatedAPIMixin, db.Model):
         secondary=user_reservation,
         back_populates="users",
     )
+    # Bitset of `restrictions`, maintained on flush (see `_update_masks`)
+    restriction_mask: so.Mapped[int] = so.mapped_column(
+        sa.Integer, nullable=False, default=0, server_default="0"
+    )
+
+    @classmethod
+    def loader_options(cls):
+        return [so.selectinload(User.restrictions)]
 
     @classmethod
     def has_reservation(cls, userids: list[int], start: datetime, end: datetime):
         """Any user already has reservation for given time"""
-        c = (
-            db.session.query(Reservation)
-            .filter(
-                Reservation.start <= end,
-                Reservation.end >= start,
-                Reservation.users.any(User.id.in_(userids)),
+        # Only reads the index, and stops at the first hit
+        query = (
+            sa.select(user_busy.c.user_id)
+            .where(
+                user_busy.c.user_id.in_(userids),
+                user_busy.c.end >= start,
+                user_busy.c.start <= end,
             )
-            .count()
+            .limit(1)
         )
-        return c > 0
+        return db.session.scalars(query).first() is not None
+
+    @classmethod
+    def has_reservation_batch(cls, queries: list[tuple[list[int], datetime, datetime]]):
+        """`has_reservation` for many (user ids, start, end) blocks, in one query"""
+        if not queries:
+            return []
+
+        user_ids = {int(u) for (ids, _, _) in queries for u in ids}
+        first = min(start for (_, start, _) in queries)
+        last = max(end for (_, _, end) in queries)
+        rows = db.session.execute(
+            sa.select(user_busy.c.user_id, user_busy.c.start, user_busy.c.end).where(
+                user_busy.c.user_id.in_(user_ids),
+                user_busy.c.end >= first,
+                user_busy.c.start <= last,
+            )
+        )
+        busy = {}
+        for user_id, s, e in rows:
+            busy.setdefault(user_id, []).append((s, e))
+
+        out = []
+        for ids, start, end in queries:
+            # SQLite datetimes are naive, so compare the same way the query does
+            start, end = start.replace(tzinfo=None), end.replace(tzinfo=None)
+            out.append(
+                any(
+                    s <= end and e >= start
+                    for u in ids
+                    for (s, e) in busy.get(int(u), [])
+                )
+            )
+        return out
 
     def __repr__(self):
         return "<User {}>".format(self.name)
@@ -143,6 +411,36 @@ class User(PaginatedAPIMixin, db.Model):
             },
         }
 
+    @classmethod
+    def projection(cls, query):
+        names = _restriction_names(
+            user_restriction, user_restriction.c.user_id == cls.id
+        )
+        return query.with_only_columns(cls.id, cls.name, names.label("restrictions"))
+
+    @staticmethod
+    def row_to_dict(row):
+        return {
+            "id": row.id,
+            "name": row.name,
+            "restrictions": _split_names(row.restrictions),
+            "_links": {
+                "reservations": url_for(
+                    "api.user_reservations", id=row.id, _external=True
+                )
+            },
+        }
+
+
+# Bookings in this process for restaurants in the same stripe are serialized, so
+# they don't all race for the same tables (and the database's write lock). These are
+# re-entrant, so requests interleaved on one thread by the async entry point (see
+# asgi.py) can't deadlock on them; the overlap check alone keeps those apart.
+BOOKING_STRIPES = 64
+_booking_locks = [threading.RLock() for _ in range(BOOKING_STRIPES)]
+# `_claim_table` lost a race for its table, as opposed to finding none free
+BOOKING_CONFLICT = object()
+
 
 class Restaurant(PaginatedAPIMixin, db.Model):
     __tablename__ = "restaurant"
@@ -156,86 +454,461 @@ class Restaurant(PaginatedAPIMixin, db.Model):
         secondary=restaurant_endorsement
     )
     tables: so.Mapped[list["Table"]] = so.relationship(back_populates="restaurant")
+    # Bitset of `endorsements`, maintained on flush (see `_update_masks`)
+    endorse_mask: so.Mapped[int] = so.mapped_column(
+        sa.Integer, nullable=False, default=0, server_default="0"
+    )
+
+    @classmethod
+    def loader_options(cls):
+        return [so.selectinload(Restaurant.endorsements)]
 
     @classmethod
     def search_has_table(cls, user_ids: list[int], start: datetime, end: datetime):
         """Restaurants that are available within a given time block"""
 
+        from app.cache import search_cache, search_key
+
         size = len(user_ids)
 
-        # Available table ids subquery
-        table_q = db.session.query(Table.id).filter(
-            Table.capacity >= size,
-            ~Table.reservations.any(
-                sa.and_(
-                    Reservation.start <= end,
-                    Reservation.end >= start,
-                )
-            ),
+        # Restrictions are bitsets, so "restaurant endorses every restriction of every
+        # user" is `(endorse_mask & required) == required`
+        required = 0
+        for mask in db.session.scalars(
+            sa.select(User.restriction_mask).where(User.id.in_(user_ids))
+        ):
+            required |= mask
+
+        cache = search_cache()
+        if cache is None:
+            return cls._search_query(size, required, start, end)
+
+        key = search_key(required, size, start, end)
+        restaurant_ids = cache.get(key)
+        if restaurant_ids is None:
+            generation = cache.generation
+            query = cls._search_query(size, required, start, end)
+            restaurant_ids = db.session.scalars(
+                query.with_only_columns(Restaurant.id)
+            ).all()
+            cache.put(key, restaurant_ids, generation)
+        return sa.select(Restaurant).where(Restaurant.id.in_(restaurant_ids))
+
+    @classmethod
+    def _search_query(cls, size: int, required: int, start: datetime, end: datetime):
+        from app.availability import get_engine
+
+        engine = get_engine()
+        restaurant_ids = (
+            None if engine is None else engine.available_restaurants(size, start, end)
         )
+        if restaurant_ids is None:
+            # Correlated, so each restaurant only looks at its own tables (by
+            # ix_table_restaurant_id_capacity) and their reservations (by
+            # ix_reservation_table_id_start_end, or table_slot's key)
+            has_table = Restaurant.tables.any(
+                sa.and_(Table.capacity >= size, Table.free_between(start, end))
+            )
+        else:
+            has_table = Restaurant.id.in_(restaurant_ids)
 
-        # All restriction ids subquery
-        restriction_q = db.session.query(Restriction.id).filter(
-            Restriction.users.any(User.id.in_(user_ids))
+        return sa.select(Restaurant).where(
+            has_table,
+            Restaurant.endorse_mask.op("&")(required) == required,
         )
-        restriction_ids = set([r.id for r in restriction_q.all()])
-
-        # NOTE: due to time constraints, this query is not fully fleshed out
-        # Keeping this here for personal reference
-        #     restaurant_q = (
-        #         sa.select(Restaurant)
-        #         .options(so.joinedload(Restaurant.endorsements, innerjoin=True))
-        #         .where(
-        #             # .options(so.joinedload(Restaurant.endorsements)).where(
-        #             sa.and_(
-        #                 Restaurant.tables.any(Table.id.in_(table_q)),
-        #                 Restriction.id.in_(restriction_q),
-        #             )
-        #         )
-        #     )
-        restaurant_q = sa.select(Restaurant).where(
-            Restaurant.tables.any(Table.id.in_(table_q)),
+
+    @classmethod
+    def search_has_table_batch(
+        cls, queries: list[tuple[list[int], datetime, datetime]]
+    ) -> list[list[int]]:
+        """`search_has_table` for many (user ids, start, end) blocks
+
+        Restriction masks and tables are each loaded once and shared between the
+        queries, and so are reservations, per run of overlapping blocks (so blocks
+        far apart don't load everything in between). Returns the matching
+        restaurant ids for each query.
+        """
+        from app import slots
+        from app.availability import IntervalIndex, get_engine
+
+        if not queries:
+            return []
+
+        user_ids = {int(u) for (ids, _, _) in queries for u in ids}
+        masks = dict(
+            db.session.execute(
+                sa.select(User.id, User.restriction_mask).where(User.id.in_(user_ids))
+            ).all()
         )
-        out = db.session.scalars(restaurant_q).all()
+        tables = db.session.execute(
+            sa.select(Table.id, Table.capacity, Table.restaurant_id).where(
+                Table.capacity >= min(len(set(ids)) for (ids, _, _) in queries)
+            )
+        ).all()
+        endorse = dict(db.session.execute(sa.select(cls.id, cls.endorse_mask)).all())
 
-        def filter_(r):
-            return restriction_ids.issubset({e.id for e in r.endorsements})
+        # Runs of overlapping blocks, by start
+        runs = []
+        for start, end in sorted(
+            (start.replace(tzinfo=None), end.replace(tzinfo=None))
+            for (_, start, end) in queries
+        ):
+            if runs and start <= runs[-1][1]:
+                runs[-1][1] = max(runs[-1][1], end)
+            else:
+                runs.append([start, end])
+        run_starts = [start for (start, _) in runs]
+        indexes = {}
+        if slots.enabled():
+            # Held slots, as `search_has_table` and booking check them
+            build, held = slots.held_index, slots.held
+        else:
+            build, held = IntervalIndex.build, lambda start, end: (start, end)
 
-        restaurant_ids = [r.id for r in out if filter_(r)]
+        engine = get_engine()
+        out = []
+        for ids, start, end in queries:
+            # A user listed twice is still one seat
+            size = len({int(u) for u in ids})
+            required = 0
+            for u in ids:
+                required |= masks.get(int(u), 0)
 
-        return sa.select(Restaurant).where(Restaurant.id.in_(restaurant_ids))
+            available = (
+                None
+                if engine is None
+                else engine.available_restaurants(size, start, end)
+            )
+            if available is None:
+                run = bisect_right(run_starts, start.replace(tzinfo=None)) - 1
+                if run not in indexes:
+                    indexes[run] = build(*runs[run])
+                index = indexes[run]
+                available = {
+                    rid
+                    for (tid, capacity, rid) in tables
+                    if capacity >= size and index.is_free(tid, *held(start, end))
+                }
+
+            out.append(
+                sorted(
+                    rid
+                    for rid in available
+                    if endorse.get(rid, 0) & required == required
+                )
+            )
+        return out
 
     def __repr__(self):
         return "<Restaurant {}>".format(self.name)
 
+    def day_availability(
+        self, day: date, size: int, interval: timedelta, length: timedelta
+    ) -> list[tuple[datetime, bool]]:
+        """For every `interval` start in a day, is a table of `size` free for `length`
+
+        One query for the restaurant's tables and that day's reservations, then a
+        sweep line: a reservation blocks the starts in [start - length, end], so a
+        slot is available while fewer blocks cover it than there are tables.
+
+        With `TABLE_SLOTS`, held slots are read instead, as search and booking check
+        them: a slot blocks the starts whose slots reach it.
+        """
+        from app import slots
+
+        day_start = datetime.combine(day, datetime.min.time())
+        times = [day_start + i * interval for i in range(timedelta(days=1) // interval)]
+
+        tables_q = sa.select(Table.id).where(
+            Table.restaurant_id == self.id, Table.capacity >= size
+        )
+        if slots.enabled():
+            # Held from `slot` until the next one starts
+            until = slots.slot_size() - timedelta(microseconds=1)
+            slot = table_slot.c.slot_start
+            rows = db.session.execute(
+                tables_q.add_columns(slot, slot)
+                .outerjoin(
+                    table_slot,
+                    sa.and_(
+                        table_slot.c.table_id == Table.id,
+                        slot.between(
+                            slots.floor(day_start), slots.floor(times[-1] + length)
+                        ),
+                    ),
+                )
+                .order_by(Table.id, slot)
+            ).all()
+            rows = [(t, s, e and e + until) for (t, s, e) in rows]
+        else:
+            rows = db.session.execute(
+                tables_q.add_columns(Reservation.start, Reservation.end)
+                .outerjoin(
+                    Reservation,
+                    sa.and_(
+                        Reservation.table_id == Table.id,
+                        Reservation.start <= times[-1] + length,
+                        Reservation.end >= day_start,
+                    ),
+                )
+                .order_by(Table.id, Reservation.start)
+            ).all()
+
+        # Merge each table's blocks, so a covered slot counts a table at most once
+        tables = set()
+        blocks = []
+        for table_id, start, end in rows:
+            tables.add(table_id)
+            if start is None:
+                continue
+            a, b = start - length, end
+            if blocks and blocks[-1][0] == table_id and a <= blocks[-1][2]:
+                blocks[-1][2] = max(blocks[-1][2], b)
+            else:
+                blocks.append([table_id, a, b])
+
+        starts = sorted(a for (_, a, _) in blocks)
+        ends = sorted(b for (_, _, b) in blocks)
+        out = []
+        started = ended = 0
+        for at in times:
+            while started < len(starts) and starts[started] <= at:
+                started += 1
+            while ended < len(ends) and ends[ended] < at:
+                ended += 1
+            # Blocks covering this time = started by now, minus those ended before it
+            out.append((at, started - ended < len(tables)))
+        return out
+
     def book_table(self, user_ids: list[int], start: datetime, end: datetime):
+        """Claim the smallest free table that fits, for `user_ids`
+
+        The table is claimed optimistically: the reservation is inserted, then checked
+        against every other reservation on that table while we still hold the write
+        lock. If another booking got there first, ours is rolled back and we try the
+        next table, up to `BOOKING_RETRIES` times. Bookings in this process for the
+        same restaurant (stripe) take turns, so they rarely get that far.
+
+        Returns None if no table is free.
+        """
+        retries = current_app.config.get("BOOKING_RETRIES", 5)
+        with _booking_locks[self.id % BOOKING_STRIPES]:
+            for attempt in range(retries + 1):
+                try:
+                    res = self._claim_table(user_ids, start, end)
+                except sa.exc.OperationalError:
+                    # Another connection holds the write lock ("database is locked")
+                    db.session.rollback()
+                    if attempt == retries:
+                        raise
+                else:
+                    if res is not BOOKING_CONFLICT:
+                        return res
+                time.sleep(random.uniform(0, 0.005 * 2**attempt))
+        return None
+
+    @classmethod
+    def book_table_batch(
+        cls, bookings: list[tuple[int, list[int], datetime, datetime]]
+    ) -> list[int | str]:
+        """`book_table` for many (restaurant id, user ids, start, end), in one commit
+
+        Masks, tables, and the reservations in the window covering every booking are
+        each loaded once, then tables are allocated in memory, in order, so later
+        bookings see earlier ones. Like `book_table`, the new reservations are checked
+        for overlaps before committing, and the batch is retried if another booking
+        got there first.
+
+        Returns the new reservation's id, or why it couldn't be booked, for each.
+        """
+        if not bookings:
+            return []
+
+        retries = current_app.config.get("BOOKING_RETRIES", 5)
+        stripes = sorted({rid % BOOKING_STRIPES for (rid, _, _, _) in bookings})
+        with ExitStack() as stack:
+            # Always in the same order, so two batches can't deadlock
+            for stripe in stripes:
+                stack.enter_context(_booking_locks[stripe])
+            for attempt in range(retries + 1):
+                try:
+                    results = cls._claim_tables(bookings)
+                except sa.exc.OperationalError:
+                    db.session.rollback()
+                    if attempt == retries:
+                        raise
+                else:
+                    if results is not BOOKING_CONFLICT:
+                        return results
+                time.sleep(random.uniform(0, 0.005 * 2**attempt))
+        return ["Too many bookings at once, try again"] * len(bookings)
+
+    @classmethod
+    def _claim_tables(cls, bookings: list[tuple[int, list[int], datetime, datetime]]):
+        from app import slots
+        from app.availability import IntervalIndex
+
+        first = min(start for (_, _, start, _) in bookings)
+        last = max(end for (_, _, _, end) in bookings)
+        restaurant_ids = {rid for (rid, _, _, _) in bookings}
+        user_ids = {int(u) for (_, ids, _, _) in bookings for u in ids}
+
+        users = {
+            u.id: u
+            for u in db.session.scalars(sa.select(User).where(User.id.in_(user_ids)))
+        }
+        endorse = dict(
+            db.session.execute(
+                sa.select(cls.id, cls.endorse_mask).where(cls.id.in_(restaurant_ids))
+            ).all()
+        )
+        tables = {}
+        for table_id, capacity, rid in db.session.execute(
+            sa.select(Table.id, Table.capacity, Table.restaurant_id)
+            .where(Table.restaurant_id.in_(restaurant_ids))
+            .order_by(Table.capacity.asc(), Table.id)
+        ):
+            tables.setdefault(rid, []).append((table_id, capacity))
+
+        # Booked intervals per table, and (keyed by user id instead) per user
+        table_ids = [t for ts in tables.values() for (t, _) in ts]
+        if slots.enabled():
+            # Held slots, so allocation agrees with the key
+            index = slots.held_index(first, last, table_ids)
+            held = slots.held
+        else:
+            index = IntervalIndex.build(first, last, table_ids)
+            held = lambda start, end: (start, end)
+        busy = IntervalIndex()
+        for user_id, id_, start, end in db.session.execute(
+            sa.select(
+                user_busy.c.user_id,
+                user_busy.c.reservation_id,
+                user_busy.c.start,
+                user_busy.c.end,
+            ).where(
+                user_busy.c.user_id.in_(user_ids),
+                user_busy.c.end >= first,
+                user_busy.c.start <= last,
+            )
+        ):
+            busy.add(user_id, id_, start, end)
+
+        results = []
+        for i, (rid, ids, start, end) in enumerate(bookings):
+            # A user listed twice is still one seat, and one `user_reservation` row
+            ids = list(dict.fromkeys(int(u) for u in ids))
+            required = 0
+            for u in ids:
+                required |= users[u].restriction_mask
+            if not all(busy.is_free(u, start, end) for u in ids):
+                results.append("User has reservation at this time")
+                continue
+            if endorse.get(rid, 0) & required != required:
+                results.append("Restaurant can't cater to these restrictions")
+                continue
+            table_id = next(
+                (
+                    table_id
+                    for (table_id, capacity) in tables.get(rid, [])
+                    if capacity >= len(ids)
+                    and index.is_free(table_id, *held(start, end))
+                ),
+                None,
+            )
+            if table_id is None:
+                results.append("Restaurant not available at this time")
+                continue
+
+            res = Reservation(start=start, end=end, table_id=table_id)
+            res.users = [users[u] for u in ids]
+            db.session.add(res)
+            # Not flushed yet, so there's no id to index it by
+            index.add(table_id, -i - 1, *held(start, end))
+            for u in ids:
+                busy.add(u, -i - 1, start, end)
+            results.append(res)
+
+        new = [r for r in results if isinstance(r, Reservation)]
+        if not new:
+            return results
+        try:
+            db.session.flush()
+        except sa.exc.IntegrityError as e:
+            db.session.rollback()
+            # Another booking holds one of the slots (with `TABLE_SLOTS`)
+            if slots.is_conflict(e):
+                return BOOKING_CONFLICT
+            raise
+
+        other = so.aliased(Reservation)
+        conflict = (
+            sa.select(Reservation.id)
+            .join(
+                other,
+                sa.and_(
+                    other.table_id == Reservation.table_id,
+                    other.id != Reservation.id,
+                    other.start <= Reservation.end,
+                    other.end >= Reservation.start,
+                ),
+            )
+            .where(Reservation.id.in_([r.id for r in new]))
+            .limit(1)
+        )
+        if db.session.scalars(conflict).first() is not None:
+            db.session.rollback()
+            return BOOKING_CONFLICT
+
+        results = [r.id if isinstance(r, Reservation) else r for r in results]
+        db.session.commit()
+        return results
+
+    def _claim_table(self, user_ids: list[int], start: datetime, end: datetime):
+        from app import slots
+
         size = len(user_ids)
         table_q = (
-            db.session.query(Table.id)
-            .filter(
+            sa.select(Table.id)
+            .where(
                 Table.capacity >= size,
                 Table.restaurant_id == self.id,
-                ~Table.reservations.any(
-                    sa.and_(
-                        Reservation.start <= end,
-                        Reservation.end >= start,
-                    )
-                ),
+                Table.free_between(start, end),
             )
-            .order_by(Table.capacity.asc())
+            .order_by(Table.capacity.asc(), Table.id)
             .limit(1)
         )
-
         table_id = db.session.scalars(table_q).first()
-        res = Reservation(
-            start=start,
-            end=end,
-            table_id=table_id,
+        if table_id is None:
+            return None
+
+        res = Reservation(start=start, end=end, table_id=table_id)
+        res.users = list(
+            db.session.scalars(sa.select(User).where(User.id.in_(user_ids)))
         )
         db.session.add(res)
+        if slots.enabled():
+            # The slots' key does the overlap check
+            try:
+                db.session.flush()
+            except sa.exc.IntegrityError as e:
+                db.session.rollback()
+                if slots.is_conflict(e):
+                    return BOOKING_CONFLICT
+                raise
+            db.session.commit()
+            return res
+        db.session.flush()
 
-        for uid in user_ids:
-            res.users.append(User.query.get(uid))
+        conflict = sa.select(Reservation.id).where(
+            Reservation.table_id == table_id,
+            Reservation.id != res.id,
+            Reservation.start <= end,
+            Reservation.end >= start,
+        )
+        if db.session.scalars(conflict.limit(1)).first() is not None:
+            db.session.rollback()
+            return BOOKING_CONFLICT
         db.session.commit()
         return res
 
@@ -246,9 +919,28 @@ class Restaurant(PaginatedAPIMixin, db.Model):
             "endorsements": [e.name.title() for e in self.endorsements],
         }
 
+    @classmethod
+    def projection(cls, query):
+        names = _restriction_names(
+            restaurant_endorsement, restaurant_endorsement.c.restaurant_id == cls.id
+        )
+        return query.with_only_columns(cls.id, cls.name, names.label("endorsements"))
+
+    @staticmethod
+    def row_to_dict(row):
+        return {
+            "id": row.id,
+            "name": row.name,
+            "endorsements": _split_names(row.endorsements),
+        }
+
 
 class Table(db.Model):
     __tablename__ = "table"
+    __table_args__ = (
+        # A restaurant's tables that fit a party, for search and booking
+        sa.Index("ix_table_restaurant_id_capacity", "restaurant_id", "capacity"),
+    )
 
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     capacity: so.Mapped[int] = so.mapped_column(sa.Integer, nullable=False)
@@ -266,22 +958,36 @@ class Table(db.Model):
     def __repr__(self):
         return f"<Table {self.id}:{self.capacity}>"
 
+    @staticmethod
+    def free_between(start: datetime, end: datetime):
+        """Clause: `Table` has no reservation overlapping `start`-`end`
 
-class Reservation(PaginatedAPIMixin, db.Model):
-    __tablename__ = "reservation"
+        With `TABLE_SLOTS`, none of the slots it touches are held.
+        """
+        from app import slots
 
-    id: so.Mapped[int] = so.mapped_column(primary_key=True)
-    start: so.Mapped[datetime] = so.mapped_column(sa.DateTime, nullable=False)
-    end: so.Mapped[datetime] = so.mapped_column(sa.DateTime, nullable=False)
-    table_id: so.Mapped[int] = so.mapped_column(
-        sa.ForeignKey("table.id"), nullable=False
-    )
+        if slots.enabled():
+            return ~sa.exists().where(
+                table_slot.c.table_id == Table.id,
+                table_slot.c.slot_start.in_(slots.slots_between(start, end)),
+            )
+        return ~Table.reservations.any(
+            sa.and_(Reservation.start <= end, Reservation.end >= start)
+        )
 
-    table: so.Mapped["Table"] = so.relationship(back_populates="reservations")
-    users: so.Mapped[list["User"]] = so.relationship(
-        secondary=user_reservation,
-        back_populates="reservations",
-    )
+
+class ReservationMixin(PaginatedAPIMixin):
+    """Serialization shared by current and archived reservations
+
+    Expects `id`, `start`, `end`, `users`, and `user_association`: the table linking
+    users to these reservations.
+    """
+
+    cursor_keys = ("start", "id")
+
+    @classmethod
+    def loader_options(cls):
+        return [so.selectinload(cls.users).load_only(User.id)]
 
     def to_dict(self):
         return {
@@ -295,3 +1001,255 @@ class Reservation(PaginatedAPIMixin, db.Model):
                 ]
             },
         }
+
+    @classmethod
+    def projection(cls, query):
+        user_ids = (
+            sa.select(sa.func.group_concat(cls.user_association.c.user_id))
+            .where(cls.user_association.c.reservation_id == cls.id)
+            .scalar_subquery()
+        )
+        return query.with_only_columns(
+            cls.id, cls.start, cls.end, user_ids.label("user_ids")
+        )
+
+    @staticmethod
+    def row_to_dict(row):
+        user_ids = [int(u) for u in row.user_ids.split(",")] if row.user_ids else []
+        return {
+            "id": row.id,
+            "start": row.start.replace(tzinfo=timezone.utc).isoformat(),
+            "end": row.end.replace(tzinfo=timezone.utc).isoformat(),
+            "size": len(user_ids),
+            "_links": {
+                "users": [url_for("api.user", id=u, _external=True) for u in user_ids]
+            },
+        }
+
+    @classmethod
+    def for_user(cls, user_id: int):
+        """Query for one user's reservations, by its rows in `user_association`"""
+        return sa.select(cls).where(
+            cls.id.in_(
+                sa.select(cls.user_association.c.reservation_id).where(
+                    cls.user_association.c.user_id == user_id
+                )
+            )
+        )
+
+
+def pre_flush_values(obj, keys: tuple[str, ...]) -> list:
+    """`obj`'s values of `keys` before the flush in progress, for flush listeners
+
+    Reservation columns are declared with `active_history`, so a changed value's old
+    one is loaded even if it never was; an unchanged one is the current value.
+    """
+    state = sa.inspect(obj)
+    values = []
+    for key in keys:
+        history = state.attrs[key].history
+        values.append(history.deleted[0] if history.deleted else getattr(obj, key))
+    return values
+
+
+class Reservation(ReservationMixin, db.Model):
+    __tablename__ = "reservation"
+    __table_args__ = (
+        # The overlap check: a table's reservations starting before a block ends
+        sa.Index("ix_reservation_table_id_start_end", "table_id", "start", "end"),
+        # Cursor pages, and reservations in a time window
+        sa.Index("ix_reservation_start", "start"),
+        # Never reuse ids, which archived reservations keep
+        {"sqlite_autoincrement": True},
+    )
+    user_association = user_reservation
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    # `active_history`: listeners that keep copies of reservations (availability
+    # engines, the search cache) need the old values, even if they were never loaded
+    start: so.Mapped[datetime] = so.mapped_column(
+        sa.DateTime, nullable=False, active_history=True
+    )
+    end: so.Mapped[datetime] = so.mapped_column(
+        sa.DateTime, nullable=False, active_history=True
+    )
+    table_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey("table.id"), nullable=False, active_history=True
+    )
+
+    table: so.Mapped["Table"] = so.relationship(back_populates="reservations")
+    users: so.Mapped[list["User"]] = so.relationship(
+        secondary=user_reservation,
+        back_populates="reservations",
+    )
+
+
+# Reservations that ended before the archive cutoff (see app/archive.py), with the
+# same ids. Nothing checks them for overlaps, so `reservation` only holds rows that
+# can still conflict with a booking
+reservation_archive = sa.Table(
+    "reservation_archive",
+    db.Model.metadata,
+    sa.Column("id", sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column("start", sa.DateTime, nullable=False),
+    sa.Column("end", sa.DateTime, nullable=False),
+    sa.Column("table_id", sa.ForeignKey("table.id"), nullable=False),
+    sa.Index("ix_reservation_archive_start", "start"),
+)
+
+user_reservation_archive = sa.Table(
+    "user_reservation_archive",
+    db.Model.metadata,
+    sa.Column("user_id", sa.ForeignKey("user.id"), primary_key=True),
+    sa.Column(
+        "reservation_id", sa.ForeignKey("reservation_archive.id"), primary_key=True
+    ),
+    sa.Index("ix_user_reservation_archive_reservation_id", "reservation_id"),
+)
+
+# Every `TABLE_SLOT_MINUTES` slot each reservation's table is held for, when
+# `TABLE_SLOTS` is on (see app/slots.py). The key makes double-booking a slot fail
+table_slot = sa.Table(
+    "table_slot",
+    db.Model.metadata,
+    sa.Column("table_id", sa.ForeignKey("table.id"), primary_key=True),
+    sa.Column("slot_start", sa.DateTime, primary_key=True),
+    sa.Column("reservation_id", sa.ForeignKey("reservation.id"), nullable=False),
+    sa.Index("ix_table_slot_reservation_id", "reservation_id"),
+)
+
+# Each user's reservations, with their times copied in (see app/busy.py), so
+# `User.has_reservation` is a range probe on one index, without joining `reservation`
+user_busy = sa.Table(
+    "user_busy",
+    db.Model.metadata,
+    sa.Column("reservation_id", sa.ForeignKey("reservation.id"), primary_key=True),
+    sa.Column("user_id", sa.ForeignKey("user.id"), primary_key=True),
+    sa.Column("start", sa.DateTime, nullable=False),
+    sa.Column("end", sa.DateTime, nullable=False),
+    # Covering: a user's reservations ending after a block starts, then their starts
+    sa.Index("ix_user_busy_user_id_end_start", "user_id", "end", "start"),
+)
+
+# Catalog response versions (see app/cache.py), bumped in the same transaction as the
+# rows they cover, so every process sees every write. `key` is "*" for everything of
+# a `kind`, "" for its collection, or an id
+catalog_version = sa.Table(
+    "catalog_version",
+    db.Model.metadata,
+    sa.Column("kind", sa.String(16), primary_key=True),
+    sa.Column("key", sa.String(16), primary_key=True),
+    sa.Column("version", sa.Integer, nullable=False),
+)
+
+# How far each named bulk import got, committed with each of its chunks (see
+# app/imports.py)
+import_checkpoint = sa.Table(
+    "import_checkpoint",
+    db.Model.metadata,
+    sa.Column("name", sa.String(64), primary_key=True),
+    # Input records done
+    sa.Column("position", sa.Integer, nullable=False),
+    sa.Column("updated", sa.DateTime, nullable=False),
+)
+
+_reservation_columns = ("id", "start", "end", "table_id")
+reservation_history = sa.union_all(
+    sa.select(*(Reservation.__table__.c[c] for c in _reservation_columns)),
+    sa.select(*(reservation_archive.c[c] for c in _reservation_columns)),
+).subquery("reservation_history")
+user_reservation_history = sa.union_all(
+    sa.select(user_reservation.c.user_id, user_reservation.c.reservation_id),
+    sa.select(
+        user_reservation_archive.c.user_id, user_reservation_archive.c.reservation_id
+    ),
+).subquery("user_reservation_history")
+
+
+class ReservationHistory(ReservationMixin, db.Model):
+    """Current and archived reservations, read-only"""
+
+    __table__ = reservation_history
+    __mapper_args__ = {"primary_key": [reservation_history.c.id]}
+    user_association = user_reservation_history
+
+    users: so.Mapped[list["User"]] = so.relationship(
+        secondary=user_reservation_history,
+        primaryjoin=reservation_history.c.id
+        == user_reservation_history.c.reservation_id,
+        secondaryjoin=lambda: User.id == user_reservation_history.c.user_id,
+        viewonly=True,
+    )
+
+
+@sa.event.listens_for(so.Session, "before_flush")
+def _number_restrictions(session, flush_context, instances):
+    """Give new restrictions their ids up front, so one that wouldn't fit in a mask
+    is refused before anything is written (rather than by `_update_masks`)
+    """
+    new = sorted(
+        (o for o in session.new if isinstance(o, Restriction) and o.id is None),
+        key=lambda o: sa.inspect(o).insert_order,
+    )
+    if not new:
+        return
+    last = session.connection().scalar(sa.select(sa.func.max(Restriction.id))) or 0
+    if last + len(new) > Restriction.MAX_RESTRICTIONS:
+        raise ValueError(
+            f"Can't add {len(new)} restriction(s): at most "
+            f"{Restriction.MAX_RESTRICTIONS} fit in a mask"
+        )
+    for id_, obj in enumerate(new, last + 1):
+        obj.id = id_
+
+
+@sa.event.listens_for(so.Session, "after_flush")
+def _update_masks(session, flush_context):
+    """Keep the restriction bitsets in sync with their association tables
+
+    Runs after the flush so new restrictions already have ids. Masks are recomputed
+    from the association tables, so changes from either side of a relationship (eg,
+    `restriction.users.append(user)`) are picked up.
+    """
+    changed = {Restaurant: set(), User: set()}
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Restaurant):
+            if sa.inspect(obj).attrs.endorsements.history.has_changes():
+                changed[Restaurant].add(obj.id)
+        elif isinstance(obj, User):
+            if sa.inspect(obj).attrs.restrictions.history.has_changes():
+                changed[User].add(obj.id)
+        elif isinstance(obj, Restriction):
+            history = sa.inspect(obj).attrs.users.history
+            changed[User].update(
+                u.id for u in list(history.added) + list(history.deleted)
+            )
+
+    connection = session.connection()
+    for model, association, key, column in [
+        (Restaurant, restaurant_endorsement, "restaurant_id", "endorse_mask"),
+        (User, user_restriction, "user_id", "restriction_mask"),
+    ]:
+        if not changed[model]:
+            continue
+
+        masks = dict.fromkeys(changed[model], 0)
+        rows = connection.execute(
+            sa.select(association.c[key], association.c.restriction_id).where(
+                association.c[key].in_(masks)
+            )
+        )
+        for owner, restriction_id in rows:
+            masks[owner] |= Restriction.id_bit(restriction_id)
+
+        table = model.__table__
+        connection.execute(
+            table.update()
+            .where(table.c.id == sa.bindparam("owner"))
+            .values({column: sa.bindparam("mask")}),
+            [{"owner": owner, "mask": mask} for (owner, mask) in masks.items()],
+        )
+        for owner, mask in masks.items():
+            obj = session.identity_map.get(session.identity_key(model, owner))
+            if obj is not None:
+                so.attributes.set_committed_value(obj, column, mask)
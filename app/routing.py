@@ -0,0 +1,83 @@
+"""Read/write routing: GET requests query a separate pool of read-only connections
+
+Searches and listings are most of the traffic, and with one engine they queue on the
+same pool (and SQLite locks) as bookings. With `READ_ROUTING`, a GET/HEAD request's
+`db.session` runs its SELECTs on the reader engine:
+- `SQLALCHEMY_READER_URI` (eg a replica), or
+- for a SQLite file db, read-only (`mode=ro`) connections to the same file. In WAL
+  mode (see app/sqlite.py) they read the last commit without waiting on a writer
+
+Anything else goes to the writer: other methods, INSERT/UPDATE/DELETE, and every
+query after the session first flushes, so a request always sees its own writes. A
+session already in a transaction when the request starts (eg in tests, sharing the
+app context) stays on the writer too. In-memory dbs can't be shared, so have no
+reader.
+"""
+
+from flask import current_app, request
+from flask_sqlalchemy.session import Session
+import sqlalchemy as sa
+
+from app import sqlite
+
+READ_METHODS = ("GET", "HEAD")
+
+
+class RoutingSession(Session):
+    """`db.session`, sending reads to the reader engine when it's marked read-only"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get("read_only"):
+            reader = current_app.extensions.get("reader_engine")
+            if clause is not None and clause.is_select and not self._flushing:
+                if reader is not None:
+                    return reader
+            else:
+                # A write, so from here on this session reads from the writer
+                self.info["read_only"] = False
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@sa.event.listens_for(RoutingSession, "before_flush")
+def _stop_routing(session, flush_context, instances):
+    session.info["read_only"] = False
+
+
+def reader_url(config) -> sa.URL | None:
+    """Where reads go, or None to keep them on the writer"""
+    if config.get("SQLALCHEMY_READER_URI"):
+        return sa.make_url(config["SQLALCHEMY_READER_URI"])
+    url = sa.make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    if url.query.get("uri") == "true":
+        # Already a URI filename, eg "file:app.db?cache=shared"
+        return url.update_query_dict({"mode": "ro"})
+    return url.set(database=f"file:{url.database}").update_query_dict(
+        {"mode": "ro", "uri": "true"}
+    )
+
+
+def init_app(app, db):
+    if not app.config.get("READ_ROUTING"):
+        return
+    url = reader_url(app.config)
+    if url is None:
+        return
+
+    options = sqlite.engine_options(
+        {**app.config, "SQLALCHEMY_DATABASE_URI": url.render_as_string(False)}
+    )
+    engine = sa.create_engine(url, **options)
+    sqlite.apply_profile(engine, app.config, read_only=True)
+    app.extensions["reader_engine"] = engine
+
+    @app.before_request
+    def route_reads():
+        db.session.info["read_only"] = (
+            request.method in READ_METHODS and not db.session().in_transaction()
+        )
+
+    @app.teardown_request
+    def stop_routing(exc):
+        db.session.info.pop("read_only", None)
@@ -0,0 +1,207 @@
+"""`table_slot`: each reservation's table, per `TABLE_SLOT_MINUTES` slot it touches
+
+With `TABLE_SLOTS` on, every reservation inserted/updated/deleted through the session
+writes its slots in the same flush. The primary key is (table_id, slot_start), so
+two bookings can't hold the same table in the same slot: a conflicting booking fails
+on the constraint, instead of being found by a range query after its insert. Search
+and booking find free tables by looking up their slots, an anti-join on the key,
+rather than `start <= end AND end >= start` over `reservation`.
+
+A reservation holds every slot from the one its start is in to the one its end is
+in. For times on slot boundaries (eg `/restaurant/<id>/availability`'s, with the
+default settings) that's the same as the range check. Otherwise it's conservative:
+two reservations within a slot of each other conflict.
+
+Turning it on (or changing `TABLE_SLOT_MINUTES`) needs `python scripts.py slots
+rebuild`, and `python scripts.py slots check` compares the table with `reservation`.
+Core writes to `reservation` (eg `scripts.generate`) bypass the session, so rebuild
+after them too.
+"""
+
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from flask import current_app, has_app_context
+import sqlalchemy as sa
+
+from app.models import Reservation, db, table_slot
+
+# Reservations/slots written per statement when rebuilding
+CHUNK_SIZE = 10000
+
+
+def enabled() -> bool:
+    return has_app_context() and current_app.config.get("TABLE_SLOTS", False)
+
+
+def slot_size() -> timedelta:
+    return timedelta(minutes=current_app.config.get("TABLE_SLOT_MINUTES", 15))
+
+
+def floor(dt: datetime) -> datetime:
+    """Start of the slot `dt` is in. Slots are counted from midnight"""
+    dt = dt.replace(tzinfo=None)
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day + (dt - day) // slot_size() * slot_size()
+
+
+def slots_between(start: datetime, end: datetime) -> list[datetime]:
+    """Starts of every slot touched by `start`-`end`"""
+    first, last, size = floor(start), floor(end), slot_size()
+    return [first + i * size for i in range((last - first) // size + 1)]
+
+
+def held(start: datetime, end: datetime) -> tuple[datetime, datetime]:
+    """A block, as the first & last slots it touches, to check against `held_index`"""
+    return floor(start), floor(end)
+
+
+def held_index(start: datetime, end: datetime, table_ids: list[int] | None = None):
+    """The slots held between `start` and `end` (on `table_ids`), each as an instant
+
+    In an `IntervalIndex`, so `is_free(table_id, *held(start, end))` agrees with the
+    key: whether a booking could take the table.
+    """
+    from app.availability import IntervalIndex
+
+    index = IntervalIndex()
+    query = sa.select(
+        table_slot.c.table_id, table_slot.c.slot_start, table_slot.c.reservation_id
+    ).where(table_slot.c.slot_start.between(floor(start), floor(end)))
+    if table_ids is not None:
+        query = query.where(table_slot.c.table_id.in_(table_ids))
+    for table_id, slot, id_ in db.session.execute(query):
+        index.add(table_id, id_, slot, slot)
+    return index
+
+
+def is_conflict(error: sa.exc.IntegrityError) -> bool:
+    """Whether `error` is another reservation holding one of the slots"""
+    return enabled() and table_slot.name in str(error.orig)
+
+
+def _rows(reservation_id: int, table_id: int, start: datetime, end: datetime):
+    return [
+        {"table_id": table_id, "slot_start": slot, "reservation_id": reservation_id}
+        for slot in slots_between(start, end)
+    ]
+
+
+@sa.event.listens_for(Reservation, "after_insert")
+def _insert_slots(mapper, connection, target):
+    if not enabled():
+        return
+    rows = _rows(target.id, target.table_id, target.start, target.end)
+    # Ending before it starts, it touches no slots
+    if rows:
+        connection.execute(table_slot.insert(), rows)
+
+
+@sa.event.listens_for(Reservation, "after_update")
+def _update_slots(mapper, connection, target):
+    if not enabled():
+        return
+    state = sa.inspect(target)
+    if any(
+        state.attrs[key].history.has_changes() for key in ("table_id", "start", "end")
+    ):
+        _delete_slots(mapper, connection, target)
+        _insert_slots(mapper, connection, target)
+
+
+@sa.event.listens_for(Reservation, "before_delete")
+def _delete_slots(mapper, connection, target):
+    if enabled():
+        connection.execute(
+            table_slot.delete().where(table_slot.c.reservation_id == target.id)
+        )
+
+
+def _expected():
+    """(table_id, {slot_start: reservation_id}, clashes) from `reservation`, by table
+
+    Where reservations on a table touch the same slot, the first (by id) gets it, and
+    the rest are clashes: (table_id, slot_start, reservation_id).
+    """
+    rows = db.session.execute(
+        sa.select(
+            Reservation.table_id, Reservation.id, Reservation.start, Reservation.end
+        )
+        .order_by(Reservation.table_id, Reservation.id)
+        .execution_options(yield_per=CHUNK_SIZE)
+    )
+    for table_id, reservations in groupby(rows, key=lambda row: row[0]):
+        slots, clashes = {}, []
+        for _, id_, start, end in reservations:
+            for slot in slots_between(start, end):
+                if slot in slots:
+                    clashes.append((table_id, slot, id_))
+                else:
+                    slots[slot] = id_
+        yield table_id, slots, clashes
+
+
+def rebuild() -> int:
+    """Regenerate `table_slot` from `reservation`, in one transaction
+
+    Returns how many slots were written.
+    """
+    db.session.execute(table_slot.delete())
+    written, chunk = 0, []
+    for table_id, slots, _ in _expected():
+        chunk += [
+            {"table_id": table_id, "slot_start": slot, "reservation_id": id_}
+            for (slot, id_) in slots.items()
+        ]
+        if len(chunk) >= CHUNK_SIZE:
+            db.session.execute(table_slot.insert(), chunk)
+            written, chunk = written + len(chunk), []
+    if chunk:
+        db.session.execute(table_slot.insert(), chunk)
+        written += len(chunk)
+    db.session.commit()
+    return written
+
+
+def check() -> dict[str, list[tuple[int, datetime, int]]]:
+    """Differences between `table_slot` and what `reservation` says it should hold
+
+    Lists of (table_id, slot_start, reservation_id):
+    - "missing": slots that should be there
+    - "extra": slots that shouldn't, eg for a deleted reservation
+    - "clashes": reservations touching a slot an earlier one on their table holds.
+      Booked with `TABLE_SLOTS` off, eg from another process
+
+    All empty if it's consistent. Both sides are read a table at a time.
+    """
+    problems = {"missing": [], "extra": [], "clashes": []}
+    rows = db.session.execute(
+        sa.select(
+            table_slot.c.table_id, table_slot.c.slot_start, table_slot.c.reservation_id
+        )
+        .order_by(table_slot.c.table_id, table_slot.c.slot_start)
+        .execution_options(yield_per=CHUNK_SIZE)
+    )
+    actual = ((t, list(group)) for (t, group) in groupby(rows, key=lambda r: r[0]))
+    current = next(actual, None)
+
+    for table_id, slots, clashes in _expected():
+        problems["clashes"] += clashes
+        # Tables with slots, but no reservations
+        while current is not None and current[0] < table_id:
+            problems["extra"] += [tuple(row) for row in current[1]]
+            current = next(actual, None)
+        have = {}
+        if current is not None and current[0] == table_id:
+            have = {slot: id_ for (_, slot, id_) in current[1]}
+            current = next(actual, None)
+
+        for slot, id_ in slots.items():
+            if have.pop(slot, None) != id_:
+                problems["missing"].append((table_id, slot, id_))
+        problems["extra"] += [(table_id, slot, id_) for (slot, id_) in have.items()]
+
+    while current is not None:
+        problems["extra"] += [tuple(row) for row in current[1]]
+        current = next(actual, None)
+    return problems
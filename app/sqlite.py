@@ -0,0 +1,52 @@
+"""SQLite connection profile: pragmas for every connection, and a pool for threads
+
+By default SQLite uses a rollback journal, so a booking's write transaction blocks
+every reader until it commits. `SQLITE_PRAGMAS` are run on each new connection:
+- journal_mode=WAL: readers see the last commit while a writer is busy (one writer
+  at a time still). It's stored in the db file, so it stays on once set
+- synchronous=NORMAL: with WAL, only syncs at checkpoints. A power loss can drop the
+  last commits, but never corrupts the db
+- cache_size/mmap_size: page cache per connection, and reads via mmap
+- busy_timeout: how long a writer waits for the lock before "database is locked"
+- temp_store=MEMORY: temporary tables/indexes (eg for ORDER BY) in memory
+
+`SQLITE_POOL` replaces the default pool size (5 + 10 overflow) for file dbs, so the
+threaded server doesn't queue on connections. In-memory dbs keep their own pool.
+"""
+
+import sqlalchemy as sa
+
+
+def engine_options(config) -> dict:
+    """`SQLALCHEMY_ENGINE_OPTIONS`, with `SQLITE_POOL` for a SQLite file db"""
+    options = dict(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    url = sa.make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite" and url.database not in (
+        None,
+        "",
+        ":memory:",
+    ):
+        for key, value in (config.get("SQLITE_POOL") or {}).items():
+            options.setdefault(key, value)
+    return options
+
+
+def apply_profile(engine: sa.Engine, config, read_only: bool = False):
+    """Run `SQLITE_PRAGMAS` on every new connection to `engine`, if it's SQLite
+
+    `read_only` connections can't change the journal mode, so skip it.
+    """
+    pragmas = config.get("SQLITE_PRAGMAS")
+    if not pragmas or engine.dialect.name != "sqlite":
+        return
+    if read_only:
+        pragmas = {k: v for (k, v) in pragmas.items() if k != "journal_mode"}
+
+    @sa.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
@@ -0,0 +1,415 @@
+"""Benchmarks for search, booking and listing, at several data scales
+
+Every scale is generated (by `scripts.generate`) into a temporary db, then each
+benchmark is called `--iterations` times, or for `--budget` seconds if that's sooner.
+Reports p50/p95/p99 latency, SQL queries per call and calls per second.
+
+    python bench.py --scales small,medium --save baseline.json
+    python bench.py --scales small,medium --baseline baseline.json --threshold 0.25
+
+`--concurrency N` also serves searches, lookups, and bookings mixed with lookups, N
+at a time, from N threads (like the threaded server) and through the async entry
+point (`app/asgi.py`). `--no-sqlite-profile` runs without `SQLITE_PRAGMAS` (WAL etc.)
+and `SQLITE_POOL`, to compare. `--table-slots` turns on `TABLE_SLOTS` (app/slots.py).
+
+With `--baseline`, exits non-zero if any benchmark's p95 got more than `--threshold`
+slower, or it runs more queries per call, than in the baseline.
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from flask import current_app
+import sqlalchemy as sa
+
+from app.app import create_app
+from app.asgi import AsyncApp, local_request
+from app.models import Restaurant, User, db
+from config import Config
+from scripts import generate
+
+# (restaurants, users, reservations) for each scale
+SCALES = {
+    "small": (100, 1000, 5000),
+    "medium": (1000, 20000, 100000),
+    "large": (10000, 200000, 1000000),
+}
+# When generated reservations start, and how many days they cover
+FIRST_DAY = datetime(2024, 8, 1)
+DAYS = 30
+
+
+class BenchConfig(Config):
+    # Measure the queries themselves, not the caches in front of them
+    SEARCH_CACHE_SIZE = 0
+    CATALOG_CACHE_SIZE = 0
+    # Its EXPLAINs would count as queries
+    SLOW_REQUEST_SECONDS = None
+
+
+@contextmanager
+def count_queries(*engines: sa.Engine):
+    """Count the SQL statements `engines` run in the block"""
+    statements = [0]
+
+    def record(*args):
+        statements[0] += 1
+
+    for engine in engines:
+        sa.event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            sa.event.remove(engine, "before_cursor_execute", record)
+
+
+def app_engines(app) -> list[sa.Engine]:
+    """The writer, and the reader if reads are routed to one"""
+    reader = app.extensions.get("reader_engine")
+    return [db.engine] + ([reader] if reader is not None else [])
+
+
+def benchmarks(app, rng: random.Random, scale: tuple[int, int, int]):
+    """Name -> function making one call, with random (but seeded) arguments"""
+    restaurants, users, _ = scale
+    client = app.test_client()
+
+    def party():
+        return rng.sample(range(1, users + 1), rng.randint(1, 4))
+
+    def when():
+        # Within the generated reservations, so searches see realistic contention
+        start = FIRST_DAY + timedelta(
+            days=rng.randrange(DAYS), minutes=15 * rng.randrange(11 * 4, 22 * 4)
+        )
+        return start, start + timedelta(hours=2)
+
+    def search():
+        start, end = when()
+        query = Restaurant.search_has_table(party(), start, end).limit(10)
+        db.session.scalars(query).all()
+
+    def has_reservation():
+        start, end = when()
+        User.has_reservation(party(), start, end)
+
+    def book_table():
+        # After the generated data, so every booking is new
+        start = FIRST_DAY + timedelta(days=DAYS + rng.randrange(365), hours=12)
+        restaurant = db.session.get(Restaurant, rng.randint(1, restaurants))
+        restaurant.book_table(party(), start, start + timedelta(hours=2))
+
+    def get(url):
+        def call():
+            response = client.get(url())
+            assert response.status_code < 500, response.status_code
+
+        return call
+
+    def search_url():
+        start, _ = when()
+        ids = "&".join(f"user_ids={u}" for u in party())
+        return f"/restaurant/search?{ids}&datetime={start.isoformat()}"
+
+    return {
+        "search_has_table": search,
+        "has_reservation": has_reservation,
+        "book_table": book_table,
+        "GET /restaurant/search": get(search_url),
+        "GET /restaurants": get(
+            lambda: f"/restaurants?page={rng.randint(1, restaurants // 10)}"
+        ),
+        "GET /users": get(lambda: f"/users?page={rng.randint(1, users // 10)}"),
+        "GET /reservations?cursor=": get(lambda: "/reservations?cursor="),
+        "GET /user/<id>/reservations": get(
+            lambda: f"/user/{rng.randint(1, users)}/reservations"
+        ),
+    }
+
+
+def concurrent_requests(rng: random.Random, scale: tuple[int, int, int], n: int):
+    """(name, `n` (method, url)s) for the concurrent benchmarks"""
+    restaurants, users, _ = scale
+    searches, mixed = [], []
+    for _ in range(n):
+        start = FIRST_DAY + timedelta(days=rng.randrange(DAYS), hours=19)
+        searches.append(
+            (
+                "GET",
+                f"/restaurant/search?user_ids={rng.randint(1, users)}"
+                f"&datetime={start.isoformat()}",
+            )
+        )
+    yield "GET /restaurant/search", searches
+    yield "GET /restaurant/<id>", [
+        ("GET", f"/restaurant/{rng.randint(1, restaurants)}") for _ in range(n)
+    ]
+
+    # Reads while bookings are being written: 1 booking to every 3 reads
+    for i in range(n):
+        if i % 4 == 0:
+            # After the generated data, so every booking is new
+            start = FIRST_DAY + timedelta(days=DAYS + rng.randrange(365), hours=12)
+            url = (
+                f"/restaurant/{rng.randint(1, restaurants)}/reservation"
+                f"?user_ids={rng.randint(1, users)}&datetime={start.isoformat()}"
+            )
+            mixed.append(("POST", url))
+        else:
+            mixed.append(("GET", f"/restaurant/{rng.randint(1, restaurants)}"))
+    yield "mixed bookings + reads", mixed
+
+
+def run(call, iterations: int, budget: float, warmup: int = 3) -> dict:
+    """Time `iterations` calls, or as many as fit in `budget` seconds (at least 2)"""
+    for _ in range(warmup):
+        call()
+
+    latencies = []
+    with count_queries(*app_engines(current_app)) as queries:
+        began = time.perf_counter()
+        while len(latencies) < iterations:
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+            if len(latencies) >= 2 and time.perf_counter() - began > budget:
+                break
+        elapsed = time.perf_counter() - began
+    return stats(latencies, elapsed, queries[0])
+
+
+def run_threaded(app, requests: list[tuple[str, str]], concurrency: int) -> dict:
+    """Make (method, url) `requests` from a pool of threads, like the threaded server"""
+
+    def call(request):
+        method, url = request
+        start = time.perf_counter()
+        response = app.test_client().open(url, method=method)
+        assert response.status_code < 500, response.status_code
+        return time.perf_counter() - start
+
+    with count_queries(*app_engines(app)) as queries:
+        with ThreadPoolExecutor(concurrency) as pool:
+            began = time.perf_counter()
+            latencies = list(pool.map(call, requests))
+            elapsed = time.perf_counter() - began
+    return stats(latencies, elapsed, queries[0])
+
+
+def run_async(app, requests: list[tuple[str, str]], concurrency: int) -> dict:
+    """Make (method, url) `requests` through the ASGI entry point, `concurrency` at a
+    time
+    """
+
+    async def go():
+        asgi = AsyncApp(app)
+        limit = asyncio.Semaphore(concurrency)
+
+        async def call(method, url):
+            async with limit:
+                start = time.perf_counter()
+                status, _, _ = await local_request(asgi, method, url)
+                assert status < 500, status
+                return time.perf_counter() - start
+
+        try:
+            with count_queries(asgi.engine.sync_engine) as queries:
+                began = time.perf_counter()
+                latencies = await asyncio.gather(*(call(*r) for r in requests))
+                elapsed = time.perf_counter() - began
+        finally:
+            await asgi.engine.dispose()
+        return stats(latencies, elapsed, queries[0])
+
+    return asyncio.run(go())
+
+
+def stats(latencies: list[float], elapsed: float, queries: int) -> dict:
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "p50_ms": cuts[49] * 1000,
+        "p95_ms": cuts[94] * 1000,
+        "p99_ms": cuts[98] * 1000,
+        "queries": queries / len(latencies),
+        "ops_per_s": len(latencies) / elapsed,
+        "calls": len(latencies),
+    }
+
+
+def bench_scale(
+    name: str,
+    iterations: int,
+    budget: float,
+    seed: int,
+    engine: str,
+    concurrency: int,
+    sqlite_profile: bool = True,
+    table_slots: bool = False,
+) -> dict:
+    restaurants, users, reservations = SCALES[name]
+    with tempfile.TemporaryDirectory() as tmp:
+
+        class ScaleConfig(BenchConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(tmp, "bench.db")
+            AVAILABILITY_ENGINE = engine
+            OCCUPANCY_ORIGIN = FIRST_DAY
+            TABLE_SLOTS = table_slots
+            if not sqlite_profile:
+                SQLITE_PRAGMAS = None
+                SQLITE_POOL = None
+
+        app = create_app(ScaleConfig)
+        with app.app_context():
+            db.create_all()
+            print(f"# {name}: generating", file=sys.stderr)
+            generate(
+                restaurants,
+                users,
+                reservations,
+                seed=seed,
+                first_day=FIRST_DAY.date(),
+                days=DAYS,
+            )
+
+            rng = random.Random(seed)
+            results = {}
+            for bench, call in benchmarks(app, rng, SCALES[name]).items():
+                results[bench] = run(call, iterations, budget)
+                db.session.remove()
+
+            if concurrency:
+                # Separate requests for each, so the async run makes new bookings too
+                threaded = concurrent_requests(rng, SCALES[name], iterations)
+                asynchronous = concurrent_requests(rng, SCALES[name], iterations)
+                for (workload, requests), (_, async_requests) in zip(
+                    list(threaded), list(asynchronous)
+                ):
+                    results[f"{workload} x{concurrency} threads"] = run_threaded(
+                        app, requests, concurrency
+                    )
+                    results[f"{workload} x{concurrency} async"] = run_async(
+                        app, async_requests, concurrency
+                    )
+                    db.session.remove()
+            db.engine.dispose()
+    return results
+
+
+def report(results: dict):
+    print(f"{'benchmark':<34}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}", end="")
+    print(f"{'queries':>9}{'ops/s':>9}{'calls':>7}")
+    for scale, benches in results.items():
+        print(f"[{scale}]")
+        for bench, r in benches.items():
+            print(
+                f"{bench:<34}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+                f"{r['queries']:>9.1f}{r['ops_per_s']:>9.0f}{r['calls']:>7}"
+            )
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Benchmarks that are slower (p95) or run more queries than the baseline"""
+    out = []
+    for scale, benches in results.items():
+        for bench, r in benches.items():
+            before = baseline.get(scale, {}).get(bench)
+            if before is None:
+                continue
+            if r["p95_ms"] > before["p95_ms"] * (1 + threshold):
+                out.append(
+                    f"{scale} {bench}: p95 {before['p95_ms']:.2f}ms -> "
+                    f"{r['p95_ms']:.2f}ms"
+                )
+            if r["queries"] > before["queries"]:
+                out.append(
+                    f"{scale} {bench}: queries {before['queries']:.1f} -> "
+                    f"{r['queries']:.1f}"
+                )
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--scales", default="small", help=f"Comma separated, of {', '.join(SCALES)}"
+    )
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=10,
+        help="Stop a benchmark early after this many seconds",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--engine", default="sql", help="AVAILABILITY_ENGINE to benchmark"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Also compare threaded vs async serving, this many requests at a time",
+    )
+    parser.add_argument(
+        "--no-sqlite-profile",
+        action="store_true",
+        help="Use SQLite's default journal and pragmas, and SQLAlchemy's default pool",
+    )
+    parser.add_argument(
+        "--table-slots",
+        action="store_true",
+        help="Find free tables and conflicts through `table_slot` (TABLE_SLOTS)",
+    )
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against this JSON file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Allowed p95 slowdown vs the baseline, as a fraction",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for scale in args.scales.split(","):
+        if scale not in SCALES:
+            parser.error(f"Unknown scale {scale}")
+        results[scale] = bench_scale(
+            scale,
+            args.iterations,
+            args.budget,
+            args.seed,
+            args.engine,
+            args.concurrency,
+            not args.no_sqlite_profile,
+            args.table_slots,
+        )
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failed = regressions(results, json.load(f), args.threshold)
+        for line in failed:
+            print(f"REGRESSION {line}")
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,3 +6,69 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config:
     # Hardcoded for simplicity, it's only MySQL
     SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(basedir, "app.db")
+
+    # Run on every new SQLite connection (see app/sqlite.py), None for SQLite's defaults
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,  # In KiB, so 64MB
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 5000,  # ms
+        "temp_store": "MEMORY",
+    }
+    # Connection pool for a SQLite file db, None for SQLAlchemy's default
+    SQLITE_POOL = {"pool_size": 16, "max_overflow": 16, "pool_timeout": 30}
+
+    # Run GET requests' queries on read-only connections (see app/routing.py)
+    READ_ROUTING = True
+    # Where they go, eg a replica. None for read-only connections to a SQLite file db
+    SQLALCHEMY_READER_URI = None
+
+    # Build list responses from selected columns instead of ORM objects
+    SERIALIZE_PROJECTIONS = True
+
+    # How `Restaurant.search_has_table` finds free tables: "sql" queries the
+    # reservation table, "index" uses an in-memory interval index, and "matrix" a
+    # NumPy occupancy matrix (see availability.py)
+    AVAILABILITY_ENGINE = "sql"
+    # Matrix engine: slot size, how far ahead it covers, and where it starts
+    # (None means midnight today)
+    OCCUPANCY_SLOT_MINUTES = 15
+    OCCUPANCY_HORIZON_DAYS = 7
+    OCCUPANCY_ORIGIN = None
+
+    # Most `search_has_table` results kept in memory, 0 to disable (see cache.py)
+    SEARCH_CACHE_SIZE = 1024
+    # Most `/restaurants`, `/users` etc. responses kept in memory, 0 to disable
+    CATALOG_CACHE_SIZE = 1024
+
+    # Record per-endpoint latency and SQL counts, served at `/metrics`
+    METRICS_ENABLED = True
+    # Log requests slower than this (None to disable), with their SQL statements and
+    # the query plans of the slowest few
+    SLOW_REQUEST_SECONDS = 1.0
+    SLOW_REQUEST_PLANS = 3
+
+    # `python scripts.py archive` moves reservations that ended this long ago out of
+    # the reservation table, this many per transaction (see app/archive.py)
+    ARCHIVE_AFTER_DAYS = 30
+    ARCHIVE_BATCH_SIZE = 1000
+
+    # Rows `/export/<kind>.ndjson` and `python scripts.py export` read (and write) at
+    # a time (see app/export.py)
+    EXPORT_BATCH_SIZE = 1000
+
+    # Restaurants per transaction in `/restaurants/import` and `python scripts.py
+    # import` (see app/imports.py)
+    IMPORT_CHUNK_SIZE = 1000
+
+    # Keep `table_slot` (every slot each reservation holds its table for) and use it
+    # for conflicts and availability (see app/slots.py). Needs
+    # `python scripts.py slots rebuild` after turning on, or changing the slot size
+    TABLE_SLOTS = False
+    TABLE_SLOT_MINUTES = 15
+
+    # Spacing of start times in `/restaurant/<id>/availability`
+    BOOKING_SLOT_MINUTES = 15
+    # Times `Restaurant.book_table` retries after losing a table to another booking
+    BOOKING_RETRIES = 5
@@ -0,0 +1,76 @@
+"""indexes and association primary keys
+
+Revision ID: e9d5ce621e80
+Revises: 684526b5c356
+Create Date: 2026-10-17 20:07:53.619131
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e9d5ce621e80"
+down_revision = "684526b5c356"
+branch_labels = None
+depends_on = None
+
+# Association table -> its two columns, which become its primary key
+ASSOCIATIONS = {
+    "user_restriction": ("user_id", "restriction_id"),
+    "restaurant_endorsement": ("restaurant_id", "restriction_id"),
+    "user_reservation": ("user_id", "reservation_id"),
+}
+
+
+def upgrade():
+    for table, (a, b) in ASSOCIATIONS.items():
+        # Rows the primary key wouldn't allow: half-empty, or duplicates
+        op.execute(f"DELETE FROM {table} WHERE {a} IS NULL OR {b} IS NULL")
+        op.execute(
+            f"DELETE FROM {table} WHERE rowid NOT IN "
+            f"(SELECT MIN(rowid) FROM {table} GROUP BY {a}, {b})"
+        )
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column(a, existing_type=sa.INTEGER(), nullable=False)
+            batch_op.alter_column(b, existing_type=sa.INTEGER(), nullable=False)
+            batch_op.create_primary_key(f"pk_{table}", [a, b])
+
+    with op.batch_alter_table("user_reservation", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_user_reservation_reservation_id", ["reservation_id"], unique=False
+        )
+
+    with op.batch_alter_table("reservation", schema=None) as batch_op:
+        batch_op.create_index("ix_reservation_start", ["start"], unique=False)
+        batch_op.create_index(
+            "ix_reservation_table_id_start_end",
+            ["table_id", "start", "end"],
+            unique=False,
+        )
+
+    with op.batch_alter_table("table", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_table_restaurant_id_capacity",
+            ["restaurant_id", "capacity"],
+            unique=False,
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("table", schema=None) as batch_op:
+        batch_op.drop_index("ix_table_restaurant_id_capacity")
+
+    with op.batch_alter_table("reservation", schema=None) as batch_op:
+        batch_op.drop_index("ix_reservation_table_id_start_end")
+        batch_op.drop_index("ix_reservation_start")
+
+    with op.batch_alter_table("user_reservation", schema=None) as batch_op:
+        batch_op.drop_index("ix_user_reservation_reservation_id")
+
+    for table, (a, b) in ASSOCIATIONS.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_constraint(f"pk_{table}", type_="primary")
+            batch_op.alter_column(a, existing_type=sa.INTEGER(), nullable=True)
+            batch_op.alter_column(b, existing_type=sa.INTEGER(), nullable=True)
@@ -0,0 +1,6 @@
+"""ASGI entry point, eg `uvicorn rec_async:app` (see app/asgi.py)"""
+
+from app.asgi import AsyncApp
+from rec import app as flask_app
+
+app = AsyncApp(flask_app)
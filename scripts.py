@@ -1,8 +1,27 @@
-from datetime import datetime, timedelta
+"""Set up the db: `reinit` for the example data (the default), `generate` for lots
+
+`archive` moves past reservations out of the way (see app/archive.py), `slots`
+rebuilds/checks `table_slot` (see app/slots.py), `busy` rebuilds `user_busy` (see
+app/busy.py), `import` adds restaurants from NDJSON/CSV (see app/imports.py), and
+`export` dumps a table as NDJSON (see app/export.py).
+"""
+
+import argparse
+from datetime import date, datetime, time, timedelta
+from itertools import islice
+import os
+import random
+import sys
+import time as timer
+
 import flask_migrate as fm
+import sqlalchemy as sa
 
+from app import archive, availability, busy, export, imports, slots
 from app.app import create_app
+from app.cache import bump_catalog
 from app.models import User, Restaurant, Table, Restriction, db, Reservation
+from app.models import restaurant_endorsement, user_reservation, user_restriction
 
 
 def reinit_tables():
@@ -85,6 +104,378 @@ def reinit_tables():
     db.session.commit()
 
 
+RESTRICTIONS = [
+    "vegetarian",
+    "vegan",
+    "gluten free",
+    "paleo",
+    "kosher",
+    "halal",
+    "nut free",
+    "dairy free",
+]
+
+
+def generate(
+    restaurants: int,
+    users: int,
+    reservations: int,
+    seed: int = 1,
+    table_sizes: dict[int, float] = {2: 4, 4: 2, 6: 1},
+    tables_per_restaurant: tuple[int, int] = (3, 15),
+    party_sizes: dict[int, float] = {1: 1, 2: 5, 3: 1, 4: 2, 6: 1},
+    restriction_rate: float = 0.2,
+    endorse_rate: float = 0.3,
+    seatings: dict[time, float] = {
+        time(11): 1,
+        time(13, 30): 1,
+        time(16): 1,
+        time(18, 30): 3,
+        time(21): 2,
+    },
+    first_day: date = date(2024, 8, 1),
+    days: int = 30,
+    chunk_size: int = 10000,
+):
+    """Add a large, reproducible, synthetic data set to the current app's db
+
+    Rows are generated lazily and written with Core bulk inserts, `chunk_size` at a
+    time, with masks computed up front instead of by the flush listener. The same
+    arguments and `seed` always produce the same rows.
+
+    - `restriction_rate`: chance a user has any restrictions (then one or two)
+    - `endorse_rate`: chance a restaurant endorses each restriction
+    - `table_sizes`/`party_sizes`: relative weights of each size
+    - `seatings`: start times each day, with the relative share of reservations at each
+
+    Reservations are 2 hours, and seatings should be further apart than that: a table
+    or user is booked at most once per seating, so nothing overlaps. Tables and users
+    are drawn uniformly, and dietary restrictions are ignored when booking.
+    """
+    rng = random.Random(seed)
+
+    def next_id(model):
+        return (db.session.scalar(sa.select(sa.func.max(model.id))) or 0) + 1
+
+    def insert(name, parent, child, rows):
+        """Insert (parent row, child rows) pairs in chunks, in one transaction"""
+        began = timer.perf_counter()
+        count = 0
+        with db.engine.begin() as conn:
+            while chunk := list(islice(rows, chunk_size)):
+                conn.execute(sa.insert(parent), [p for (p, _) in chunk])
+                children = [c for (_, cs) in chunk for c in cs]
+                if children:
+                    conn.execute(sa.insert(child), children)
+                count += len(chunk)
+        print(f"{name}: {count} rows in {timer.perf_counter() - began:.1f}s")
+
+    def mask(ids):
+        out = 0
+        for id_ in ids:
+            out |= Restriction.id_bit(id_)
+        return out
+
+    # Reuse any restrictions that exist
+    existing = set(db.session.scalars(sa.select(Restriction.name)))
+    db.session.add_all(Restriction(name=n) for n in RESTRICTIONS if n not in existing)
+    db.session.commit()
+    restriction_ids = list(
+        db.session.scalars(
+            sa.select(Restriction.id)
+            .where(Restriction.name.in_(RESTRICTIONS))
+            .order_by(Restriction.id)
+        )
+    )
+
+    def generate_users(first):
+        for id_ in range(first, first + users):
+            ids = []
+            if rng.random() < restriction_rate:
+                ids = rng.sample(restriction_ids, rng.randint(1, 2))
+            user = {"id": id_, "name": f"User {id_}", "restriction_mask": mask(ids)}
+            yield user, [{"user_id": id_, "restriction_id": r} for r in ids]
+
+    def generate_restaurants(first):
+        for id_ in range(first, first + restaurants):
+            ids = [r for r in restriction_ids if rng.random() < endorse_rate]
+            restaurant = {
+                "id": id_,
+                "name": f"Restaurant {id_}",
+                "endorse_mask": mask(ids),
+            }
+            yield restaurant, [{"restaurant_id": id_, "restriction_id": r} for r in ids]
+
+    def generate_tables(first_restaurant, first):
+        """Table rows, remembering each one's (id, capacity) in `tables`"""
+        sizes, weights = list(table_sizes), list(table_sizes.values())
+        for rid in range(first_restaurant, first_restaurant + restaurants):
+            n = rng.randint(*tables_per_restaurant)
+            for capacity in rng.choices(sizes, weights, k=n):
+                tables.append((first + len(tables), capacity))
+                table = {
+                    "id": tables[-1][0],
+                    "capacity": capacity,
+                    "restaurant_id": rid,
+                }
+                yield table, []
+
+    def generate_reservations(first):
+        """Reservations for each seating by its weight, at most one per table"""
+        starts = [
+            datetime.combine(first_day + timedelta(days=d), t)
+            for d in range(days)
+            for t in seatings
+        ]
+        shares = [w for _ in range(days) for w in seatings.values()]
+        counts = [min(int(reservations * w / sum(shares)), len(tables)) for w in shares]
+        # Hand out what rounding down left over
+        for i in range(min(reservations - sum(counts), len(counts))):
+            counts[i] = min(counts[i] + 1, len(tables))
+
+        sizes, weights = list(party_sizes), list(party_sizes.values())
+        id_ = first
+        for start, count in zip(starts, counts):
+            picked = rng.sample(tables, count)
+            party = [min(rng.choices(sizes, weights)[0], c) for (_, c) in picked]
+            # Distinct users within a seating, so nobody is double-booked
+            booked = iter(rng.sample(range(users), min(sum(party), users)))
+            for (table_id, _), size in zip(picked, party):
+                members = list(islice(booked, size))
+                if not members:
+                    break
+                reservation = {
+                    "id": id_,
+                    "table_id": table_id,
+                    "start": start,
+                    "end": start + timedelta(hours=2),
+                }
+                yield reservation, [
+                    {"reservation_id": id_, "user_id": first_user + u} for u in members
+                ]
+                id_ += 1
+
+    first_user = next_id(User)
+    insert("users", User.__table__, user_restriction, generate_users(first_user))
+
+    first_restaurant = next_id(Restaurant)
+    insert(
+        "restaurants",
+        Restaurant.__table__,
+        restaurant_endorsement,
+        generate_restaurants(first_restaurant),
+    )
+
+    tables = []
+    new_tables = generate_tables(first_restaurant, next_id(Table))
+    insert("tables", Table.__table__, None, new_tables)
+
+    insert(
+        "reservations",
+        Reservation.__table__,
+        user_reservation,
+        generate_reservations(next_id(Reservation)),
+    )
+
+    # Nothing above went through the session: bump the catalog versions (which every
+    # process reads), and drop this process's engines
+    bump_catalog("restaurant", "user")
+    availability.reset()
+    began = timer.perf_counter()
+    count = busy.rebuild()
+    print(f"user_busy: {count} rows in {timer.perf_counter() - began:.1f}s")
+    if slots.enabled():
+        began = timer.perf_counter()
+        count = slots.rebuild()
+        print(f"slots: {count} rows in {timer.perf_counter() - began:.1f}s")
+
+
+def distribution(text: str, key=int) -> dict:
+    """Parse weights like `2=4,4=2,6=1`"""
+    out = {}
+    for part in text.split(","):
+        k, _, weight = part.partition("=")
+        out[key(k)] = float(weight or 1)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("reinit", help="Reset the db to the small example data set")
+
+    gen = commands.add_parser("generate", help="Add a large synthetic data set")
+    gen.add_argument("--restaurants", type=int, default=1000)
+    gen.add_argument("--users", type=int, default=10000)
+    gen.add_argument("--reservations", type=int, default=50000)
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument(
+        "--table-sizes",
+        type=distribution,
+        default="2=4,4=2,6=1",
+        help="Relative weight of each table capacity",
+    )
+    gen.add_argument(
+        "--tables-per-restaurant",
+        type=lambda s: tuple(int(n) for n in s.split("-")),
+        default="3-15",
+        help="Range of tables per restaurant, eg 3-15",
+    )
+    gen.add_argument(
+        "--party-sizes",
+        type=distribution,
+        default="1=1,2=5,3=1,4=2,6=1",
+        help="Relative weight of each party size",
+    )
+    gen.add_argument(
+        "--restriction-rate",
+        type=float,
+        default=0.2,
+        help="Chance a user has any restrictions",
+    )
+    gen.add_argument(
+        "--endorse-rate",
+        type=float,
+        default=0.3,
+        help="Chance a restaurant endorses each restriction",
+    )
+    gen.add_argument(
+        "--seatings",
+        type=lambda s: distribution(s, key=time.fromisoformat),
+        default="11:00=1,13:30=1,16:00=1,18:30=3,21:00=2",
+        help="Daily start times, with the relative share of reservations at each",
+    )
+    gen.add_argument("--first-day", type=date.fromisoformat, default="2024-08-01")
+    gen.add_argument("--days", type=int, default=30)
+    gen.add_argument("--chunk-size", type=int, default=10000)
+
+    arc = commands.add_parser(
+        "archive", help="Move past reservations into the archive tables"
+    )
+    arc.add_argument(
+        "--days",
+        type=int,
+        help="Archive reservations that ended this many days ago (ARCHIVE_AFTER_DAYS)",
+    )
+    arc.add_argument("--batch-size", type=int, help="Per transaction")
+
+    slot = commands.add_parser(
+        "slots", help="Regenerate table_slot from reservation, or check it matches"
+    )
+    slot.add_argument("action", choices=["rebuild", "check"])
+
+    commands.add_parser("busy", help="Regenerate user_busy from user_reservation")
+
+    imp = commands.add_parser(
+        "import", help="Add restaurants, tables and endorsements from NDJSON/CSV"
+    )
+    imp.add_argument("path", help="File to read, or - for stdin")
+    imp.add_argument(
+        "--format", choices=imports.FORMATS, help="Defaults to the file's extension"
+    )
+    imp.add_argument(
+        "--name",
+        help="Checkpoint to resume from and save to (defaults to the file name)",
+    )
+    imp.add_argument("--chunk-size", type=int, help="Restaurants per transaction")
+
+    exp = commands.add_parser("export", help="Dump a table as NDJSON")
+    exp.add_argument("kind", choices=list(export.KINDS))
+    exp.add_argument(
+        "--since",
+        type=datetime.fromisoformat,
+        help="Only reservations starting at or after this",
+    )
+    exp.add_argument(
+        "--history", action="store_true", help="Include archived reservations"
+    )
+    exp.add_argument("--batch-size", type=int, help="Rows read at a time")
+    exp.add_argument("-o", "--output", help="File to write, instead of stdout")
+    exp.add_argument(
+        "--base-url",
+        default="http://localhost:5000",
+        help="Host for the links in each line",
+    )
+
+    args = vars(parser.parse_args())
+    command = args.pop("command")
+    if command == "import":
+        app = create_app()
+        app.app_context().push()
+        path = args["path"]
+        fmt = args["format"] or ("csv" if path.endswith(".csv") else "ndjson")
+        name = args["name"] or (None if path == "-" else os.path.basename(path))
+
+        def progress(result):
+            print(
+                f"{result['position']} records: {result['restaurants']} restaurants, "
+                f"{result['rejected']} rejected, {result['rows_per_second']} rows/s",
+                file=sys.stderr,
+            )
+
+        resumed = imports.checkpoint(name) if name else 0
+        if resumed:
+            print(f"Resuming {name} after record {resumed}", file=sys.stderr)
+        lines = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        with lines:
+            result = imports.import_restaurants(
+                lines, fmt, name=name, chunk_size=args["chunk_size"], progress=progress
+            )
+        for error in result["errors"]:
+            print(f"    line {error['line']}: {error['error']}")
+        print(
+            f"Imported {result['restaurants']} restaurants, {result['tables']} tables "
+            f"and {result['endorsements']} endorsements in {result['seconds']}s "
+            f"({result['rows_per_second']} rows/s), rejected {result['rejected']}"
+        )
+    elif command == "export":
+        app = create_app()
+        # Lines link to the API, as they would if served, so need a request to build
+        # the urls from
+        app.test_request_context(base_url=args["base_url"]).push()
+        out = open(args["output"], "w") if args["output"] else sys.stdout
+        try:
+            for chunk in export.ndjson(
+                args["kind"], args["since"], args["history"], args["batch_size"]
+            ):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    elif command == "busy":
+        app = create_app()
+        app.app_context().push()
+        print(f"Wrote {busy.rebuild()} rows")
+    elif command == "slots":
+        app = create_app()
+        app.app_context().push()
+        if args["action"] == "rebuild":
+            print(f"Wrote {slots.rebuild()} slots")
+        else:
+            problems = slots.check()
+            for kind, rows in problems.items():
+                print(f"{kind}: {len(rows)}")
+                for row in rows[:10]:
+                    print(f"    table {row[0]}, {row[1]}, reservation {row[2]}")
+            if any(problems.values()):
+                raise SystemExit(1)
+    elif command == "archive":
+        app = create_app()
+        app.app_context().push()
+        if args["days"] is not None:
+            app.config["ARCHIVE_AFTER_DAYS"] = args["days"]
+        moved = archive.archive_reservations(archive.cutoff(), args["batch_size"])
+        print(f"Archived {moved} reservations")
+    elif command == "generate":
+        app = create_app()
+        app.app_context().push()
+        fm.upgrade()
+        generate(**args)
+        print("Data generated")
+    else:
+        reinit_tables()
+        print("Tables reinitialized")
+
+
 if __name__ == "__main__":
-    reinit_tables()
-    print("Tables reinitialized")
+    main()
@@ -1,21 +1,111 @@
+import asyncio
+from contextlib import contextmanager, redirect_stdout
 from datetime import datetime, timezone, timedelta
+import importlib.util
+import io
+import json
+import os
 import pytest
+import random
+import re
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 from app.app import create_app
-from app.models import db
+from app.asgi import AsyncApp, local_request
+from app.busy import rebuild as busy_rebuild
+from app.archive import archive_reservations, cutoff
+from app.availability import IntervalIndex, get_engine
+from app.cache import search_cache
+from app.export import ndjson
+from app.imports import checkpoint as imports_checkpoint
+from app.imports import import_restaurants
+from app.instrumentation import query_plan
+from app.models import BOOKING_CONFLICT, db
 from app.models import User
 from app.models import Reservation
 from app.models import Restaurant
 from app.models import Table
 from app.models import Restriction
+from app.models import restaurant_endorsement
+from app.models import table_slot
+from app.models import user_busy
+from app.models import user_reservation
+from app import slots
 from config import Config
+from scripts import generate
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = "sqlite://"
     ELASTICSEARCH_URL = None
+    # Cached searches are tested separately, so the rest see the engines directly
+    SEARCH_CACHE_SIZE = 0
+    CATALOG_CACHE_SIZE = 0
+
+
+def installed(module: str) -> bool:
+    """Whether an optional dependency (not in the poetry deps) is installed"""
+    return importlib.util.find_spec(module) is not None
+
+
+@contextmanager
+def assert_max_queries(test, n):
+    """Fail `test` if the block runs more than `n` SQL statements"""
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(db.engine, "before_cursor_execute", record)
+    test.assertLessEqual(len(statements), n, "\n\n".join(statements))
+
+
+@contextmanager
+def assert_no_full_scans(test, allowed=()):
+    """Fail `test` if a SELECT in the block scans a whole table, other than `allowed`
+
+    Checked with `EXPLAIN QUERY PLAN`, on the statements as they were run.
+    """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    engines = [db.engine]
+    if "reader_engine" in test.app.extensions:
+        engines.append(test.app.extensions["reader_engine"])
+    for engine in engines:
+        sa.event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            sa.event.remove(engine, "before_cursor_execute", record)
+
+    test.assertNotEqual(statements, [])
+    for statement, parameters in statements:
+        plan = query_plan(statement, parameters)
+        # "SCAN table", "SCAN table USING [COVERING] INDEX": every row of it
+        scans = [
+            line
+            for line in plan
+            if re.match(r"SCAN (\w+)", line.strip())
+            and line.split()[1] not in allowed
+            and line.split()[1] != "CONSTANT"
+        ]
+        test.assertEqual(scans, [], f"{statement}\n" + "\n".join(plan))
 
 
 class TestUser(unittest.TestCase):
@@ -124,10 +214,91 @@ class TestUser(unittest.TestCase):
                 print(f"Failed test {name}: {e}")
                 raise e
 
+    def test__user_busy__follows_reservation_writes(self):
+        def busy():
+            return set(db.session.execute(sa.select(user_busy)).all())
+
+        def expected():
+            return {
+                (r.id, u.id, r.start, r.end)
+                for r in db.session.scalars(sa.select(Reservation))
+                for u in r.users
+            }
+
+        self.assertEqual(len(busy()), 2)
+        self.assertEqual(busy(), expected())
+        first, second = db.session.scalars(sa.select(Reservation)).all()
+        lucile, gob = db.session.get(User, 3), db.session.get(User, 4)
+
+        # From either side of the relationship
+        first.users.append(lucile)
+        gob.reservations.append(second)
+        db.session.commit()
+        self.assertEqual(busy(), expected())
+        self.assertTrue(User.has_reservation([4], first.start, first.end))
+
+        second.users.remove(gob)
+        first.start = datetime(2020, 1, 1, 1)
+        db.session.commit()
+        self.assertEqual(busy(), expected())
+        self.assertFalse(User.has_reservation([4], first.start, first.end))
+        self.assertTrue(User.has_reservation([3], datetime(2020, 1, 1, 1), first.start))
+
+        db.session.delete(first)
+        db.session.commit()
+        self.assertEqual(busy(), expected())
+        self.assertFalse(User.has_reservation([1, 3], second.start, second.end))
+
+        # Rebuilt from `user_reservation`, eg after Core writes
+        db.session.execute(user_busy.delete())
+        self.assertEqual(busy_rebuild(), 1)
+        self.assertEqual(busy(), expected())
+
+        # A range probe on the covering index, per user
+        with assert_no_full_scans(self) as statements:
+            User.has_reservation([1, 2, 3], second.start, second.end)
+        plan = "\n".join(query_plan(*statements[0]))
+        self.assertIn("COVERING INDEX ix_user_busy_user_id_end_start", plan)
+
+    def test__restrictions__refused_past_the_mask_width(self):
+        def count():
+            return db.session.scalar(sa.select(sa.func.count(Restriction.id)))
+
+        limit = Restriction.MAX_RESTRICTIONS
+        db.session.add_all(Restriction(name=f"r{i}") for i in range(limit - 1))
+        db.session.commit()
+
+        # Refused up front, with nothing written
+        db.session.add_all([Restriction(name="one"), Restriction(name="two")])
+        with self.assertRaisesRegex(ValueError, f"at most {limit}"):
+            db.session.commit()
+        db.session.rollback()
+        self.assertEqual(count(), limit - 1)
+
+        # The last one that fits is usable
+        last = Restriction(name="last")
+        user = db.session.get(User, 3)
+        user.restrictions.append(last)
+        db.session.commit()
+        self.assertEqual(last.id, limit)
+        self.assertEqual(user.restriction_mask, 1 << (limit - 1))
+
+        # Deleting one leaves a gap, but ids still only grow
+        db.session.delete(db.session.scalar(sa.select(Restriction).filter_by(id=1)))
+        db.session.commit()
+        db.session.add(Restriction(name="past"))
+        with self.assertRaisesRegex(ValueError, f"at most {limit}"):
+            db.session.commit()
+        db.session.rollback()
+
+
+class RestaurantTestCase(unittest.TestCase):
+    """The restaurants, users and restrictions every restaurant test starts with"""
+
+    config = TestConfig
 
-class TestRestaurant(unittest.TestCase):
     def setUp(self):
-        self.app = create_app(TestConfig)
+        self.app = create_app(self.config)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
@@ -186,6 +357,26 @@ class TestRestaurant(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    def reserve_every_table(self):
+        """A reservation per table, on separate days, for 1-3 users"""
+        for i, table in enumerate(Table.query.all()):
+            r = Reservation(
+                start=datetime(2020, 1, 1, 12) + timedelta(days=i),
+                end=datetime(2020, 1, 1, 14) + timedelta(days=i),
+                table_id=table.id,
+            )
+            r.users.extend(User.query.filter(User.id <= 1 + i % 3).all())
+            db.session.add(r)
+        db.session.commit()
+        db.session.expunge_all()
+
+
+class TestRestaurant(RestaurantTestCase):
+    """Search & booking, which every engine/cache/storage variant below reruns"""
+
+    # Extra queries a `/restaurant/<id>`, `/users` etc. response runs
+    catalog_queries = 0
+
     def test__search_has_table__users_with_restrictions__only_restaurants_supporting(
         self,
     ):
@@ -214,6 +405,349 @@ class TestRestaurant(unittest.TestCase):
                 print(f"Failed test {name}: {e}")
                 raise e
 
+    def test__endorse_mask__follows_endorsement_changes(self):
+        paleo = Restriction.query.filter_by(name="paleo").first()
+        rest = Restaurant.query.get(1)
+        self.assertEqual(rest.endorse_mask, Restriction.mask(rest.endorsements))
+
+        start = datetime(2020, 1, 1, 2)
+        end = datetime(2020, 1, 1, 3)
+        query = Restaurant.search_has_table([4], start, end)
+        self.assertEqual([r.id for r in db.session.scalars(query).all()], [3])
+
+        rest.endorsements.append(paleo)
+        db.session.commit()
+        query = Restaurant.search_has_table([4], start, end)
+        self.assertEqual([r.id for r in db.session.scalars(query).all()], [1, 3])
+
+        rest.endorsements.remove(paleo)
+        db.session.commit()
+        self.assertEqual(rest.endorse_mask, Restriction.mask(rest.endorsements))
+        self.assertFalse(rest.endorse_mask & paleo.bit)
+
+        # Users can change from either side of the relationship
+        user = User.query.get(1)
+        paleo.users.append(user)
+        db.session.commit()
+        self.assertEqual(user.restriction_mask, Restriction.mask(user.restrictions))
+        self.assertTrue(user.restriction_mask & paleo.bit)
+
+    def test__search_has_table_batch__matches_single_searches(self):
+        rest = Restaurant.query.get(4)
+        for _ in rest.tables:
+            rest.book_table([6], datetime(2020, 1, 1, 18), datetime(2020, 1, 1, 20))
+
+        queries = []
+        for userids in [[5], [4], [1, 2], [1, 2, 3, 5, 6]]:
+            for hour in [17, 19, 21]:
+                start = datetime(2020, 1, 1, hour)
+                queries.append((userids, start, start + timedelta(hours=2)))
+
+        out = Restaurant.search_has_table_batch(queries)
+        for query, ids in zip(queries, out):
+            expected = db.session.scalars(Restaurant.search_has_table(*query)).all()
+            self.assertEqual(ids, [r.id for r in expected], query)
+
+    def test__search_batch_endpoint__results_in_order(self):
+        Restaurant.query.get(1).book_table(
+            [5], datetime(2020, 1, 1, 18), datetime(2020, 1, 1, 20)
+        )
+        client = self.app.test_client()
+        response = client.post(
+            "/restaurant/search/batch",
+            json=[
+                {"user_ids": [4], "datetime": "2020-01-01T12:00:00+00:00"},
+                {"user_ids": [5], "datetime": "2020-01-01T19:00:00+00:00"},
+                {"user_ids": [99], "datetime": "2020-01-01T12:00:00+00:00"},
+                {"user_ids": [1], "datetime": "not a date"},
+                {"user_ids": [1], "datetime": "2020-01-01T12:00:00+00:00"},
+            ],
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()["results"]
+        self.assertEqual([r["name"] for r in results[0]["items"]], ["Tetetlán"])
+        self.assertEqual(results[1]["status"], 400)
+        self.assertEqual(results[2]["status"], 404)
+        self.assertEqual(results[3]["status"], 400)
+        self.assertEqual(results[4]["_meta"]["total_items"], 2)
+
+    def test__query_plans__no_full_table_scans(self):
+        start = datetime(2020, 1, 1, 18)
+        end = start + timedelta(hours=2)
+        Restaurant.query.get(1).book_table([1, 2], start, end)
+        db.session.commit()
+        # In-memory availability engines load everything once, on first use. Then
+        # they check every table that fits the party, instead of reservations
+        allowed = {"restaurant"} if get_engine() is None else {"restaurant", "table"}
+
+        # Search goes through every restaurant's mask, but not every reservation
+        with assert_no_full_scans(self, allowed=allowed):
+            db.session.scalars(Restaurant.search_has_table([3, 4], start, end)).all()
+        with assert_no_full_scans(self):
+            User.has_reservation([1, 3], start, end)
+        with assert_no_full_scans(self):
+            db.session.get(Restaurant, 3).book_table([3], start, end)
+        with assert_no_full_scans(self):
+            response = self.app.test_client().get("/user/1/reservations")
+            self.assertEqual(len(response.json["items"]), 1)
+
+    def test__bulk_reservations_endpoint__allocates_in_order_with_one_commit(self):
+        def item(rid, user_ids, hour=18):
+            dt = datetime(2020, 1, 1, hour, tzinfo=timezone.utc).isoformat()
+            return {"restaurant_id": rid, "user_ids": user_ids, "datetime": dt}
+
+        commits = []
+
+        def record(session):
+            commits.append(session)
+
+        sa.event.listen(so.Session, "after_commit", record)
+        client = self.app.test_client()
+        response = client.post(
+            "/reservations/bulk",
+            json=[
+                item(5, [1]),
+                item(5, [2]),  # u.to.pi.a isn't gluten free
+                item(5, [5]),
+                item(5, [6]),  # Both tables taken by the items above
+                item(4, [1], hour=19),  # Overlaps the first item
+                item(99, [1]),
+                item(4, [42]),
+                {"restaurant_id": 4, "user_ids": [3], "datetime": "not a date"},
+                item(3, [3, 4]),
+            ],
+        )
+        sa.event.remove(so.Session, "after_commit", record)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(commits), 1)
+
+        results = response.get_json()["results"]
+        self.assertEqual(
+            [r.get("status") for r in results],
+            [None, 400, None, 400, 400, 404, 404, 400, None],
+        )
+        booked = [db.session.get(Reservation, r["id"]) for r in results if "id" in r]
+        self.assertEqual([r.table.restaurant_id for r in booked], [5, 5, 3])
+        self.assertEqual(len({r.table_id for r in booked}), 3)
+        self.assertEqual([u.id for u in booked[2].users], [3, 4])
+        self.assertEqual(results[8]["size"], 2)
+
+    def test__batch_endpoints__duplicate_user_ids_count_once(self):
+        dt = datetime(2020, 1, 1, 18, tzinfo=timezone.utc).isoformat()
+        client = self.app.test_client()
+        response = client.post(
+            "/reservations/bulk",
+            json=[
+                {"restaurant_id": 4, "user_ids": [2]},
+                {"restaurant_id": 4, "user_ids": [5, 5, 5], "datetime": dt},
+            ],
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()["results"]
+        self.assertEqual(results[0]["status"], 400)
+        self.assertEqual(results[1].get("size"), 1, results)
+        reservation = db.session.get(Reservation, results[1]["id"])
+        self.assertEqual([u.id for u in reservation.users], [5])
+        # A party of one, so the smallest table
+        self.assertEqual(reservation.table.capacity, 2)
+
+        # u.to.pi.a only has 2-tops
+        start = datetime(2020, 1, 2, 18)
+        queries = [([5, 5, 5], start, start + timedelta(hours=2))]
+        self.assertEqual(Restaurant.search_has_table_batch(queries), [[1, 2, 3, 4, 5]])
+        response = client.post(
+            "/restaurant/search/batch",
+            json=[{"user_ids": [5, 5, 5], "datetime": start.isoformat()}],
+        )
+        results = response.get_json()["results"]
+        self.assertEqual(results[0]["_meta"]["total_items"], 5)
+
+    def test__book_table_batch__only_reads_the_booked_restaurants_tables(self):
+        start = datetime(2020, 1, 1, 18)
+        end = start + timedelta(hours=2)
+        Restaurant.query.get(1).book_table([3], start, end)
+        build = IntervalIndex.build
+        indexes = []
+
+        def record_build(*args, **kwargs):
+            indexes.append(build(*args, **kwargs))
+            return indexes[-1]
+
+        with mock.patch.object(IntervalIndex, "build", record_build):
+            booked = Restaurant.book_table_batch([(4, [5], start, end)])
+        self.assertIsInstance(booked[0], int)
+        tables = {t.id for t in Restaurant.query.get(4).tables}
+        for index in indexes:
+            self.assertLessEqual(set(index._tables), tables)
+
+    def test__booking__other_integrity_errors_are_not_conflicts(self):
+        start = datetime(2020, 1, 1, 18)
+        end = start + timedelta(hours=2)
+        # A stale `user_busy` row (at another time) for the next reservation, so
+        # booking it fails on a key that has nothing to do with other bookings
+        past = datetime(2019, 1, 1)
+        db.session.execute(
+            sa.insert(user_busy).values(
+                reservation_id=1, user_id=5, start=past, end=past
+            )
+        )
+        db.session.commit()
+        with self.assertRaises(sa.exc.IntegrityError):
+            Restaurant.book_table_batch([(4, [5], start, end), (5, [6], start, end)])
+        with self.assertRaises(sa.exc.IntegrityError):
+            db.session.get(Restaurant, 4).book_table([5], start, end)
+        # As at the end of a request
+        db.session.rollback()
+        self.assertEqual(db.session.scalars(sa.select(Reservation)).all(), [])
+
+    def test__day_availability__matches_per_slot_search(self):
+        rest = Restaurant.query.get(5)
+        blocks = [
+            (datetime(2020, 1, 1, 18), datetime(2020, 1, 1, 20)),
+            (datetime(2020, 1, 1, 17, 10), datetime(2020, 1, 1, 19)),
+            (datetime(2020, 1, 1, 20, 30), datetime(2020, 1, 1, 21)),
+            (datetime(2020, 1, 1, 23), datetime(2020, 1, 2, 1)),
+            (datetime(2019, 12, 31, 23), datetime(2020, 1, 1, 1)),
+        ]
+        for i, (start, end) in enumerate(blocks):
+            db.session.add(
+                Reservation(start=start, end=end, table_id=rest.tables[i % 2].id)
+            )
+        db.session.commit()
+
+        length = timedelta(hours=2)
+        times = rest.day_availability(
+            datetime(2020, 1, 1).date(), 2, timedelta(minutes=15), length
+        )
+        self.assertEqual(len(times), 96)
+        self.assertIn(False, [available for (_, available) in times])
+        # With `TABLE_SLOTS`, blocks conflict by the slots they touch
+        held = slots.held if slots.enabled() else lambda s, e: (s, e)
+        for start, available in times:
+            first, last = held(start, start + length)
+            free = [
+                t
+                for t in rest.tables
+                if not any(
+                    held(r.start, r.end)[0] <= last and held(r.start, r.end)[1] >= first
+                    for r in t.reservations
+                )
+            ]
+            self.assertEqual(available, len(free) > 0, start)
+
+        # Nothing fits a party bigger than every table
+        times = rest.day_availability(
+            datetime(2020, 1, 1).date(), 3, timedelta(minutes=15), length
+        )
+        self.assertFalse(any(available for (_, available) in times))
+
+        client = self.app.test_client()
+        response = client.get("/restaurant/5/availability?date=2020-01-01&party_size=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()["slots"]), 96)
+        response = client.get("/restaurant/5/availability?date=nope")
+        self.assertEqual(response.status_code, 400)
+
+    def test__to_collection_dict__cursor__walks_every_item_in_key_order(self):
+        rest = Restaurant.query.get(4)
+        for i, table in enumerate(rest.tables):
+            r = Reservation(
+                start=datetime(2020, 1, 1 + i % 3, 12),
+                end=datetime(2020, 1, 1 + i % 3, 14),
+                table_id=table.id,
+            )
+            r.users.append(User.query.get(1))
+            db.session.add(r)
+        db.session.commit()
+
+        client = self.app.test_client()
+        for url, key, counted in [
+            ("/reservations?per_page=4&cursor=", ("start", "id"), False),
+            (
+                "/user/1/reservations?per_page=4&cursor=&total=exact",
+                ("start", "id"),
+                True,
+            ),
+            ("/restaurants?per_page=2&cursor=&total=estimate", ("id",), True),
+        ]:
+            items = []
+            while url:
+                data = client.get(url).get_json()
+                self.assertLessEqual(len(data["items"]), 4)
+                self.assertEqual("total_items" in data["_meta"], counted)
+                items += data["items"]
+                url = data["_links"]["next"]
+
+            keys = [tuple(item[k] for k in key) for item in items]
+            self.assertEqual(keys, sorted(set(keys)))
+            self.assertEqual(len(keys), 15 if "start" in key else 5)
+
+        # Page numbers still work, with or without the count
+        data = client.get("/reservations?page=4&per_page=4").get_json()
+        self.assertEqual(data["_meta"]["total_items"], 15)
+        self.assertEqual(len(data["items"]), 3)
+        data = client.get("/reservations?page=3&per_page=4&total=none").get_json()
+        self.assertNotIn("total_items", data["_meta"])
+        self.assertIsNotNone(data["_links"]["next"])
+
+        for query, message in [
+            ("cursor=garbage", "Invalid cursor garbage"),
+            ("total=maybe", "Invalid total maybe"),
+        ]:
+            response = client.get(f"/reservations?{query}")
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()["message"], message)
+
+    def test__endpoints__projection_matches_orm_serialization(self):
+        self.reserve_every_table()
+        client = self.app.test_client()
+
+        def get(url):
+            data = client.get(url).get_json()
+            for item in data["items"]:
+                for key in ["restrictions", "endorsements"]:
+                    if key in item:
+                        item[key] = sorted(item[key])
+            return data
+
+        for url in [
+            "/restaurants?per_page=100",
+            "/users?per_page=3&page=2",
+            "/reservations?per_page=100",
+            "/reservations?per_page=7&cursor=",
+            "/user/2/reservations?per_page=100",
+            "/restaurant/search?user_ids=5&datetime=2020-01-01T13:00:00",
+        ]:
+            self.app.config["SERIALIZE_PROJECTIONS"] = True
+            projected = get(url)
+            self.app.config["SERIALIZE_PROJECTIONS"] = False
+            self.assertEqual(projected, get(url), url)
+            self.assertTrue(projected["items"], url)
+
+    def test__endpoints__constant_queries_regardless_of_page_size(self):
+        self.reserve_every_table()
+
+        client = self.app.test_client()
+        endpoints = [
+            ("/restaurants?per_page={}", 3 + self.catalog_queries),
+            ("/users?per_page={}", 3 + self.catalog_queries),
+            ("/reservations?per_page={}", 3),
+            ("/reservations?per_page={}&cursor=", 2),
+            ("/user/1/reservations?per_page={}", 4),
+            ("/restaurant/search?per_page={}&user_ids=5&datetime=2021-01-01", 7),
+        ]
+        for url, n in endpoints:
+            # Warm up, so one-off work (eg, building an availability engine) isn't counted
+            client.get(url.format(1))
+            for per_page in [2, 100]:
+                with assert_max_queries(self, n):
+                    response = client.get(url.format(per_page))
+                self.assertEqual(response.status_code, 200, url)
+
+        for url in ["/restaurant/1", "/user/2"]:
+            with assert_max_queries(self, 2 + self.catalog_queries):
+                client.get(url)
+
     def test__search_has_table__reserved_table_timeslot__no_reserved_tables(self):
 
         users = [User.query.get(1)]
@@ -295,3 +829,1022 @@ class TestRestaurant(unittest.TestCase):
         # Make sure user is attached to each res
         for r in reservations:
             self.assertEqual([u.id for u in r.users], user_ids)
+
+
+class TestDataTransfer(RestaurantTestCase):
+    """Exports, imports and archiving, which don't depend on the availability engine"""
+
+    def test__export__streams_every_row_as_ndjson(self):
+        rest = Restaurant.query.get(4)
+        for hour in range(10, 22):
+            start = datetime(2020, 1, 1, hour)
+            rest.book_table([hour % 6 + 1], start, start + timedelta(hours=1))
+        client = self.app.test_client()
+
+        def lines(url):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            return [
+                json.loads(line)
+                for line in response.get_data(as_text=True).split("\n")
+                if line
+            ]
+
+        # The same items as the list endpoints, in cursor order
+        listed = client.get("/reservations?cursor=&per_page=100").json["items"]
+        self.assertEqual(lines("/export/reservations.ndjson"), listed)
+        listed = client.get("/users?per_page=100").json["items"]
+        self.assertEqual(lines("/export/users.ndjson"), listed)
+        self.assertEqual(len(lines("/export/restaurants.ndjson")), 5)
+
+        since = lines("/export/reservations.ndjson?since=2020-01-01T18:00:00%2B00:00")
+        self.assertEqual([r["start"][11:13] for r in since], ["18", "19", "20", "21"])
+        archive_reservations(datetime(2020, 1, 1, 12, 30))
+        self.assertEqual(len(lines("/export/reservations.ndjson")), 10)
+        self.assertEqual(len(lines("/export/reservations.ndjson?history=true")), 12)
+
+        self.assertEqual(client.get("/export/tables.ndjson").status_code, 404)
+        response = client.get("/export/users.ndjson?since=2020-01-01")
+        self.assertEqual(response.status_code, 400)
+        response = client.get("/export/reservations.ndjson?since=yesterday")
+        self.assertEqual(response.status_code, 400)
+
+        # One query, read (and written) a batch at a time
+        with self.app.test_request_context(), assert_max_queries(self, 1):
+            chunks = list(ndjson("reservations", batch_size=4))
+        self.assertEqual([chunk.count("\n") for chunk in chunks], [4, 4, 2])
+
+    def test__import__restaurants_tables_and_endorsements(self):
+        self.app.config["IMPORT_CHUNK_SIZE"] = 2
+        client = self.app.test_client()
+        # Cached before the import, so it has to be dropped
+        search = "/restaurant/search?user_ids=4&datetime=2020-01-01T18:00:00%2B00:00"
+        self.assertEqual(len(client.get(search).json["items"]), 1)
+        records = [
+            {"name": "Gene's", "endorsements": ["Paleo", "vegan"], "tables": {"4": 2}},
+            {"name": "Lardo", "tables": {"2": 1}},
+            {"name": "Sudden Valley", "endorsements": ["Keto"]},
+            {"name": "Bluth's", "tables": {"2": "many"}},
+            "not an object",
+            {"name": "Skip's Scramble", "tables": {"2": 1, "6": 1}},
+        ]
+        body = "\n".join(json.dumps(r) for r in records) + "\n\n{oops\n"
+        response = client.post(
+            "/restaurants/import",
+            data=body,
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, 200)
+        result = response.json
+        self.assertEqual(
+            {k: result[k] for k in ["restaurants", "tables", "endorsements"]},
+            {"restaurants": 2, "tables": 4, "endorsements": 2},
+        )
+        self.assertEqual(result["rejected"], 5)
+        self.assertEqual([e["line"] for e in result["errors"]], [2, 3, 4, 5, 8])
+        self.assertIn("keto", result["errors"][1]["error"])
+        self.assertIn("rows_per_second", result)
+
+        genes = Restaurant.query.filter_by(name="Gene's").one()
+        self.assertEqual(genes.endorse_mask, Restriction.mask(genes.endorsements))
+        self.assertEqual(sorted(t.capacity for t in genes.tables), [4, 4])
+        names = [r["name"] for r in client.get(search).json["items"]]
+        self.assertEqual(names, ["Tetetlán", "Gene's"])
+
+        csv = "name,endorsements,tables\nBanana Stand,Vegan;Vegetarian,2=1\n"
+        response = client.post("/restaurants/import", data=csv, content_type="text/csv")
+        self.assertEqual(response.json["restaurants"], 1)
+        stand = Restaurant.query.filter_by(name="Banana Stand").one()
+        self.assertEqual(len(stand.endorsements), 2)
+        response = client.post("/restaurants/import?format=xml", data="")
+        self.assertEqual(response.status_code, 400)
+
+    def test__import__resumes_from_its_checkpoint(self):
+        lines = [
+            json.dumps({"name": f"Stand {i}", "tables": {"2": 1}}) for i in range(7)
+        ]
+
+        def failing(lines, after):
+            yield from lines[:after]
+            raise OSError("Connection lost")
+
+        with self.assertRaises(OSError):
+            import_restaurants(failing(lines, 5), name="city", chunk_size=2)
+        # The chunk in progress was rolled back, earlier ones kept
+        self.assertEqual(imports_checkpoint("city"), 4)
+        self.assertEqual(Restaurant.query.count(), 9)
+
+        result = import_restaurants(lines, name="city", chunk_size=2)
+        self.assertEqual((result["position"], result["restaurants"]), (7, 3))
+        self.assertEqual(result["rejected"], 0)
+        self.assertEqual(Restaurant.query.count(), 12)
+        # Done, so running it again is a no-op
+        result = import_restaurants(lines, name="city", chunk_size=2)
+        self.assertEqual(result["restaurants"], 0)
+
+    def test__archive__moves_past_reservations_out_of_the_hot_table(self):
+        past = datetime(2020, 1, 1, 18)
+        future = datetime.now().replace(microsecond=0) + timedelta(days=1)
+        old = Restaurant.query.get(5).book_table(
+            [1, 2], past, past + timedelta(hours=2)
+        )
+        new = Restaurant.query.get(5).book_table(
+            [1], future, future + timedelta(hours=2)
+        )
+        old_id, new_id = old.id, new.id
+        client = self.app.test_client()
+        before = client.get("/reservations?history=true").json["items"]
+
+        with assert_max_queries(self, 12):
+            moved = archive_reservations(cutoff(), batch_size=1)
+        self.assertEqual(moved, 1)
+        self.assertEqual(db.session.scalars(sa.select(Reservation.id)).all(), [new_id])
+        self.assertFalse(User.has_reservation([2], past, past + timedelta(hours=1)))
+        self.assertEqual(archive_reservations(cutoff()), 0)
+
+        items = client.get("/reservations").json["items"]
+        self.assertEqual([r["id"] for r in items], [new_id])
+        # Archived reservations keep their ids and users
+        self.assertEqual(client.get("/reservations?history=true").json["items"], before)
+        response = client.get("/user/2/reservations?history=true&per_page=1")
+        self.assertEqual([r["id"] for r in response.json["items"]], [old_id])
+        self.assertEqual(client.get("/user/2/reservations").json["items"], [])
+        # Cursor pages carry `history` on
+        response = client.get("/user/1/reservations?history=true&cursor=&per_page=1")
+        self.assertEqual([r["id"] for r in response.json["items"]], [old_id])
+        self.assertIn("history=true", response.json["_links"]["next"])
+        response = client.get(response.json["_links"]["next"])
+        self.assertEqual([r["id"] for r in response.json["items"]], [new_id])
+
+        # Ids aren't reused, even once the newest reservation is archived
+        Reservation.query.get(new_id).end = past
+        db.session.commit()
+        archive_reservations(cutoff())
+        again = Restaurant.query.get(5).book_table([1], future, future)
+        self.assertGreater(again.id, new_id)
+
+
+class TestInstrumentation(RestaurantTestCase):
+    """Metrics and the slow request log"""
+
+    def test__metrics__counts_requests_and_queries_per_endpoint(self):
+        client = self.app.test_client()
+        client.get("/restaurant/1")
+        client.get("/restaurant/2")
+        client.get("/restaurant/99")
+        with assert_max_queries(self, 2) as statements:
+            client.get("/restaurant/3")
+        queries = len(statements)
+
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        lines = dict(
+            line.rsplit(" ", 1)
+            for line in response.get_data(as_text=True).splitlines()
+            if not line.startswith("#")
+        )
+        labels = 'endpoint="api.restaurant",method="GET"'
+        self.assertEqual(
+            lines[f'rec_http_requests_total{{{labels},status="200"}}'], "3"
+        )
+        self.assertEqual(
+            lines[f'rec_http_requests_total{{{labels},status="404"}}'], "1"
+        )
+        self.assertEqual(
+            lines[f"rec_http_request_duration_seconds_count{{{labels}}}"], "4"
+        )
+        # Every request ran at most as many queries as the last one
+        bucket = f'endpoint="api.restaurant",le="{queries}"'
+        self.assertEqual(lines[f"rec_db_queries_per_request_bucket{{{bucket}}}"], "4")
+
+        class NoMetricsConfig(self.config):
+            METRICS_ENABLED = False
+
+        app = create_app(NoMetricsConfig)
+        self.assertEqual(app.test_client().get("/metrics").status_code, 404)
+
+    def test__slow_request_log__statements_and_query_plans(self):
+        client = self.app.test_client()
+        self.app.config["SLOW_REQUEST_SECONDS"] = 60
+        with self.assertNoLogs(self.app.logger, "WARNING"):
+            client.get("/restaurants")
+
+        self.app.config["SLOW_REQUEST_SECONDS"] = 0
+        self.app.config["SLOW_REQUEST_PLANS"] = 1
+        with self.assertLogs(self.app.logger, "WARNING") as logs:
+            client.get("/restaurant/search?user_ids=5&datetime=2020-01-01T12:00:00")
+        [report] = logs.output
+        self.assertIn("(api.restaurant_search)", report)
+        self.assertIn("'user_ids': ['5']", report)
+        self.assertIn("FROM restaurant", report)
+        self.assertEqual(report.count("Plan for ["), 1)
+        # The search's plan, from EXPLAIN QUERY PLAN
+        plan = report.split("Plan for [")[1]
+        self.assertRegex(plan, r"(SCAN|SEARCH) ")
+
+
+class TestBatchValidation(RestaurantTestCase):
+    """Parsing of bulk booking & batch search requests"""
+
+    def test__bulk_reservations_endpoint__user_ids_must_be_a_list_of_ints(self):
+        dt = datetime(2020, 1, 1, 18, tzinfo=timezone.utc).isoformat()
+        client = self.app.test_client()
+        response = client.post(
+            "/reservations/bulk",
+            json=[
+                # Each would be booked, read as users 4 and 5, 1, and 5 and 3
+                {"restaurant_id": 3, "user_ids": "45", "datetime": dt},
+                {"restaurant_id": 2, "user_ids": [True], "datetime": dt},
+                {"restaurant_id": 2, "user_ids": [5, "3"], "datetime": dt},
+            ],
+        )
+        results = response.get_json()["results"]
+        self.assertEqual([r["status"] for r in results], [400, 400, 400])
+        self.assertEqual(Reservation.query.count(), 0)
+
+    def test__search_batch_endpoint__user_ids_must_be_a_list_of_ints(self):
+        dt = datetime(2020, 1, 1, 18, tzinfo=timezone.utc).isoformat()
+        client = self.app.test_client()
+        response = client.post(
+            "/restaurant/search/batch",
+            json=[
+                {"user_ids": "45", "datetime": dt},
+                {"user_ids": [True], "datetime": dt},
+                {"user_ids": [4, 5], "datetime": dt},
+            ],
+        )
+        results = response.get_json()["results"]
+        self.assertEqual([r.get("status") for r in results], [400, 400, None])
+        self.assertEqual([r["id"] for r in results[2]["items"]], [3])
+
+    def test__search_has_table_batch__indexes_each_run_of_overlapping_blocks(self):
+        build = IntervalIndex.build
+        windows = []
+
+        def record_build(*args, **kwargs):
+            windows.append(args[:2])
+            return build(*args, **kwargs)
+
+        six = datetime(2020, 1, 1, 18)
+        year = datetime(2021, 1, 1, 18)
+        two = timedelta(hours=2)
+        queries = [
+            ([5], year, year + two),
+            ([5], six, six + two),
+            ([4], six + timedelta(hours=1), six + timedelta(hours=3)),
+        ]
+        # Reservations, rather than an engine's copy or held slots
+        self.app.config["AVAILABILITY_ENGINE"] = "sql"
+        self.app.config["TABLE_SLOTS"] = False
+        with mock.patch.object(IntervalIndex, "build", record_build):
+            results = Restaurant.search_has_table_batch(queries)
+        self.assertEqual(results, [[1, 2, 3, 4, 5], [1, 2, 3, 4, 5], [3]])
+        self.assertEqual(
+            sorted(windows), [(six, six + timedelta(hours=3)), (year, year + two)]
+        )
+
+
+class TestGenerate(unittest.TestCase):
+    """`scripts.generate`, which writes on a connection of its own, so into a file db"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+        class FileTestConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(
+                self.dir.name, "app.db"
+            )
+
+        self.app = create_app(FileTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.app.extensions["reader_engine"].dispose()
+        self.app_context.pop()
+
+    def generate(self) -> dict[str, list]:
+        """Every table's rows, from a fresh db"""
+        db.drop_all()
+        db.create_all()
+        with redirect_stdout(io.StringIO()):
+            generate(restaurants=20, users=200, reservations=300, seed=7, days=3)
+        return {
+            name: db.session.execute(
+                sa.select(table).order_by(*table.primary_key.columns)
+            ).all()
+            for (name, table) in db.metadata.tables.items()
+        }
+
+    def test__generate__same_seed_same_rows_without_double_booking(self):
+        first = self.generate()
+        self.assertEqual(self.generate(), first)
+        self.assertEqual(len(first["restaurant"]), 20)
+        self.assertEqual(len(first["user"]), 200)
+        self.assertEqual(len(first["reservation"]), 300)
+        self.assertEqual(len(first["user_busy"]), len(first["user_reservation"]))
+
+        a, b = so.aliased(Reservation), so.aliased(Reservation)
+        overlap = sa.and_(a.id < b.id, a.start <= b.end, a.end >= b.start)
+        tables = sa.select(sa.func.count()).join_from(
+            a, b, sa.and_(a.table_id == b.table_id, overlap)
+        )
+        self.assertEqual(db.session.scalar(tables), 0)
+
+        ua, ub = user_reservation.alias(), user_reservation.alias()
+        users = (
+            sa.select(sa.func.count())
+            .select_from(ua)
+            .join(ub, ua.c.user_id == ub.c.user_id)
+            .join(a, a.id == ua.c.reservation_id)
+            .join(b, b.id == ub.c.reservation_id)
+            .where(overlap)
+        )
+        self.assertEqual(db.session.scalar(users), 0)
+
+
+class IndexTestConfig(TestConfig):
+    AVAILABILITY_ENGINE = "index"
+
+
+class TestRestaurantIndexEngine(TestRestaurant):
+    """Same search behavior, using the in-memory interval index"""
+
+    config = IndexTestConfig
+    # How long after a reservation ends its table shows as free again
+    free_after = timedelta(minutes=1)
+
+    def test__search_has_table__engine__kept_in_sync_with_bookings(self):
+        start = datetime(2020, 1, 1, 1)
+        end = datetime(2020, 1, 1, 3)
+        rest = Restaurant.query.get(5)
+
+        def search(start, end):
+            query = Restaurant.search_has_table([5], start, end)
+            return {r.id for r in db.session.scalars(query).all()}
+
+        # Build the index before booking, so booking has to update it
+        self.assertIn(5, search(start, end))
+        reservations = [rest.book_table([5], start, end) for _ in rest.tables]
+        self.assertNotIn(5, search(start, end))
+        # Touching the end of a reservation still overlaps, same as the SQL check
+        self.assertNotIn(5, search(end, end + timedelta(hours=2)))
+        self.assertIn(5, search(end + self.free_after, end + timedelta(hours=2)))
+
+        client = self.app.test_client()
+        response = client.delete(f"/reservation/{reservations[0].id}")
+        self.assertEqual(response.status_code, 204)
+        self.assertIn(5, search(start, end))
+
+    def test__search_has_table__engine__follows_unloaded_attribute_writes(self):
+        start = datetime(2020, 1, 1, 18)
+        end = start + timedelta(hours=2)
+        later = start + timedelta(hours=4)
+        rest = Restaurant.query.get(5)
+
+        def search(start, end):
+            query = Restaurant.search_has_table([5], start, end)
+            return {r.id for r in db.session.scalars(query).all()}
+
+        self.assertIn(5, search(start, end))
+        reservations = [rest.book_table([5], start, end) for _ in rest.tables]
+        # Expired by the commit, so none of their columns are loaded
+        for res in reservations:
+            res.start = later
+            res.end = later + timedelta(hours=2)
+        db.session.commit()
+        self.assertIn(5, search(start, end))
+        self.assertNotIn(5, search(later, later + timedelta(hours=2)))
+
+    def test__search_has_table__engine__matches_sql(self):
+        for rid in [1, 2, 3]:
+            rest = Restaurant.query.get(rid)
+            # Fully booked for a different block per restaurant
+            for i, table in enumerate(rest.tables):
+                db.session.add(
+                    Reservation(
+                        start=datetime(2020, 1, 1, rid * 3, i % 2),
+                        end=datetime(2020, 1, 1, rid * 3 + 2),
+                        table_id=table.id,
+                    )
+                )
+        db.session.commit()
+
+        for hour in range(12):
+            start = datetime(2020, 1, 1, hour, 30)
+            end = start + timedelta(hours=2)
+            for userids in [[5], [4], [1, 5], [1, 2, 3, 5]]:
+                self.app.config["AVAILABILITY_ENGINE"] = "sql"
+                expected = db.session.scalars(
+                    Restaurant.search_has_table(userids, start, end)
+                ).all()
+                self.app.config["AVAILABILITY_ENGINE"] = self.config.AVAILABILITY_ENGINE
+                out = db.session.scalars(
+                    Restaurant.search_has_table(userids, start, end)
+                ).all()
+                self.assertEqual(
+                    [r.id for r in out], [r.id for r in expected], (start, userids)
+                )
+
+
+class MatrixTestConfig(TestConfig):
+    AVAILABILITY_ENGINE = "matrix"
+    OCCUPANCY_ORIGIN = datetime(2020, 1, 1)
+    OCCUPANCY_HORIZON_DAYS = 1
+
+
+@unittest.skipUnless(installed("numpy"), "The matrix engine needs numpy")
+class TestRestaurantMatrixEngine(TestRestaurantIndexEngine):
+    """Same search behavior, using the NumPy occupancy matrix"""
+
+    config = MatrixTestConfig
+    # Rounded out to whole slots (`OCCUPANCY_SLOT_MINUTES`)
+    free_after = timedelta(minutes=15)
+
+    def test__search_has_table__outside_horizon__falls_back_to_sql(self):
+        rest = Restaurant.query.get(5)
+        start = datetime(2020, 1, 2, 23)
+        end = start + timedelta(hours=2)
+        for _ in rest.tables:
+            rest.book_table([5], start, end)
+
+        query = Restaurant.search_has_table([5], start, end)
+        self.assertEqual(len(db.session.scalars(query).all()), 4)
+
+    def test__search_has_table__matrix__horizon_moves_with_the_day(self):
+        self.app.config["OCCUPANCY_ORIGIN"] = None
+        today = datetime(2020, 1, 1)
+        with mock.patch("app.availability._today", return_value=today):
+            matrix = get_engine()
+            self.assertEqual(matrix.origin, today)
+            self.assertIs(get_engine(), matrix)
+
+        later = today + timedelta(days=3)
+        start = later + timedelta(hours=1)
+        end = start + timedelta(hours=2)
+        rest = Restaurant.query.get(5)
+        for _ in rest.tables:
+            rest.book_table([5], start, end)
+        # Past the first day's horizon
+        self.assertIsNone(matrix.available_restaurants(1, start, end))
+        with mock.patch("app.availability._today", return_value=later):
+            self.assertTrue(matrix.stale)
+            query = Restaurant.search_has_table([5], start, end)
+            self.assertNotIn(5, {r.id for r in db.session.scalars(query)})
+            moved = get_engine()
+            self.assertIsNot(moved, matrix)
+            self.assertEqual(moved.origin, later)
+            self.assertEqual(moved.available_restaurants(1, start, end), {1, 2, 3, 4})
+
+
+class CacheTestConfig(TestConfig):
+    SEARCH_CACHE_SIZE = 4
+
+
+class TestRestaurantSearchCache(TestRestaurant):
+    """Same search behavior, through the search result cache"""
+
+    config = CacheTestConfig
+
+    def test__search_has_table__cache__hits_and_precise_invalidation(self):
+        cache = search_cache()
+
+        def search(userids, start):
+            query = Restaurant.search_has_table(
+                userids, start, start + timedelta(hours=2)
+            )
+            return [r.id for r in db.session.scalars(query).all()]
+
+        six, nine = datetime(2020, 1, 1, 18), datetime(2020, 1, 1, 21)
+        self.assertEqual(search([5], six), [1, 2, 3, 4, 5])
+        self.assertEqual(search([4], six), [3])
+        self.assertEqual(search([5], nine), [1, 2, 3, 4, 5])
+        # Same restrictions & size from a different user is the same entry
+        self.assertEqual(search([5], six), [1, 2, 3, 4, 5])
+        self.assertEqual(cache.stats()["misses"], 3)
+        self.assertEqual(search([2], six), [2])
+        self.assertEqual(search([3], six), [1, 2, 3])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        rest = Restaurant.query.get(5)
+        for _ in rest.tables:
+            rest.book_table([6], six, six + timedelta(hours=2))
+        # Only searches overlapping the bookings are dropped
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(search([1], six), [2])
+        self.assertEqual(search([4], six), [3])
+
+        rest = Restaurant.query.get(1)
+        rest.endorsements.append(Restriction.query.filter_by(name="paleo").first())
+        db.session.commit()
+        # Only searches needing paleo are dropped
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(search([4], six), [1, 3])
+        self.assertEqual(search([1], six), [2])
+
+        client = self.app.test_client()
+        stats = client.get("/restaurant/search/cache").get_json()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["size"], 3)
+
+    def test__search_has_table__cache__moved_reservation_frees_its_old_block(self):
+        def search(start):
+            query = Restaurant.search_has_table([5], start, start + timedelta(hours=1))
+            return {r.id for r in db.session.scalars(query).all()}
+
+        six, seven = datetime(2020, 1, 1, 18), datetime(2020, 1, 1, 19)
+        rest = Restaurant.query.get(5)
+        reservations = [
+            rest.book_table([5], six, six + timedelta(hours=4)) for _ in rest.tables
+        ]
+        self.assertEqual(search(seven), {1, 2, 3, 4})
+        # Neither its old start nor its old end touch the cached block
+        for res in reservations:
+            res.start = datetime(2020, 1, 1, 21)
+        db.session.commit()
+        self.assertEqual(search(seven), {1, 2, 3, 4, 5})
+
+        nine = datetime(2020, 1, 1, 21)
+        self.assertEqual(search(nine), {1, 2, 3, 4})
+        # Moved to another restaurant's tables, its own are free at the same time
+        reservations[0].table_id = Restaurant.query.get(4).tables[0].id
+        reservations[1].table_id = Restaurant.query.get(4).tables[1].id
+        db.session.commit()
+        self.assertEqual(search(nine), {1, 2, 3, 4, 5})
+
+
+class CatalogCacheTestConfig(TestConfig):
+    CATALOG_CACHE_SIZE = 16
+
+
+class TestCatalogCache(TestRestaurant):
+    config = CatalogCacheTestConfig
+    # Reading the response's versions
+    catalog_queries = 1
+
+    def test__catalog_response__sees_other_processes_writes(self):
+        dir_ = tempfile.TemporaryDirectory()
+        self.addCleanup(dir_.cleanup)
+
+        class FileTestConfig(self.config):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(dir_.name, "app.db")
+
+        # Two workers on one database, with a cache each
+        worker, other = create_app(FileTestConfig), create_app(FileTestConfig)
+        with worker.app_context():
+            db.create_all()
+            db.session.add(Restaurant(name="Lardo"))
+            db.session.commit()
+        client = worker.test_client()
+        etag = client.get("/restaurant/1").headers["ETag"]
+        self.assertEqual(
+            client.get("/restaurant/1", headers={"If-None-Match": etag}).status_code,
+            304,
+        )
+
+        with other.app_context():
+            db.session.get(Restaurant, 1).name = "Lardo Burgers"
+            db.session.commit()
+        response = client.get("/restaurant/1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["name"], "Lardo Burgers")
+
+        for app in (worker, other):
+            with app.app_context():
+                db.engine.dispose()
+                app.extensions["reader_engine"].dispose()
+
+    def test__catalog_response__etag_changes_only_with_its_rows(self):
+        client = self.app.test_client()
+
+        def etags():
+            return {
+                url: client.get(url).headers["ETag"]
+                for url in ["/restaurant/1", "/restaurant/2", "/restaurants", "/user/1"]
+            }
+
+        before = etags()
+        response = client.get(
+            "/restaurant/1", headers={"If-None-Match": before["/restaurant/1"]}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b"")
+
+        # Bookings don't show up in any of these
+        Restaurant.query.get(1).book_table(
+            [1], datetime(2020, 1, 1, 18), datetime(2020, 1, 1, 20)
+        )
+        self.assertEqual(etags(), before)
+
+        paleo = Restriction.query.filter_by(name="paleo").first()
+        rest = Restaurant.query.get(1)
+        rest.endorsements.append(paleo)
+        db.session.commit()
+        after = etags()
+        self.assertNotEqual(after["/restaurant/1"], before["/restaurant/1"])
+        self.assertNotEqual(after["/restaurants"], before["/restaurants"])
+        self.assertEqual(after["/restaurant/2"], before["/restaurant/2"])
+        self.assertEqual(after["/user/1"], before["/user/1"])
+        self.assertIn("Paleo", client.get("/restaurant/1").get_json()["endorsements"])
+
+        # Through the other side of the relationship
+        user = User.query.get(1)
+        paleo.users.append(user)
+        db.session.commit()
+        self.assertNotEqual(etags()["/user/1"], after["/user/1"])
+
+        # Bulk writes to association tables invalidate the whole kind
+        before = etags()
+        db.session.execute(
+            sa.insert(restaurant_endorsement).values(restaurant_id=2, restriction_id=4)
+        )
+        db.session.commit()
+        after = etags()
+        self.assertNotEqual(after["/restaurant/2"], before["/restaurant/2"])
+        self.assertEqual(after["/user/1"], before["/user/1"])
+
+
+class SlotTestConfig(TestConfig):
+    TABLE_SLOTS = True
+
+
+class TestRestaurantSlots(TestRestaurant):
+    """Same search & booking behavior, with conflicts found through `table_slot`"""
+
+    config = SlotTestConfig
+
+    def test__search_paths__agree_on_slot_rounding(self):
+        start = datetime(2020, 1, 1, 18)
+        end = start + timedelta(hours=2)
+        rest = Restaurant.query.get(5)
+        for _ in rest.tables:
+            rest.book_table([5], start, end)
+
+        # Within the slot the bookings end in
+        after = end + timedelta(minutes=5)
+        query = Restaurant.search_has_table([5], after, after + timedelta(hours=2))
+        self.assertNotIn(5, [r.id for r in db.session.scalars(query)])
+        batch = Restaurant.search_has_table_batch(
+            [([5], after, after + timedelta(hours=2))]
+        )
+        self.assertNotIn(5, batch[0])
+        client = self.app.test_client()
+        response = client.post(
+            "/restaurant/search/batch",
+            json=[{"user_ids": [5], "datetime": after.isoformat()}],
+        )
+        items = response.get_json()["results"][0]["items"]
+        self.assertNotIn(5, [r["id"] for r in items])
+        slots = dict(
+            rest.day_availability(
+                start.date(), 2, timedelta(minutes=5), timedelta(hours=2)
+            )
+        )
+        self.assertFalse(slots[after])
+        self.assertTrue(slots[end + timedelta(minutes=15)])
+        self.assertIsNone(rest.book_table([5], after, after + timedelta(hours=2)))
+
+    def slot_rows(self, reservation_id):
+        return db.session.execute(
+            sa.select(table_slot.c.table_id, table_slot.c.slot_start)
+            .where(table_slot.c.reservation_id == reservation_id)
+            .order_by(table_slot.c.slot_start)
+        ).all()
+
+    def test__table_slot__written_with_bookings_and_unique_per_table(self):
+        start = datetime(2020, 1, 1, 18)
+        res = Restaurant.query.get(5).book_table([1], start, start + timedelta(hours=1))
+        rows = self.slot_rows(res.id)
+        # 18:00 to 19:00 inclusive touches five slots
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0], (res.table_id, start))
+        self.assertEqual(rows[-1][1], start + timedelta(hours=1))
+
+        # The key rejects a second reservation on the table, whatever wrote it
+        db.session.add(
+            Reservation(
+                table_id=res.table_id,
+                start=start + timedelta(minutes=50),
+                end=start + timedelta(hours=2),
+            )
+        )
+        with self.assertRaises(sa.exc.IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+        # Within a slot of an existing reservation conflicts, even without overlap
+        rest = Restaurant.query.get(5)
+        later = start + timedelta(hours=1, minutes=5)
+        self.assertIsNotNone(rest.book_table([1], later, later + timedelta(hours=1)))
+        self.assertIsNone(rest.book_table([1], later, later + timedelta(hours=1)))
+        self.assertEqual(slots.check(), {"missing": [], "extra": [], "clashes": []})
+
+        response = self.app.test_client().delete(f"/reservation/{res.id}")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.slot_rows(res.id), [])
+
+    def test__table_slot__rebuild_and_check(self):
+        start = datetime(2020, 1, 1, 18)
+        rest = Restaurant.query.get(1)
+        reservations = [
+            rest.book_table([1], start, start + timedelta(hours=2)) for _ in range(3)
+        ]
+        expected = slots.check()
+        self.assertEqual(expected, {"missing": [], "extra": [], "clashes": []})
+
+        # Drift: a lost slot, a stale one, and a booking written around the session
+        db.session.execute(
+            table_slot.delete().where(
+                table_slot.c.reservation_id == reservations[0].id,
+                table_slot.c.slot_start == start,
+            )
+        )
+        db.session.execute(
+            table_slot.insert().values(
+                table_id=reservations[1].table_id,
+                slot_start=datetime(2020, 1, 2),
+                reservation_id=reservations[1].id,
+            )
+        )
+        db.session.execute(
+            sa.insert(Reservation).values(
+                table_id=reservations[2].table_id,
+                start=start + timedelta(hours=1),
+                end=start + timedelta(hours=3),
+            )
+        )
+        db.session.commit()
+        added = db.session.scalar(sa.select(sa.func.max(Reservation.id)))
+        problems = slots.check()
+        # The new one clashes with the earlier reservation from 19:00 to 20:00, and
+        # the rest of its slots are missing
+        clashing = [start + timedelta(minutes=15 * i) for i in range(4, 13)]
+        table_id = reservations[2].table_id
+        self.assertEqual(
+            problems["missing"],
+            [(reservations[0].table_id, start, reservations[0].id)]
+            + [(table_id, slot, added) for slot in clashing[5:]],
+        )
+        self.assertEqual(
+            problems["extra"],
+            [(reservations[1].table_id, datetime(2020, 1, 2), reservations[1].id)],
+        )
+        self.assertEqual(
+            problems["clashes"], [(table_id, slot, added) for slot in clashing[:5]]
+        )
+
+        # 18:00 to 20:00 is 9 slots per reservation
+        self.assertEqual(slots.rebuild(), 3 * 9 + 4)
+        problems = slots.check()
+        self.assertEqual(problems["missing"] + problems["extra"], [])
+        self.assertEqual(len(problems["clashes"]), 5)
+
+
+class TestRestaurantFileDatabase(TestRestaurant):
+    """Same behavior against a database file, plus what needs one: many threads
+    booking at once, and the async entry point (on its own connections)
+    """
+
+    THREADS = 8
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        path = os.path.join(self.dir.name, "app.db")
+
+        class FileTestConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + path
+
+        self.config = FileTestConfig
+        super().setUp()
+
+    def tearDown(self):
+        engine = db.engine
+        super().tearDown()
+        engine.dispose()
+
+    def book_concurrently(self, book):
+        """Have every thread try every (restaurant, time) twice, via `book`
+
+        Returns how many bookings succeeded.
+        """
+        starts = [datetime(2020, 1, 1, hour) for hour in (10, 13, 16)]
+        attempts = [(rid, start) for rid in range(1, 6) for start in starts] * 2
+        booked, errors = [], []
+
+        def worker(i):
+            with self.app.app_context():
+                try:
+                    order = random.Random(i).sample(attempts, len(attempts))
+                    for rid, start in order:
+                        res = book(rid, [i % 6 + 1], start, start + timedelta(hours=2))
+                        if res is not None:
+                            booked.append(res)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [
+            threading.Thread(target=worker, args=(i,)) for i in range(self.THREADS)
+        ]
+        began = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+        print(f"{len(booked)} bookings in {elapsed:.2f}s", end=" ")
+        print(f"({len(booked) / elapsed:.0f}/s, {self.THREADS} threads)")
+        self.assertEqual(errors, [])
+
+        # Every table free at every time gets booked exactly once
+        self.assertEqual(len(booked), Table.query.count() * len(starts))
+        a, b = so.aliased(Reservation), so.aliased(Reservation)
+        overlaps = db.session.scalar(
+            sa.select(sa.func.count())
+            .select_from(a)
+            .join(
+                b,
+                sa.and_(
+                    a.table_id == b.table_id,
+                    a.id < b.id,
+                    a.start <= b.end,
+                    a.end >= b.start,
+                ),
+            )
+        )
+        self.assertEqual(overlaps, 0)
+
+    def test__book_table__concurrent__no_overlapping_reservations(self):
+        def book(rid, user_ids, start, end):
+            res = db.session.get(Restaurant, rid).book_table(user_ids, start, end)
+            return res and res.id
+
+        self.book_concurrently(book)
+
+    def test__claim_table__concurrent_without_locks__no_overlapping_reservations(
+        self,
+    ):
+        # Skip the in-process lock, so only the database keeps bookings apart
+        def book(rid, user_ids, start, end):
+            restaurant = db.session.get(Restaurant, rid)
+            while True:
+                try:
+                    res = restaurant._claim_table(user_ids, start, end)
+                except sa.exc.OperationalError:
+                    db.session.rollback()
+                    continue
+                if res is not BOOKING_CONFLICT:
+                    return res and res.id
+
+        self.book_concurrently(book)
+
+    def test__availability_engine__keeps_bookings_committed_while_building(self):
+        self.app.config["AVAILABILITY_ENGINE"] = "index"
+        start = datetime(2020, 1, 1, 18)
+        end = start + timedelta(hours=2)
+        build = IntervalIndex.build
+
+        def book(rid):
+            with self.app.app_context():
+                try:
+                    db.session.get(Restaurant, rid).book_table([5], start, end)
+                finally:
+                    db.session.remove()
+
+        def build_while_booking(*args):
+            index = build(*args)
+            # Another request books after the SELECT, before the index is in use
+            for _ in range(2):
+                thread = threading.Thread(target=book, args=(5,))
+                thread.start()
+                thread.join()
+            return index
+
+        with mock.patch.object(IntervalIndex, "build", build_while_booking):
+            engine = get_engine()
+        self.assertIs(get_engine(), engine)
+        self.assertNotIn(5, engine.available_restaurants(1, start, end))
+
+    def asgi(self, method, url):
+        """Make one request through the async entry point"""
+        return asyncio.run(self.asgi_many([(method, url)]))[0]
+
+    async def asgi_many(self, requests):
+        """Make (method, url) requests concurrently, returning (status, body)s"""
+        app = AsyncApp(self.app)
+        try:
+            responses = await asyncio.gather(
+                *(local_request(app, method, url) for (method, url) in requests)
+            )
+        finally:
+            await app.engine.dispose()
+        return [(status, body) for (status, _, body) in responses]
+
+    @unittest.skipUnless(
+        installed("aiosqlite"), "The async entry point needs aiosqlite"
+    )
+    def test__asgi__same_responses_as_wsgi(self):
+        Restaurant.query.get(1).book_table(
+            [1, 2], datetime(2020, 1, 1, 18), datetime(2020, 1, 1, 20)
+        )
+        client = self.app.test_client()
+        for url in [
+            "/restaurants?per_page=3",
+            "/restaurant/2",
+            "/users?cursor=",
+            "/user/1/reservations",
+            "/reservations",
+            "/restaurant/search?user_ids=5&datetime=2020-01-01T19:00:00",
+            "/restaurant/search?user_ids=1&datetime=2020-01-01T19:00:00",
+            "/restaurant/99",
+        ]:
+            response = client.get(url)
+            status, data = self.asgi("GET", url)
+            self.assertEqual(status, response.status_code, url)
+            self.assertEqual(data, response.get_data(), url)
+
+    @unittest.skipUnless(
+        installed("aiosqlite"), "The async entry point needs aiosqlite"
+    )
+    def test__asgi__concurrent_bookings__no_overlapping_reservations(self):
+        # Every party tries u.to.pi.a's 2 tables at the same time
+        url = "/restaurant/5/reservation?user_ids={}&datetime=2020-01-01T18:00:00"
+        responses = asyncio.run(
+            self.asgi_many([("POST", url.format(u)) for u in (1, 5, 6)])
+        )
+        statuses = sorted(status for (status, _) in responses)
+        self.assertEqual(statuses, [200, 200, 400])
+
+        booked = Reservation.query.all()
+        self.assertEqual(len(booked), 2)
+        self.assertEqual(len({r.table_id for r in booked}), 2)
+
+    def test__sqlite_profile__pragmas_and_pool(self):
+        with db.engine.connect() as conn:
+            pragma = lambda name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+            self.assertEqual(pragma("journal_mode"), "wal")
+            self.assertEqual(pragma("synchronous"), 1)  # NORMAL
+            self.assertEqual(pragma("busy_timeout"), 5000)
+            self.assertEqual(pragma("temp_store"), 2)  # MEMORY
+        self.assertEqual(db.engine.pool.size(), self.config.SQLITE_POOL["pool_size"])
+
+    def test__sqlite_profile__reads_during_open_write(self):
+        writer = db.engine.connect()
+        self.addCleanup(writer.close)
+        # Locks out readers, unless in WAL mode
+        writer.exec_driver_sql("BEGIN EXCLUSIVE")
+        writer.exec_driver_sql("UPDATE restaurant SET name = 'Renamed' WHERE id = 1")
+
+        # Another connection reads the last commit, without waiting on the writer
+        began = time.perf_counter()
+        response = self.app.test_client().get("/restaurant/1")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.json["name"], "Renamed")
+        self.assertLess(time.perf_counter() - began, 1)
+        writer.rollback()
+
+    def count_statements(self, engine):
+        """Count the statements `engine` runs until the test ends"""
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        sa.event.listen(engine, "before_cursor_execute", record)
+        self.addCleanup(sa.event.remove, engine, "before_cursor_execute", record)
+        return statements
+
+    def test__read_routing__get_requests_query_the_reader(self):
+        reader = self.app.extensions["reader_engine"]
+        reads, writes = self.count_statements(reader), self.count_statements(db.engine)
+        # Requests sharing the test's session only route when it's not mid-transaction
+        db.session.commit()
+
+        client = self.app.test_client()
+        url = "/restaurant/5/reservation?user_ids=1&datetime=2020-01-01T18:00:00"
+        self.assertEqual(client.post(url).status_code, 200)
+        self.assertEqual(reads, [])
+        self.assertTrue(any(s.startswith("INSERT") for s in writes))
+
+        del writes[:]
+        db.session.commit()
+        response = client.get("/user/1/reservations")
+        self.assertEqual(response.status_code, 200)
+        # Sees the booking just committed on the writer
+        self.assertEqual(len(response.json["items"]), 1)
+        self.assertNotEqual(reads, [])
+        self.assertEqual(writes, [])
+
+    def test__read_routing__reader_is_read_only(self):
+        reader = self.app.extensions["reader_engine"]
+        with reader.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql("PRAGMA journal_mode").scalar(), "wal"
+            )
+            with self.assertRaises(sa.exc.OperationalError):
+                conn.exec_driver_sql("DELETE FROM reservation")